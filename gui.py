@@ -310,6 +310,8 @@ class Main:
         self.AvailablePorts = SAXSDrivers.list_available_ports()
         self.controller = SAXSDrivers.SAXSController(timeout=0.1)
         self.instruments = []
+        self.pump_monitor = SAXSDrivers.PumpMonitor(errorlogger=self.python_logger)
+        self.pump_monitor.start()
         self.pump = None
         self.cerberus_pump = None
         self.purge_valve = None
@@ -559,10 +561,10 @@ class Main:
     def stop_instruments(self):
         SAXSDrivers.InstrumentTerminateFunction(self.instruments)
         # Nesting the commands so that if one fails the rest still complete
-        for instrument in self.instruments:
-            if instrument.enabled and instrument.instrument_type == "Pump":
-                if instrument.is_running():
-                    return
+        pumps = [instrument for instrument in self.instruments if instrument.enabled and instrument.instrument_type == "Pump"]
+        # asked, not taken from the pump monitor: its last reading is from before the stop
+        if any(SAXSDrivers.pumps_running(pumps)):
+            return
 
         try:
             self.flowpath.valve4.set_auto_position("Load")
@@ -696,6 +698,8 @@ class Main:
                 button.destroy()
 
         self.instruments = []
+        self.pump_monitor.set_pumps([])
+        self.pump_monitor.poll_rate = float(instrument_config.get('pump_poll_rate', SAXSDrivers.PumpMonitor.POLL_RATE))
         self.manual_page_buttons = []
         self.manual_page_variables = []
         self.setup_page_buttons = []
@@ -859,6 +863,7 @@ class Main:
     def handle_exception(self, exception, value, traceback):
         """Add python exceptions to the GUI log."""
         self.python_logger.exception("Caught exception:")
+        self.controller.wire_log.dump("exception in the GUI")
 
     def save_history(self, filename=None):
         """Save a csv file with the current state."""
@@ -881,6 +886,7 @@ class Main:
             # even its first line of code. But hopefully that doesn't happen often
             print("STARTING EXIT PROCEDURE")
             self.stop()
+            self.pump_monitor.stop()
             self.elveflow_display.stop(shutdown=True)
             # now that we've finished telling it to shut down, we can release the lock and
             # let the elveflow display run again
@@ -906,35 +912,26 @@ class Main:
         self.main_tab_ax2.set_ylabel(data_y2_label_var, fontsize=14, color=ElveflowDisplay.COLOR_Y2)
         self.main_tab_ax3.set_ylabel(data_y3_label_var, fontsize=14, color=ElveflowDisplay.COLOR_Y3)
         try:
-            # read it once to avoid a race condition here when reading from
-            # self.elveflow_display.data at the same time as it gets data from the machine
-            elveflow_display_data = self.elveflow_display.data.copy()
-            data_x = np.array([elt[data_x_label_var] for elt in elveflow_display_data])
-            data_y1 = np.array([elt[data_y1_label_var] for elt in elveflow_display_data])
-            data_y2 = np.array([elt[data_y2_label_var] for elt in elveflow_display_data])
-            data_y3 = np.array([elt[data_y3_label_var] for elt in elveflow_display_data])
-
-            data_x_viable = (data_x >= self.graph_start_time)  # & (data_x < self.graph_end_time)
-            data_x = data_x[data_x_viable]
-            data_y1 = data_y1[data_x_viable]
-            data_y2 = data_y2[data_x_viable]
-            data_y3 = data_y3[data_x_viable]
-
-            if data_x_label_var == self.elveflow_display.elveflow_handler.header[0]:
-                data_x -= self.elveflow_display.starttime
-            if data_y1_label_var == self.elveflow_display.elveflow_handler.header[0]:
-                data_y1 -= self.elveflow_display.starttime
-            if data_y2_label_var == self.elveflow_display.elveflow_handler.header[0]:
-                data_y2 -= self.elveflow_display.starttime
-            if data_y3_label_var == self.elveflow_display.elveflow_handler.header[0]:
-                data_y3 -= self.elveflow_display.starttime
+            elveflow_display_data = self.elveflow_display.data
+            if elveflow_display_data is None:
+                raise ValueError("no Elveflow data yet")
+            # find the rows of this scan once (by binary search on the store's time index), to avoid
+            # a race condition here when reading from self.elveflow_display.data at the same time
+            # as it gets data from the machine. Times in the store are relative to the display's start time.
+            start, n = elveflow_display_data.index_range(self.graph_start_time - elveflow_display_data.time_origin)
+            # min/max decimation keeps each line's extremes, so autoscaling from it is still exact
+            width = int(self.main_tab_ax1.get_window_extent().width)
+            data_x1, data_y1 = self.elveflow_display.decimated(data_x_label_var, data_y1_label_var, start, n, width)
+            data_x2, data_y2 = self.elveflow_display.decimated(data_x_label_var, data_y2_label_var, start, n, width)
+            data_x3, data_y3 = self.elveflow_display.decimated(data_x_label_var, data_y3_label_var, start, n, width)
+            data_x = np.concatenate((data_x1, data_x2, data_x3))
 
             extremes = [np.nanmin(data_x), np.nanmax(data_x), np.nanmin(data_y1), np.nanmax(data_y1),
                 np.nanmin(data_y2), np.nanmax(data_y2), np.nanmin(data_y3), np.nanmax(data_y3)]
             if len(data_x) > 0:
-                self.the_line1.set_data(data_x, data_y1)
-                self.the_line2.set_data(data_x, data_y2)
-                self.the_line3.set_data(data_x, data_y3)
+                self.the_line1.set_data(data_x1, data_y1)
+                self.the_line2.set_data(data_x2, data_y2)
+                self.the_line3.set_data(data_x3, data_y3)
         except (ValueError, KeyError):
             extremes = [*self.main_tab_ax1.get_xlim(), *self.main_tab_ax1.get_ylim(),
                 *self.main_tab_ax2.get_ylim(), *self.main_tab_ax3.get_ylim()]
@@ -957,7 +954,36 @@ class Main:
 
     def graph_vline(self, color='k'):
         """Add a vertical line to the graph."""
-        self.main_tab_ax1.axvline(int(time.time() - self.elveflow_display.starttime), color=color, linewidth=5)
+        now = time.time()
+        self.main_tab_ax1.axvline(int(now - self.elveflow_display.starttime), color=color, linewidth=5)
+        self.elveflow_display.add_marker(now, color)
+
+    def wait_until_equilibrated(self, max_time):
+        """wait for the flow to equilibrate after switching. If stable_flow_tolerance (in µL/min)
+        is set in the Elveflow config, that's as soon as the sheath flow has stayed within it for
+        stable_flow_window seconds; either way, it's no longer than max_time seconds, and it ends
+        if the pump stops"""
+        elveflow_config = self.config['Elveflow']
+        tolerance = elveflow_config.get('stable_flow_tolerance', '').strip()
+        if not tolerance or self.elveflow_display.flow_stats is None:
+            self.pump.wait_until_time(max_time, self.update_graph)
+            return
+        pump_stopped = threading.Event()
+
+        def while_waiting():
+            self.update_graph()
+            if not self.pump.known_running():
+                pump_stopped.set()
+        start = time.time()
+        stable = self.elveflow_display.wait_until_stable(int(self.elveflow_sheath_channel.get()), float(tolerance),
+                                                         float(elveflow_config.get('stable_flow_window', 5)), timeout=max_time,
+                                                         interrupt_event=pump_stopped, command_while_waiting=while_waiting)
+        if stable:
+            self.python_logger.info(f'Flow stable after {time.time() - start:.1f} s (at most {max_time:.1f} s)')
+        elif pump_stopped.is_set():
+            self.python_logger.info(f'Pump stopped after {time.time() - start:.1f} s, before the flow was stable')
+        else:
+            self.python_logger.info(f'Flow not stable after {max_time:.1f} s; going on anyway')
 
     def auto_run_choice(self):
         self.queue.put((self.set_insert_purge, False))
@@ -1044,7 +1070,7 @@ class Main:
         self.queue.put((self.flowpath.valve4.set_auto_position, "Run"))
         self.queue.put((self.pump.infuse_volume, self.first_buffer_volume.get()/1000, self.sample_flowrate.get()))
         self.queue.put((self.python_logger.debug, f'Calculated equilibration time: {self.first_buffer_eq_volume.get()/self.sample_flowrate.get()*60}'))
-        self.queue.put((self.pump.wait_until_time, self.first_buffer_eq_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait some amount of time until stable
+        self.queue.put((self.wait_until_equilibrated, self.first_buffer_eq_volume.get()/self.sample_flowrate.get()*60))
         self.queue.put((self.graph_vline, 'chartreuse'))
         self.run_tseries(postfix="pre")
         self.queue.put((self.pump.wait_until_stopped, self.first_buffer_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait the remaining amount of time
@@ -1057,7 +1083,7 @@ class Main:
         self.queue.put((self.flowpath.valve4.set_auto_position, "Run"))
         self.queue.put((self.pump.infuse_volume, self.sample_volume.get()/1000, self.sample_flowrate.get()))
         self.queue.put((self.python_logger.debug, f'Calculated equilibration time: {self.first_buffer_eq_volume.get()/self.sample_flowrate.get()*60}'))
-        self.queue.put((self.pump.wait_until_time, self.sample_eq_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait some amount of time until stable
+        self.queue.put((self.wait_until_equilibrated, self.sample_eq_volume.get()/self.sample_flowrate.get()*60))
         self.queue.put((self.graph_vline, 'chartreuse'))
         self.run_tseries(postfix="sample")
         self.queue.put((self.pump.wait_until_stopped, self.sample_volume.get()/self.sample_flowrate.get()*60, self.update_graph))
@@ -1070,7 +1096,7 @@ class Main:
         self.queue.put((self.flowpath.valve4.set_auto_position, "Run"))
         self.queue.put((self.pump.infuse_volume, self.last_buffer_volume.get()/1000, self.sample_flowrate.get()))
         self.queue.put((self.python_logger.debug, f'Calculated equilibration time: {self.first_buffer_eq_volume.get()/self.sample_flowrate.get()*60}'))
-        self.queue.put((self.pump.wait_until_time, self.last_buffer_eq_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait some amount of time until stable
+        self.queue.put((self.wait_until_equilibrated, self.last_buffer_eq_volume.get()/self.sample_flowrate.get()*60))
         self.queue.put((self.graph_vline, 'chartreuse'))
         self.run_tseries(postfix="post")
         self.queue.put((self.pump.wait_until_stopped, self.last_buffer_volume.get()/self.sample_flowrate.get()*60, self.update_graph))
@@ -1162,7 +1188,7 @@ class Main:
         self.queue.put((self.flowpath.valve3.set_auto_position, 0))
         self.queue.put((self.flowpath.valve4.set_auto_position, "Run"))
         self.queue.put((self.pump.infuse_volume, self.first_buffer_volume.get()/1000, self.sample_flowrate.get()))
-        self.queue.put((self.pump.wait_until_time, self.first_buffer_eq_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait some amount of time until stable
+        self.queue.put((self.wait_until_equilibrated, self.first_buffer_eq_volume.get()/self.sample_flowrate.get()*60))
         self.queue.put((self.graph_vline, 'chartreuse'))
         self.run_tseries(postfix="pre")
         self.queue.put((self.pump.wait_until_stopped, self.first_buffer_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait the remaining amount of time
@@ -1175,7 +1201,7 @@ class Main:
         self.queue.put((self.flowpath.valve3.set_auto_position, 1))
         self.queue.put((self.flowpath.valve4.set_auto_position, "Run"))
         self.queue.put((self.pump.infuse_volume, self.sample_volume.get()/1000, self.sample_flowrate.get()))
-        self.queue.put((self.pump.wait_until_time, self.sample_eq_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait some amount of time until stable
+        self.queue.put((self.wait_until_equilibrated, self.sample_eq_volume.get()/self.sample_flowrate.get()*60))
         self.queue.put((self.graph_vline, 'chartreuse'))
         self.run_tseries(postfix="sample")
         self.queue.put((self.pump.wait_until_stopped, self.sample_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait the remaining amount of time
@@ -1187,7 +1213,7 @@ class Main:
         self.queue.put((self.flowpath.valve3.set_auto_position, 0))
         self.queue.put((self.flowpath.valve4.set_auto_position, "Run"))
         self.queue.put((self.pump.infuse_volume, self.last_buffer_volume.get()/1000, self.sample_flowrate.get()))
-        self.queue.put((self.pump.wait_until_time, self.last_buffer_eq_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait some amount of time until stable
+        self.queue.put((self.wait_until_equilibrated, self.last_buffer_eq_volume.get()/self.sample_flowrate.get()*60))
         self.queue.put((self.graph_vline, 'chartreuse'))
         self.run_tseries(postfix="post")
         self.queue.put((self.pump.wait_until_stopped, self.last_buffer_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait the remaining amount of time
@@ -1280,7 +1306,7 @@ class Main:
         self.queue.put((self.flowpath.valve4.set_auto_position, "Run"))
         self.queue.put((self.pump.infuse_volume, self.first_buffer_volume.get()/1000, self.sample_flowrate.get()))
         self.queue.put((self.python_logger.debug, f'Calculated equilibration time: {self.first_buffer_eq_volume.get()/self.sample_flowrate.get()*60}'))
-        self.queue.put((self.pump.wait_until_time, self.first_buffer_eq_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait some amount of time until stable
+        self.queue.put((self.wait_until_equilibrated, self.first_buffer_eq_volume.get()/self.sample_flowrate.get()*60))
         self.queue.put((self.graph_vline, 'chartreuse'))
         self.run_tseries(postfix="pre")
         self.queue.put((self.pump.wait_until_stopped, self.first_buffer_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait the remaining amount of time
@@ -1347,7 +1373,7 @@ class Main:
         self.queue.put((self.flowpath.valve3.set_auto_position, 0))
         self.queue.put((self.flowpath.valve4.set_auto_position, "Run"))
         self.queue.put((self.pump.infuse_volume, self.first_buffer_volume.get()/1000, self.sample_flowrate.get()))
-        self.queue.put((self.pump.wait_until_time, self.first_buffer_eq_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait some amount of time until stable
+        self.queue.put((self.wait_until_equilibrated, self.first_buffer_eq_volume.get()/self.sample_flowrate.get()*60))
         self.queue.put((self.graph_vline, 'chartreuse'))
         self.run_tseries(postfix="pre")
         self.queue.put((self.pump.wait_until_stopped, self.first_buffer_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait the remaining amount of time
@@ -1426,7 +1452,7 @@ class Main:
         self.queue.put((self.flowpath.valve4.set_auto_position, "Run"))
         self.queue.put((self.pump.infuse_volume, self.sample_volume.get()/1000, self.sample_flowrate.get()))
         self.queue.put((self.python_logger.debug, f'Calculated equilibration time: {self.first_buffer_eq_volume.get()/self.sample_flowrate.get()*60}'))
-        self.queue.put((self.pump.wait_until_time, self.sample_eq_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait some amount of time until stable
+        self.queue.put((self.wait_until_equilibrated, self.sample_eq_volume.get()/self.sample_flowrate.get()*60))
         self.queue.put((self.graph_vline, 'chartreuse'))
         self.run_tseries(postfix="sample")
         self.queue.put((self.pump.wait_until_stopped, self.sample_volume.get()/self.sample_flowrate.get()*60, self.update_graph))
@@ -1494,7 +1520,7 @@ class Main:
         self.queue.put((self.flowpath.valve3.set_auto_position, 1))
         self.queue.put((self.flowpath.valve4.set_auto_position, "Run"))
         self.queue.put((self.pump.infuse_volume, self.sample_volume.get()/1000, self.sample_flowrate.get()))
-        self.queue.put((self.pump.wait_until_time, self.sample_eq_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait some amount of time until stable
+        self.queue.put((self.wait_until_equilibrated, self.sample_eq_volume.get()/self.sample_flowrate.get()*60))
         self.queue.put((self.graph_vline, 'chartreuse'))
         self.run_tseries(postfix="sample")
         self.queue.put((self.pump.wait_until_stopped, self.sample_volume.get()/self.sample_flowrate.get()*60, self.update_graph)) # wait the remaining amount of time
@@ -2091,6 +2117,7 @@ class Main:
     def add_pump_set_buttons(self, address=0, name="Pump", hardware="", pc_connect=True):
         """Add pump buttons to the setup page."""
         self.instruments.append(SAXSDrivers.HPump(logger=self.python_logger, name=name, address=address, hardware_configuration=hardware, lock=self._lock, pc_connect=pc_connect))
+        self.pump_monitor.set_pumps([instrument for instrument in self.instruments if instrument.instrument_type == "Pump"])
         self.NumberofPumps += 1
         instrument_index = len(self.instruments)-1
         self.python_logger.info("Added pump")
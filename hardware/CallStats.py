@@ -0,0 +1,111 @@
+"""Latency and error statistics of instrument calls.
+
+Every call into the Elveflow SDK is timed and its error code counted, per function and
+channel. Latencies go into a log-linear histogram in the style of HdrHistogram: buckets are
+a few percent wide at every scale from microseconds to minutes, so recording a call is
+just an increment, memory is fixed, and any percentile can be read back with a few percent
+error. That is enough to tell a slow USB link (milliseconds) from Python overhead
+(microseconds).
+"""
+import threading
+import numpy as np
+
+
+class LatencyHistogram:
+    """Counts of latencies in log-linear buckets, with a resolution of 2**-(SUB_BUCKET_BITS-1).
+
+    Latencies are recorded in whole microseconds: values below 2**SUB_BUCKET_BITS µs get a
+    bucket each, and every power of two above that is split into 2**(SUB_BUCKET_BITS-1)
+    buckets."""
+    SUB_BUCKET_BITS = 6  # about 3% resolution
+    MAX_EXPONENT = 32  # up to about 2**(32+6) µs, which is days
+
+    def __init__(self):
+        half = 1 << (LatencyHistogram.SUB_BUCKET_BITS - 1)
+        self.counts = np.zeros((LatencyHistogram.MAX_EXPONENT + 2) * half, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0  # seconds
+        self.min = np.inf
+        self.max = 0.0
+
+    @staticmethod
+    def bucket(microseconds):
+        """the index of the bucket holding a (non-negative integer) latency in µs"""
+        exponent = max(microseconds.bit_length() - LatencyHistogram.SUB_BUCKET_BITS, 0)
+        if exponent > LatencyHistogram.MAX_EXPONENT:
+            exponent = LatencyHistogram.MAX_EXPONENT
+            microseconds = (1 << (LatencyHistogram.MAX_EXPONENT + LatencyHistogram.SUB_BUCKET_BITS)) - 1
+        return (exponent << (LatencyHistogram.SUB_BUCKET_BITS - 1)) + (microseconds >> exponent)
+
+    @staticmethod
+    def bucket_range(index):
+        """the (lowest, highest) latency in µs that goes in bucket number index"""
+        half = 1 << (LatencyHistogram.SUB_BUCKET_BITS - 1)
+        if index < 2 * half:
+            return index, index
+        exponent = index // half - 1
+        mantissa = index - exponent * half
+        return mantissa << exponent, ((mantissa + 1) << exponent) - 1
+
+    def record(self, seconds):
+        self.counts[LatencyHistogram.bucket(int(seconds * 1e6))] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """the latency (in seconds) that q percent of the calls were faster than"""
+        if self.count == 0:
+            return np.nan
+        rank = max(int(np.ceil(q / 100 * self.count)), 1)
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        low, high = LatencyHistogram.bucket_range(index)
+        return min(max((low + high) / 2 * 1e-6, self.min), self.max)
+
+    def summary(self):
+        """a dict of the count, mean, min, max and 50th, 90th, 99th and 99.9th percentiles, in seconds"""
+        result = {'count': self.count, 'mean': self.total / self.count if self.count else np.nan,
+                  'min': self.min if self.count else np.nan, 'max': self.max if self.count else np.nan}
+        for q in (50, 90, 99, 99.9):
+            result['p%g' % q] = self.percentile(q)
+        return result
+
+
+class CallStats:
+    """A LatencyHistogram and a count of every error code for each (function, channel) called.
+    Recording is safe from any thread."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.errors = {}  # (function, channel) -> {error code: count}
+        self._lock = threading.Lock()
+
+    def record(self, function, channel, seconds, error=0):
+        key = (function, channel)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+            histogram.record(seconds)
+            if error != 0:
+                codes = self.errors.setdefault(key, {})
+                codes[error] = codes.get(error, 0) + 1
+
+    def stats(self):
+        """a dict of (function, channel) -> the histogram's summary, plus 'errors': {error code: count}"""
+        with self._lock:
+            return {key: dict(histogram.summary(), errors=dict(self.errors.get(key, {})))
+                    for key, histogram in self.histograms.items()}
+
+    def summary_lines(self):
+        """one human-readable line per (function, channel), slowest p99 first"""
+        lines = []
+        for (function, channel), s in sorted(self.stats().items(), key=lambda item: -item[1]['p99']):
+            errors = sum(s['errors'].values())
+            lines.append("%s ch%s: %d calls, median %.2f ms, p99 %.2f ms, max %.2f ms, %d errors%s" % (
+                function, channel, s['count'], s['p50']*1000, s['p99']*1000, s['max']*1000, errors,
+                ' %s' % s['errors'] if errors else ''))
+        return lines
@@ -0,0 +1,337 @@
+"""Per-channel jobs for the Elveflow OB1 executor.
+
+The OB1 is owned by one thread (see FileIO.ElveflowHandler_SDK), which every tick reads all
+the channels and then asks each channel's controller what pressure to set. A controller is a
+ramp, a PID loop, or anything else with a step() method; it never talks to the instrument
+itself, so any number of channels can be controlled at once without fighting over the DLL.
+
+Flow regulation is shared: one MultiChannelPID holds the gains, set-points and integrators
+of all the channels in NumPy arrays and computes every channel's pressure in one step from
+the same sample that goes into the buffer. A FlowPID controller only decides when its
+channel starts and stops being regulated.
+"""
+import math
+import threading
+import time
+import numpy as np
+
+MAX_PRESSURE = 8000  # mbar; the pressure channels are the 0-8000 mbar type
+MIN_PRESSURE = 0
+
+
+def clamp_pressure(pressure):
+    return min(max(pressure, MIN_PRESSURE), MAX_PRESSURE)
+
+
+class ChannelController:
+    """Base class for a job that controls one channel's pressure.
+
+    Every tick the executor calls step(dt, pressure, flowrate) with the seconds since the
+    previous tick and the channel's latest readings; step returns the pressure to set, or
+    None to leave it alone. Once the controller sets self.finished (or its interrupt_event is
+    set), the executor replaces it with follow_up(), calls on_finish, and anyone waiting in
+    join() wakes up."""
+
+    def __init__(self, interrupt_event=None, on_finish=None):
+        self.interrupt_event = interrupt_event if interrupt_event is not None else threading.Event()
+        self.on_finish = on_finish
+        self.finished = False
+        self.last_setpoint = None
+        self._done = threading.Event()
+
+    def step(self, dt, pressure, flowrate):
+        raise NotImplementedError
+
+    def follow_up(self):
+        """the controller to run on this channel once this one is done, if any"""
+        return None
+
+    def finish(self):
+        """called by the executor once the controller is done"""
+        self.finished = True
+        self._done.set()
+
+    def is_done(self):
+        return self._done.is_set()
+
+    def join(self, timeout=None):
+        """wait until the controller is done, like Thread.join. Returns whether it is"""
+        return self._done.wait(timeout)
+
+
+class Trajectory:
+    """A planned pressure ramp: the pressure at times[i] seconds after the start is
+    pressures[i], in between it is interpolated, and after the end it is the last value."""
+
+    def __init__(self, times, pressures):
+        self.times = np.asarray(times, dtype=np.float64)
+        self.pressures = np.asarray(pressures, dtype=np.float64)
+        self.duration = self.times[-1]
+
+    def pressure_at(self, t):
+        return float(np.interp(t, self.times, self.pressures))
+
+    def velocity_at(self, t):
+        """the rate of change of the pressure (mbar/s) at t seconds"""
+        if t >= self.duration or len(self.times) < 2:
+            return 0.0
+        i = min(max(int(np.searchsorted(self.times, t, side='right')) - 1, 0), len(self.times) - 2)
+        return float((self.pressures[i+1] - self.pressures[i]) / (self.times[i+1] - self.times[i]))
+
+
+RAMP_SHAPES = ('linear', 's-curve', 'exponential')
+
+
+def plan_ramp(start, target, rate, shape='linear', acceleration=None, time_constant=None,
+              initial_velocity=0.0, resolution=0.01):
+    """plan a Trajectory from pressure start to target that never changes faster than rate mbar/s.
+
+    linear goes at rate all the way. s-curve also limits the acceleration (mbar/s^2), so the
+    pressure eases in and out; it starts at initial_velocity (mbar/s), so a ramp can be
+    replanned mid-flight without a jerk. exponential goes at rate until it is within
+    rate * time_constant of the target, then closes in exponentially with time_constant
+    seconds, ending when it is within a millibar. Curved trajectories are sampled every
+    resolution seconds"""
+    target = clamp_pressure(target)
+    distance = abs(target - start)
+    if distance == 0 and (shape != 's-curve' or initial_velocity == 0):
+        return Trajectory([0.0], [target])
+    direction = 1.0 if target >= start else -1.0
+    if shape == 'linear':
+        return Trajectory([0.0, distance / rate], [start, target])
+    if shape == 'exponential':
+        linear_distance = max(distance - rate * time_constant, 0)
+        linear_time = linear_distance / rate
+        remaining = distance - linear_distance
+        tail_time = time_constant * np.log(max(remaining, 1.0))  # until within 1 mbar
+        t = np.arange(0, tail_time, resolution)
+        tail = target - direction * remaining * np.exp(-t / time_constant)
+        return Trajectory(np.concatenate(([0.0], linear_time + t, [linear_time + tail_time])),
+                          np.concatenate(([start], tail, [target])))
+    if shape == 's-curve':
+        segments = _trapezoid_segments(start, target, rate, acceleration, initial_velocity)
+        duration = sum(length for length, _ in segments)
+        t = np.append(np.arange(0, duration, resolution), duration)
+        pressures = np.empty(len(t))
+        segment_start, p, v = 0.0, start, initial_velocity
+        for length, a in segments:
+            inside = (t >= segment_start) & (t <= segment_start + length)
+            tau = t[inside] - segment_start
+            pressures[inside] = p + v * tau + a * tau**2 / 2
+            p, v = p + v * length + a * length**2 / 2, v + a * length
+            segment_start += length
+        pressures[-1] = target
+        return Trajectory(t, np.clip(pressures, MIN_PRESSURE, MAX_PRESSURE))
+    raise ValueError("unknown ramp shape %r; use one of %s" % (shape, ', '.join(RAMP_SHAPES)))
+
+
+def _trapezoid_segments(start, target, max_speed, acceleration, velocity):
+    """the (duration, acceleration) segments of the quickest move from start (moving at
+    velocity) to target (at rest), with bounded speed and acceleration"""
+    segments = []
+    direction = 1.0 if target >= start else -1.0
+    speed = velocity * direction  # towards the target
+    position = start
+    if speed < 0 or speed ** 2 / (2 * acceleration) > abs(target - position):
+        # moving away, or too fast to stop in time: stop first, then plan from there
+        length = abs(speed) / acceleration
+        a = -np.sign(velocity) * acceleration
+        segments.append((length, a))
+        position += velocity * length + a * length**2 / 2
+        return segments + _trapezoid_segments(position, target, max_speed, acceleration, 0.0)
+    distance = abs(target - position)
+    if speed > max_speed:
+        peak = max_speed
+    else:
+        # as fast as we can go and still stop in time (never slower than we're going)
+        peak = min(max_speed, np.sqrt((2 * acceleration * distance + speed**2) / 2))
+    if peak >= speed:
+        segments.append(((peak - speed) / acceleration, direction * acceleration))
+    else:
+        segments.append(((speed - peak) / acceleration, -direction * acceleration))
+    cruise = distance - abs(peak**2 - speed**2) / (2 * acceleration) - peak**2 / (2 * acceleration)
+    if cruise > 0 and peak > 0:
+        segments.append((cruise / peak, 0.0))
+    segments.append((peak / acceleration, -direction * acceleration))
+    return segments
+
+
+class PressureRamp(ChannelController):
+    """Move the pressure from wherever it is to target along a planned trajectory (see
+    plan_ramp), so there is no big spike, then leave it there.
+
+    The trajectory is planned from the measured pressure at the first step, and followed on
+    the executor's clock. retarget() changes the target mid-flight: the ramp is replanned
+    from where it is, at the speed it is going. Setting the interrupt event (or cancel())
+    stops it where it is."""
+
+    def __init__(self, target, rate, shape='linear', acceleration=None, time_constant=None,
+                 interrupt_event=None, on_finish=None, clock=time.monotonic):
+        super().__init__(interrupt_event=interrupt_event, on_finish=on_finish)
+        if shape not in RAMP_SHAPES:
+            raise ValueError("unknown ramp shape %r; use one of %s" % (shape, ', '.join(RAMP_SHAPES)))
+        self.target = clamp_pressure(target)
+        self.rate = rate
+        self.shape = shape
+        self.acceleration = acceleration
+        self.time_constant = time_constant
+        self.clock = clock
+        self.trajectory = None
+        self.elapsed = 0.0  # seconds along the trajectory
+        self.started_at = None  # clock time the trajectory starts at
+        self._new_target = None
+
+    def step(self, dt, pressure, flowrate):
+        if self.trajectory is None:
+            # start from the measured pressure
+            self._plan(pressure if not math.isnan(pressure) else 0.0, 0.0)
+        new_target, self._new_target = self._new_target, None
+        if new_target is not None:
+            self.target = new_target
+            self._plan(self.trajectory.pressure_at(self.elapsed), self.trajectory.velocity_at(self.elapsed))
+        self.elapsed += dt
+        self.last_setpoint = self.trajectory.pressure_at(self.elapsed)
+        if self.elapsed >= self.trajectory.duration and self._new_target is None:
+            self.finished = True
+        return self.last_setpoint
+
+    def _plan(self, start, velocity):
+        self.trajectory = plan_ramp(start, self.target, self.rate, shape=self.shape, acceleration=self.acceleration,
+                                    time_constant=self.time_constant, initial_velocity=velocity)
+        self.elapsed = 0.0
+        self.started_at = self.clock()
+
+    def retarget(self, target):
+        """head for target instead, from wherever the ramp is now. Safe to call from any thread"""
+        self._new_target = clamp_pressure(target)
+
+    def cancel(self):
+        """stop the ramp where it is"""
+        self.interrupt_event.set()
+
+    def remaining_time(self):
+        """roughly how many seconds until the ramp reaches its target"""
+        if self.trajectory is None:
+            return math.nan
+        return max(self.trajectory.duration - self.elapsed, 0.0)
+
+    def expected_completion(self):
+        """the time (on the ramp's clock, time.monotonic by default) it should reach its target"""
+        if self.trajectory is None:
+            return math.nan
+        return self.started_at + self.trajectory.duration
+
+
+class MultiChannelPID:
+    """PID loops for several channels at once, acting on pressure to control flow rate.
+
+    The terms follow the usual conventions (the integral is of ki * error, the derivative is
+    of the measurement, so changing the set-point doesn't kick the output), and each channel's
+    output is its PID output plus an offset: the pressure it started from. Outputs are
+    clamped to the pressure range, and the integrators don't wind up against the clamp: a
+    channel's integral only grows while that would move its output back into range."""
+
+    def __init__(self, n_channels=4, output_limits=(MIN_PRESSURE, MAX_PRESSURE)):
+        self.output_limits = output_limits
+        self.active = np.zeros(n_channels, dtype=bool)
+        self.kp = np.zeros(n_channels)
+        self.ki = np.zeros(n_channels)
+        self.kd = np.zeros(n_channels)
+        self.setpoint = np.zeros(n_channels)
+        self.offset = np.zeros(n_channels)
+        self.integral = np.zeros(n_channels)
+        self.last_measurement = np.full(n_channels, np.nan)
+        self.output = np.full(n_channels, np.nan)  # the latest outputs; NaN for inactive channels
+
+    def engage(self, channel, setpoint, pid_constants, offset):
+        """start regulating channel (an index) to setpoint, adding offset to its output"""
+        self.kp[channel], self.ki[channel], self.kd[channel] = pid_constants
+        self.setpoint[channel] = setpoint
+        self.offset[channel] = 0.0 if math.isnan(offset) else offset
+        self.integral[channel] = 0.0
+        self.last_measurement[channel] = np.nan
+        self.output[channel] = np.nan
+        self.active[channel] = True
+
+    def release(self, channel):
+        self.active[channel] = False
+        self.output[channel] = np.nan
+
+    def update(self, dt, measurements):
+        """step every active channel by dt seconds, given the latest flow rates. Returns the
+        array of pressures to set, NaN where there is nothing to set (inactive channels, and
+        channels whose reading failed, which are left as they were)"""
+        measurements = np.asarray(measurements, dtype=np.float64)
+        valid = self.active & ~np.isnan(measurements)
+        if not valid.any() or dt <= 0:
+            return np.where(valid, self.output, np.nan)
+        error = self.setpoint - measurements
+        derivative = np.where(np.isnan(self.last_measurement), 0.0, (measurements - self.last_measurement) / dt)
+        integral = self.integral + self.ki * error * dt
+        output = self.kp * error + integral - self.kd * derivative + self.offset
+        clamped = np.clip(output, *self.output_limits)
+        # anti-windup: where the output is pinned, only integrate back towards the range
+        winding_up = ((output > clamped) & (error > 0)) | ((output < clamped) & (error < 0))
+        self.integral = np.where(valid & ~winding_up, integral, self.integral)
+        self.last_measurement = np.where(valid, measurements, self.last_measurement)
+        self.output = np.where(valid, clamped, self.output)
+        return np.where(valid, self.output, np.nan)
+
+
+class FlowPID(ChannelController):
+    """Hold a channel's flow rate at target using the executor's MultiChannelPID.
+
+    step() doesn't set any pressure itself: it engages the channel in the shared regulator,
+    which sets it. With a margin, the controller finishes once the flow has stayed within
+    target +/- margin for stable_time seconds; with a timeout, once that many seconds have
+    passed. If then_ramp_to is given, the pressure is ramped there afterwards, by the ramp
+    that make_ramp(then_ramp_to) returns."""
+
+    def __init__(self, target, pid_constants, regulator, channel, margin=None, stable_time=0, timeout=None,
+                 then_ramp_to=None, make_ramp=None, interrupt_event=None, on_finish=None):
+        super().__init__(interrupt_event=interrupt_event, on_finish=on_finish)
+        self.target = target
+        self.pid_constants = pid_constants
+        self.regulator = regulator
+        self.channel = channel  # index into the regulator
+        self.margin = margin
+        self.stable_time = stable_time
+        self.timeout = timeout
+        self.then_ramp_to = then_ramp_to
+        self.make_ramp = make_ramp
+        self.engaged = False
+        self.elapsed = 0.0
+        self.time_stable = 0.0
+
+    def step(self, dt, pressure, flowrate):
+        if not self.engaged:
+            self.regulator.engage(self.channel, self.target, self.pid_constants, offset=pressure)
+            self.engaged = True
+            return None
+        self.elapsed += dt
+        output = self.regulator.output[self.channel]
+        if not math.isnan(output):
+            self.last_setpoint = output
+        if self.timeout is not None and self.elapsed > self.timeout:
+            self.finished = True
+        elif self.margin is not None and not math.isnan(flowrate):
+            if abs(flowrate - self.target) < self.margin:
+                self.time_stable += dt
+                if self.time_stable > self.stable_time:
+                    self.finished = True
+            else:
+                # we're no longer in the final range
+                self.time_stable = 0.0
+        if self.finished:
+            self.regulator.release(self.channel)
+        return None
+
+    def finish(self):
+        if self.engaged:
+            self.regulator.release(self.channel)
+        super().finish()
+
+    def follow_up(self):
+        if self.then_ramp_to is None:
+            return None
+        return self.make_ramp(self.then_ramp_to)
@@ -0,0 +1,182 @@
+"""A simulated Elveflow OB1, for running the whole Elveflow stack without the hardware.
+
+SimulatedOB1 has the same OB1_* functions, with the same arguments, as the prototypes that
+Elveflow64.bind_prototypes makes from Elveflow64.dll, so it can be handed to
+FileIO.ElveflowHandler_SDK as its sdk. Select it with `elveflow_backend = simulator` in the
+[Elveflow] section of the config file.
+
+Each channel is modelled as a pressure regulator that follows its set-point with a
+first-order lag and a maximum slew rate, feeding a fluidic resistance: the flow rate follows
+pressure / resistance with another first-order lag. Readings have Gaussian noise added, and
+every call can be made to take a while, like the real DLL does.
+"""
+import threading
+import time
+import numpy as np
+
+MAX_PRESSURE = 8000  # mbar; the channels are simulated as the 0-8000 mbar type
+ERROR_NOT_INITIALIZED = -8001  # error code for calls made with the wrong instrument ID
+
+
+class SimulatedOB1:
+    """A fake OB1 with four channels, whose state evolves in real time.
+
+    The parameters are single values, or lists of four for per-channel values:
+    regulator_time_constant and flow_time_constant in seconds, max_slew_rate in mbar/s,
+    flow_resistance in mbar per µL/min, pressure_noise in mbar and flow_noise in µL/min
+    (standard deviations). call_latency is how many seconds each call takes."""
+    N_CHANNELS = 4
+    REGULATOR_TIME_CONSTANT = 0.05
+    MAX_SLEW_RATE = 5000
+    FLOW_TIME_CONSTANT = 0.5
+    FLOW_RESISTANCE = 100
+    PRESSURE_NOISE = 0.5
+    FLOW_NOISE = 0.02
+    CALL_LATENCY = 0.0
+
+    def __init__(self, regulator_time_constant=REGULATOR_TIME_CONSTANT, max_slew_rate=MAX_SLEW_RATE,
+                 flow_time_constant=FLOW_TIME_CONSTANT, flow_resistance=FLOW_RESISTANCE,
+                 pressure_noise=PRESSURE_NOISE, flow_noise=FLOW_NOISE, call_latency=CALL_LATENCY, seed=None):
+        def per_channel(value):
+            return np.broadcast_to(np.asarray(value, dtype=np.float64), (SimulatedOB1.N_CHANNELS,)).copy()
+        self.regulator_time_constant = per_channel(regulator_time_constant)
+        self.max_slew_rate = per_channel(max_slew_rate)
+        self.flow_time_constant = per_channel(flow_time_constant)
+        self.flow_resistance = per_channel(flow_resistance)
+        self.pressure_noise = per_channel(pressure_noise)
+        self.flow_noise = per_channel(flow_noise)
+        self.call_latency = call_latency
+        self.random = np.random.default_rng(seed)
+
+        self.instrument_id = None
+        self.sensortypes = np.zeros(SimulatedOB1.N_CHANNELS, dtype=np.int64)
+        self.setpoint = np.zeros(SimulatedOB1.N_CHANNELS)
+        self.pressure = np.zeros(SimulatedOB1.N_CHANNELS)
+        self.flowrate = np.zeros(SimulatedOB1.N_CHANNELS)
+        self.acquired_pressure = np.zeros(SimulatedOB1.N_CHANNELS)
+        self.acquired_flowrate = np.zeros(SimulatedOB1.N_CHANNELS)
+        self.calls = {}  # how many times each function was called
+        self._last_update = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """make a simulator from the simulator_* keys of an [Elveflow] config section; missing
+        keys get the defaults. Per-channel values are given as comma-separated lists"""
+        def value(key, default):
+            text = config.get('simulator_' + key, None)
+            if text is None or str(text).strip() == '':
+                return default
+            values = [float(v) for v in str(text).split(',')]
+            return values[0] if len(values) == 1 else values
+        return cls(regulator_time_constant=value('regulator_time_constant', cls.REGULATOR_TIME_CONSTANT),
+                   max_slew_rate=value('max_slew_rate', cls.MAX_SLEW_RATE),
+                   flow_time_constant=value('flow_time_constant', cls.FLOW_TIME_CONSTANT),
+                   flow_resistance=value('flow_resistance', cls.FLOW_RESISTANCE),
+                   pressure_noise=value('pressure_noise', cls.PRESSURE_NOISE),
+                   flow_noise=value('flow_noise', cls.FLOW_NOISE),
+                   call_latency=value('call_latency', cls.CALL_LATENCY))
+
+    def advance(self, dt):
+        """move the simulation dt seconds forward"""
+        if dt <= 0:
+            return
+        # the regulator: first order towards the set-point, no faster than the slew rate
+        step = (self.setpoint - self.pressure) * -np.expm1(-dt / self.regulator_time_constant)
+        step = np.clip(step, -self.max_slew_rate * dt, self.max_slew_rate * dt)
+        previous_pressure = self.pressure
+        self.pressure = np.clip(self.pressure + step, 0, MAX_PRESSURE)
+        # the flow follows the (average) pressure over the step through the resistance
+        steady_flow = (previous_pressure + self.pressure) / 2 / self.flow_resistance
+        self.flowrate = self.flowrate + (steady_flow - self.flowrate) * -np.expm1(-dt / self.flow_time_constant)
+
+    def _call(self, name):
+        """the bookkeeping every call does: count it, take as long as the DLL would, and
+        bring the simulation up to now"""
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.call_latency > 0:
+            time.sleep(self.call_latency)
+        now = time.monotonic()
+        self.advance(now - self._last_update)
+        self._last_update = now
+
+    def _acquire(self):
+        self.acquired_pressure = self.pressure + self.pressure_noise * self.random.standard_normal(SimulatedOB1.N_CHANNELS)
+        flowrate = self.flowrate + self.flow_noise * self.random.standard_normal(SimulatedOB1.N_CHANNELS)
+        self.acquired_flowrate = np.where(self.sensortypes != 0, flowrate, 0.0)
+
+    # the OB1_* call surface, as bound by Elveflow64.bind_prototypes
+
+    def OB1_Initialization(self, device_name, reg_ch_1, reg_ch_2, reg_ch_3, reg_ch_4, ob1_id_out):
+        with self._lock:
+            self._call('OB1_Initialization')
+            self.instrument_id = 0
+            ob1_id_out._obj.value = self.instrument_id
+            return 0
+
+    def OB1_Add_Sens(self, ob1_id, channel, sensortype, digital_analog, calibration, resolution):
+        with self._lock:
+            self._call('OB1_Add_Sens')
+            if ob1_id != self.instrument_id:
+                return ERROR_NOT_INITIALIZED
+            self.sensortypes[channel-1] = sensortype
+            return 0
+
+    def Elveflow_Calibration_Default(self, calib_array_out, length):
+        with self._lock:
+            self._call('Elveflow_Calibration_Default')
+            return 0
+
+    def OB1_Get_Press(self, ob1_id, channel, acquire, calib_array, pressure_out, length):
+        with self._lock:
+            self._call('OB1_Get_Press')
+            if ob1_id != self.instrument_id:
+                return ERROR_NOT_INITIALIZED
+            if acquire:
+                self._acquire()
+            pressure_out._obj.value = self.acquired_pressure[channel-1]
+            return 0
+
+    def OB1_Get_Sens_Data(self, ob1_id, channel, acquire, data_out):
+        with self._lock:
+            self._call('OB1_Get_Sens_Data')
+            if ob1_id != self.instrument_id:
+                return ERROR_NOT_INITIALIZED
+            if acquire:
+                self._acquire()
+            data_out._obj.value = self.acquired_flowrate[channel-1]
+            return 0
+
+    def OB1_Set_Press(self, ob1_id, channel, pressure, calib_array, length):
+        with self._lock:
+            self._call('OB1_Set_Press')
+            if ob1_id != self.instrument_id:
+                return ERROR_NOT_INITIALIZED
+            self.setpoint[channel-1] = min(max(float(pressure), 0), MAX_PRESSURE)
+            return 0
+
+    def OB1_Destructor(self, ob1_id):
+        with self._lock:
+            self._call('OB1_Destructor')
+            if ob1_id != self.instrument_id:
+                return ERROR_NOT_INITIALIZED
+            self.instrument_id = None
+            return 0
+
+
+if __name__ == '__main__':
+    # a quick benchmark of the acquisition and flow control stack against the simulator
+    from hardware import FileIO
+    simulator = SimulatedOB1(call_latency=0.001)
+    handler = FileIO.ElveflowHandler_SDK(sourcename='simulator', sensortypes=[4, 0, 0, 4], sdk=simulator, acquisition_rate=100)
+    handler.start()
+    try:
+        handler.set_pressure_loop(1, 4000).join()
+        start = time.monotonic()
+        pressure = handler.run_volume(4, 25, timeout=60)
+        print("sheath flow settled at %.2f µL/min (%.0f mbar) after %.1f s" % (handler.getVolume(4), pressure, time.monotonic() - start))
+    finally:
+        handler.stop()
+        handler.executor_thread.join()
+    print(handler.acquisition_stats())
+    print(simulator.calls)
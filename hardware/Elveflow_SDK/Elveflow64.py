@@ -3,7 +3,11 @@
 
 from ctypes import *
 import os.path
-ElveflowDLL=CDLL(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Elveflow64.dll"))# change this path
+import types
+try:
+	ElveflowDLL=CDLL(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Elveflow64.dll"))# change this path
+except OSError:
+	ElveflowDLL=None # the DLL only exists on Windows; the wrappers below fail if you call them without it
 
  # Elveflow Library
  # AF1 Device
@@ -651,3 +655,36 @@ def BFS_Zeroing (BFS_ID_in):
 
 
 	return 0
+
+
+
+ # SAXSControl additions
+ #
+ # Each wrapper above looks up its function and reassigns argtypes on every
+ # call, which costs more than the call itself when sampling quickly. The
+ # functions used by the acquisition and control loops are instead bound once
+ # by bind_prototypes, and the result is kept in OB1. Call the bound functions
+ # with positional arguments only.
+ #
+OB1_PROTOTYPES = {
+	'OB1_Initialization': [c_char_p, c_uint16, c_uint16, c_uint16, c_uint16, POINTER(c_int32)],
+	'OB1_Add_Sens': [c_int32, c_int32, c_uint16, c_uint16, c_uint16, ],
+	'Elveflow_Calibration_Default': [POINTER(c_double*1000), c_int32],
+	'OB1_Get_Press': [c_int32, c_int32, c_int32, POINTER(c_double*1000), POINTER(c_double), c_int32],
+	'OB1_Set_Press': [c_int32, c_int32, c_double, POINTER(c_double*1000), c_int32],
+	'OB1_Get_Sens_Data': [c_int32, c_int32, c_int32, POINTER(c_double)],
+	'OB1_Destructor': [c_int32],
+}
+
+def bind_prototypes(dll):
+	"""look up every function in OB1_PROTOTYPES in dll exactly once, set its argtypes
+	and restype, and return them all as attributes of one namespace"""
+	prototypes = types.SimpleNamespace()
+	for name, argtypes in OB1_PROTOTYPES.items():
+		function = getattr(dll, name)
+		function.argtypes = argtypes
+		function.restype = c_int32
+		setattr(prototypes, name, function)
+	return prototypes
+
+OB1 = bind_prototypes(ElveflowDLL) if ElveflowDLL is not None else None
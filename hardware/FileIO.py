@@ -3,9 +3,17 @@ import csv
 import time
 import threading
 import math
-from queue import Queue, Empty as Queue_Empty, Full as Queue_Full
+import os
 from tkinter import filedialog
-from simple_pid import PID
+import queue
+from concurrent.futures import Future
+import numpy as np
+from .SampleBuffer import SampleRingBuffer
+from .RateScheduler import DeadlineScheduler
+from .LogTailer import LogTailer, parse_delimited_block
+from .ElveflowControl import PressureRamp, FlowPID, MultiChannelPID
+from .RunWriter import load_run
+from .CallStats import CallStats
 
 USE_SDK = True
 SDK_SENSOR_TYPES = {
@@ -46,7 +54,7 @@ if USE_SDK:
 class ElveflowHandler_ESI:
     """a class that handles reading in Elveflow-generated log files"""
     SLEEPTIME = 0.2  # if no line exists, wait this many seconds before trying again
-    QUEUE_MAXLEN = 0  # zero means infinite
+    BUFFER_CAPACITY = SampleRingBuffer.DEFAULT_CAPACITY  # how many rows are kept for slow consumers
 
     TESTING_FILENAME = 'Elveflow/temp.txt'
 
@@ -75,7 +83,8 @@ class ElveflowHandler_ESI:
             self.errorlogger = errorlogger
 
         self.header = None
-        self.buffer_queue = Queue(maxsize=ElveflowHandler_ESI.QUEUE_MAXLEN)
+        self.buffer = None  # created once we know the header
+        self.fetch_cursor = 0  # read cursor used by fetchOne/fetchAll
         self.run_flag = threading.Event()
         self.run_flag.set()
 
@@ -83,101 +92,267 @@ class ElveflowHandler_ESI:
         """Start actually trying to read in data from an Elveflow log. Do not call this function more than once"""
         def start_thread():
             self.errorlogger.debug("STARTING HANDLER THREAD %s" % threading.current_thread())
-
-            def line_generator():
-                with open(self.sourcename, 'a+', encoding="latin-1", newline='') as f:
-                    # a+ creates the file if it doesn't exist, or just reads it if not
-                    # we can then jump to the beginning and then continue as though the mode is r
-                    f.seek(0)
-                    # continuously read
-                    while self.run_flag.is_set():
-                        line = f.readline()
-                        if not line.strip():
-                            # wait a little before trying to find more lines
-                            time.sleep(ElveflowHandler_ESI.SLEEPTIME)
-                        else:
-                            # DANGER: next() can raise a StopIteration. If this does, this entire thread silently exits prematurely
-                            # I think I've avoided this with if statements, but you can't be sure.
-                            if self.header is None:
-                                # the first line should be the header
-                                self.header = next(csv.reader([line], delimiter='\t'))  # get the first (only) row from the iterator
-                                self.errorlogger.debug("SETTING HEADER %s" % threading.current_thread())
-                                if getheader_handler is not None:
-                                    getheader_handler()
-                            else:
-                                # otherwise, we already have a header, so just read in data
-                                parsedline = next(csv.DictReader([line], fieldnames=self.header, delimiter='\t'))
-                                for key in parsedline:
-                                    try:
-                                        parsedline[key] = float(parsedline[key])
-                                    except ValueError:
-                                        parsedline[key] = float('nan')
-                                yield parsedline
+            tailer = LogTailer(self.sourcename, encoding="latin-1")
             try:
-                for line in line_generator():
-                    self.buffer_queue.put(line, False)
-                    time.sleep(0.1)
-            except Queue_Full:
-                pass
+                while self.run_flag.is_set():
+                    was_reset, lines = tailer.read_lines()
+                    if was_reset:
+                        self.errorlogger.warning("%s was truncated or replaced; reading it again from the start" % self.sourcename)
+                    if not lines:
+                        # only wait when we've caught up with the end of the file
+                        time.sleep(ElveflowHandler_ESI.SLEEPTIME)
+                        continue
+                    if was_reset or self.header is None:
+                        lines = self._read_header(lines, getheader_handler)
+                    if self.buffer is None:
+                        continue
+                    block, n_rejected = parse_delimited_block(lines, len(self.header), delimiter='\t')
+                    if n_rejected:
+                        self.errorlogger.warning("skipped %d lines of %s that don't match the header" % (n_rejected, self.sourcename))
+                    self.buffer.append_block(block)
             finally:
+                tailer.close()
                 self.errorlogger.debug("ENDING HANDLER THREAD %s, %s" % (threading.current_thread(), threading.enumerate()))
 
         if self.sourcename is not None:
             self.reading_thread = threading.Thread(target=start_thread)
             self.reading_thread.start()
 
+    def _read_header(self, lines, getheader_handler):
+        """treat the first non-blank line as the header and return the lines after it"""
+        while lines and not lines[0].strip():
+            lines = lines[1:]
+        if not lines:
+            return lines
+        header = next(csv.reader([lines[0]], delimiter='\t'))
+        if self.header is None:
+            self.header = header
+            self.buffer = SampleRingBuffer(self.header, capacity=ElveflowHandler_ESI.BUFFER_CAPACITY)
+            self.errorlogger.debug("SETTING HEADER %s" % threading.current_thread())
+            if getheader_handler is not None:
+                getheader_handler()
+        elif header != self.header:
+            self.errorlogger.warning("the header of %s changed; rows that don't match the original header will be skipped" % self.sourcename)
+        return lines[1:]
+
     def stop(self):
         """Stops the reading thread."""
         self.run_flag.clear()
 
+    def read_since(self, cursor):
+        """return (new_cursor, block): every row read since `cursor` as a
+        (number of columns) x (number of rows) array, columns in header order.
+        Start with a cursor of 0. Before the header is known, block has no columns."""
+        if self.buffer is None:
+            return cursor, np.empty((0, 0))
+        return self.buffer.read_since(cursor)
+
+    def current_cursor(self):
+        """return the cursor to start from to read only rows that arrive from now on"""
+        return 0 if self.buffer is None else self.buffer.cursor
+
     def fetchOne(self):
-        """retrieve the oldest element from the buffer. Afterwards, the element is no longer in the buffer.
-        If nothing is in there, return None. (You cannot tell the difference between the leftmost element of
-        the buffer holding None and the buffer being empty, but in this class, the former case should never happen)"""
-        try:
-            return self.buffer_queue.get(False)
-        except IndexError:
+        """retrieve the oldest unfetched row as a dict. Afterwards, fetchOne/fetchAll won't return it again.
+        If nothing is in there, return None."""
+        if self.buffer is None or self.fetch_cursor >= self.buffer.cursor:
             return None
+        self.fetch_cursor, block = self.buffer.read_since(self.fetch_cursor)
+        self.fetch_cursor -= block.shape[1] - 1  # only consume the first row
+        return self.buffer.rows_as_dicts(block[:, :1])[0]
 
     def peekOne(self):
-        """looks at the oldest element from the buffer, but does NOT remove it from the buffer.
-        If nothing is in there, return None. (You cannot tell the difference between the leftmost element of
-        the buffer holding None and the buffer being empty, but in this class, the former case should never happen).
-
-        NOTE that depending on your use-case, you may wish to call this function while holding the mutex"""
-        try:
-            return self.buffer_queue.queue[0]
-        except IndexError:
+        """looks at the oldest unfetched row, but does NOT consume it. If nothing is in there, return None."""
+        if self.buffer is None:
             return None
+        _, block = self.buffer.read_since(self.fetch_cursor)
+        if block.shape[1] == 0:
+            return None
+        return self.buffer.rows_as_dicts(block[:, :1])[0]
 
     def fetchAll(self):
-        """retrieve all elements from the buffer as a list. Afterwards, all elements returned are no longer in the buffer.
-        In this class, the elements of the buffer are all dicts whose keys are the entries of the header"""
-        def generateElements():
+        """retrieve all unfetched rows as a list. Afterwards, fetchOne/fetchAll won't return them again.
+        In this class, the elements of the list are all dicts whose keys are the entries of the header"""
+        if self.buffer is None:
+            return []
+        self.fetch_cursor, block = self.buffer.read_since(self.fetch_cursor)
+        return self.buffer.rows_as_dicts(block)
+
+    def getHeader(self):
+        """returns the header, a list of strings"""
+        return self.header
+
+
+class ElveflowHandler_Replay:
+    """a class that plays back a recorded Elveflow session as if it were happening now
+
+    The recording can be a CSV or tab-separated file with a header line (as saved by the
+    Elveflow tab or by the Elveflow software itself) or a binary run (see RunWriter). Samples
+    keep their original timestamps and come out at `speed` times the rate they were recorded
+    at; a speed of None (or inf) plays them back as fast as the consumers can take them."""
+    BUFFER_CAPACITY = SampleRingBuffer.DEFAULT_CAPACITY  # how many rows are kept for slow consumers
+    MAX_SLEEP = 0.05  # seconds; how long to sleep at most between releases, so stop() is quick
+    BLOCK_ROWS = 1000  # rows per release when playing back as fast as possible
+
+    def __init__(self, sourcename, errorlogger=None, speed=1.0):
+        self.sourcename = sourcename
+        if errorlogger is None:
+            # hack to just redirect logging to the standard print function
+            self.errorlogger = lambda: None
+            self.errorlogger.debug = print
+            self.errorlogger.info = print
+            self.errorlogger.warning = print
+            self.errorlogger.error = print
+            self.errorlogger.exception = print
+            self.errorlogger.critical = print
+        else:
+            self.errorlogger = errorlogger
+        self.speed = None if speed is None or math.isinf(speed) else float(speed)
+        if self.speed is not None and self.speed <= 0:
+            raise ValueError("the replay speed must be positive, not %s" % speed)
+
+        self.header, self.data = self._load(sourcename)
+        self.time_index = self._time_index()
+        self.buffer = SampleRingBuffer(self.header, capacity=ElveflowHandler_Replay.BUFFER_CAPACITY)
+        self.fetch_cursor = 0  # read cursor used by fetchOne/fetchAll
+        self.run_flag = threading.Event()
+        self.run_flag.set()
+        self.finished = threading.Event()  # set once every sample has been played back
+        self.reading_thread = None
+        self.errorlogger.debug("Loaded %d samples from %s to replay" % (self.data.shape[1], sourcename))
+
+    def _load(self, sourcename):
+        """return (header, data) of a recording, data as a (number of columns) x (number of rows) array"""
+        if os.path.isdir(sourcename):
+            metadata, columns = load_run(sourcename)
+            header = [column['name'] for column in metadata['columns']]
+            rows = min((len(values) for values in columns.values()), default=0)
+            return header, np.array([columns[name][:rows] for name in header]).reshape(len(header), rows)
+        with open(sourcename, 'r', encoding='utf-8', errors='replace', newline='') as f:
+            lines = f.read().splitlines()
+        while lines and not lines[0].strip():
+            lines = lines[1:]
+        if not lines:
+            raise ValueError("%s is empty" % sourcename)
+        delimiter = '\t' if '\t' in lines[0] else ','
+        header = next(csv.reader([lines[0]], delimiter=delimiter))
+        data, n_rejected = parse_delimited_block(lines[1:], len(header), delimiter=delimiter)
+        if n_rejected:
+            self.errorlogger.warning("skipped %d lines of %s that don't match the header" % (n_rejected, sourcename))
+        return header, data
+
+    def _time_index(self):
+        """the recording's times, made non-decreasing so they can be searched, relative to the first"""
+        time_columns = [i for i, name in enumerate(self.header) if name.strip().lower().startswith('time')]
+        if not time_columns or self.data.shape[1] == 0:
+            return np.zeros(self.data.shape[1])
+        times = np.fmax.accumulate(self.data[time_columns[0]])
+        return np.nan_to_num(times - times[0], nan=0.0)
+
+    def start(self, getheader_handler=None):
+        """start playing back the recording. Do not call this function more than once"""
+        def start_thread():
+            self.errorlogger.debug("STARTING REPLAY THREAD %s" % threading.current_thread())
+            released = 0
+            n = self.data.shape[1]
+            start_time = time.monotonic()
             try:
-                while True:
-                    yield self.buffer_queue.get(False)
-            except Queue_Empty:
-                return
-        return [elt for elt in generateElements()]
+                while self.run_flag.is_set() and released < n:
+                    if self.speed is None:
+                        due = min(n, released + ElveflowHandler_Replay.BLOCK_ROWS)
+                    else:
+                        replay_time = (time.monotonic() - start_time) * self.speed
+                        due = int(np.searchsorted(self.time_index, replay_time, side='right'))
+                    if due > released:
+                        self.buffer.append_block(self.data[:, released:due])
+                        released = due
+                    if self.speed is None:
+                        time.sleep(0)  # let the consumers in
+                    elif released < n:
+                        wait = (self.time_index[released] / self.speed) - (time.monotonic() - start_time)
+                        self.run_flag.wait(min(max(wait, 0), ElveflowHandler_Replay.MAX_SLEEP))
+                if released == n:
+                    self.finished.set()
+            finally:
+                self.errorlogger.debug("ENDING REPLAY THREAD %s after %d of %d samples" % (threading.current_thread(), released, n))
+
+        if getheader_handler is not None:
+            getheader_handler()
+        self.reading_thread = threading.Thread(target=start_thread)
+        self.reading_thread.start()
+
+    def stop(self):
+        """Stops the replay thread."""
+        self.run_flag.clear()
+
+    def read_since(self, cursor):
+        """return (new_cursor, block): every row played back since `cursor` as a
+        (number of columns) x (number of rows) array, columns in header order. Start with a cursor of 0."""
+        return self.buffer.read_since(cursor)
+
+    def current_cursor(self):
+        """return the cursor to start from to read only rows that arrive from now on"""
+        return self.buffer.cursor
+
+    def fetchOne(self):
+        """retrieve the oldest unfetched row as a dict. Afterwards, fetchOne/fetchAll won't return it again.
+        If nothing is in there, return None."""
+        if self.fetch_cursor >= self.buffer.cursor:
+            return None
+        self.fetch_cursor, block = self.buffer.read_since(self.fetch_cursor)
+        self.fetch_cursor -= block.shape[1] - 1  # only consume the first row
+        return self.buffer.rows_as_dicts(block[:, :1])[0]
+
+    def fetchAll(self):
+        """retrieve all unfetched rows as a list of dicts. Afterwards, fetchOne/fetchAll won't return them again."""
+        self.fetch_cursor, block = self.buffer.read_since(self.fetch_cursor)
+        return self.buffer.rows_as_dicts(block)
 
     def getHeader(self):
         """returns the header, a list of strings"""
         return self.header
 
+    def getPressure(self, channel_number=4):
+        """the most recently played back pressure of channel_number"""
+        return self._latest('Pressure %d [mbar]' % channel_number)
 
-class ElveflowHandler_SDK:
-    """a class that handles interfacing with the Elveflow directly"""
-    SLEEPTIME = 0.1  # how many seconds between each read of the Elveflow output
-    PID_SLEEPTIME = 0.1  # how many seconds between each command of the PID loop
-    QUEUE_MAXLEN = 0  # zero means infinite
+    def getVolume(self, channel_number=4):
+        """the most recently played back flow rate of channel_number"""
+        return self._latest('Volume flow rate %d [µL/min]' % channel_number)
 
-    PRESSURE_MAXSLOPE = 888 * PID_SLEEPTIME     # in mbar per update frame; the 888 is in mbar/s
+    def _latest(self, name):
+        row = self.buffer.latest()
+        if row is None or name not in self.buffer.column_index:
+            return math.nan
+        return row[self.buffer.column_index[name]]
+
+
+class ElveflowHandler_SDK:
+    """a class that handles interfacing with the Elveflow directly
+
+    Once started, a single executor thread owns the OB1: every tick it reads all the
+    channels, steps each channel's controller (a pressure ramp or a flow PID loop, see
+    ElveflowControl) and sends out the resulting set-points. Other threads only ever queue
+    up work for it, so the DLL is never called from two threads at once."""
+    ACQUISITION_RATE = 10  # default ticks (samples) per second; set acquisition_rate in the [Elveflow] config to change it
+    SCHEDULE_REPORT_PERIOD = 60  # at most this many seconds between warnings about missed acquisition deadlines
+    BUFFER_CAPACITY = SampleRingBuffer.DEFAULT_CAPACITY  # how many samples are kept for slow consumers
+    SHUTDOWN_TIMEOUT = 30  # seconds to wait for the pressures to ramp down when stopping
+    SDK_STATS_PERIOD = 300  # seconds between summaries of the SDK call statistics in the log; set sdk_stats_period in the [Elveflow] config to change it
+
+    PRESSURE_RAMP_RATE = 888  # mbar/s
+    PRESSURE_RAMP_ACCELERATION = 2000  # mbar/s^2, for s-curve ramps
+    PRESSURE_RAMP_TIME_CONSTANT = 0.5  # seconds, for exponential ramps
+    RAMP_SHAPE = 'linear'  # see ElveflowControl.plan_ramp; set ramp_shape in the [Elveflow] config to change it
     VOLUME_KP = 50
     VOLUME_KI = 50
     VOLUME_KD = 0
 
-    def __init__(self, sourcename=None, errorlogger=None, sensortypes=[]):
+    def __init__(self, sourcename=None, errorlogger=None, sensortypes=[], sdk=None, acquisition_rate=None, ramp_shape=None,
+                 sdk_stats_period=None):
+        """Connect to the OB1 called sourcename. sdk is the set of bound OB1_* functions to use;
+        by default, the ones from Elveflow64.dll. acquisition_rate is in samples per second.
+        ramp_shape is the shape of every pressure ramp the executor runs. Every
+        sdk_stats_period seconds, a summary of the SDK calls is logged (0 for never)"""
         if sourcename is None or sourcename == '':
             self.sourcename = b'Have you loaded the config file?'
         else:
@@ -197,315 +372,405 @@ class ElveflowHandler_SDK:
             self.errorlogger = errorlogger
         self.errorlogger.debug("Initializing Elveflow at %s" % sourcename)
 
+        self.sdk = Elveflow_SDK.OB1 if sdk is None else sdk
+        self.call_stats = CallStats()  # latencies and error codes of every SDK call
+        self.sdk_stats_period = ElveflowHandler_SDK.SDK_STATS_PERIOD if sdk_stats_period is None else sdk_stats_period
+        if self.sdk is None:
+            raise RuntimeError("Elveflow64.dll could not be loaded")
         self.instr_ID = c_int32()
         self.calib = (c_double*1000)()  # always define array that way, calibration should have 1000 elements
+        self.calib_ref = byref(self.calib)
+        self.out_params = threading.local()  # out-parameters for the SDK calls, reused within each thread
 
-        err_code = Elveflow_SDK.OB1_Initialization(self.sourcename, 3, 3, 3, 3, byref(self.instr_ID))
+        err_code = self.sdk.OB1_Initialization(self.sourcename, 3, 3, 3, 3, byref(self.instr_ID))
         # pressure sensors are hard-coded to be the 0-8000 mbar type (type 3)
         if err_code != 0:
             self.errorlogger.warning("Initialization error code %i" % err_code)
 
         self.sensortypes = sensortypes
         for i in range(len(sensortypes)):
-            err_code = Elveflow_SDK.OB1_Add_Sens(self.instr_ID.value, i+1, SensorType=sensortypes[i], DigitalAnalog=0,
-                                                 FSens_Digit_Calib=0, FSens_Digit_Resolution=3)   # TODO: what is the resolution? What does that mean?
+            # arguments are: SensorType, DigitalAnalog, FSens_Digit_Calib, FSens_Digit_Resolution
+            err_code = self.sdk.OB1_Add_Sens(self.instr_ID.value, i+1, sensortypes[i], 0, 0, 3)   # TODO: what is the resolution? What does that mean?
             if err_code != 0:
                 self.errorlogger.warning("sensor addition error code is %d" % self.instr_ID.value)
 
         # TODO: calibrations?
-        err_code = Elveflow_SDK.Elveflow_Calibration_Default(byref(self.calib), 1000)
+        err_code = self.sdk.Elveflow_Calibration_Default(self.calib_ref, 1000)
         if err_code != 0:
             self.errorlogger.warning("Calibration error code %i" % err_code)
         self.errorlogger.debug("Done initializing Elveflow")
 
-        self.header = ["time [s]", "Pressure 1 [mbar]", "Pressure 2 [mbar]", "Pressure 3 [mbar]", "Pressure 4 [mbar]",
-                       "Volume flow rate 1 [µL/min]", "Volume flow rate 2 [µL/min]", "Volume flow rate 3 [µL/min]", "Volume flow rate 4 [µL/min]"]
-        self.buffer_queue = Queue(maxsize=ElveflowHandler_SDK.QUEUE_MAXLEN)
+        self.header = sorted(ELVEFLOW_DATA_COLUMNS, key=ELVEFLOW_DATA_COLUMNS.get)
+        self.buffer = SampleRingBuffer(self.header, capacity=ElveflowHandler_SDK.BUFFER_CAPACITY)
+        self.fetch_cursor = 0  # read cursor used by fetchOne/fetchAll
+        if acquisition_rate is None:
+            acquisition_rate = ElveflowHandler_SDK.ACQUISITION_RATE
+        self.scheduler = DeadlineScheduler(acquisition_rate)
         self.run_flag = threading.Event()
         self.run_flag.set()
+        self.ramp_shape = ElveflowHandler_SDK.RAMP_SHAPE if ramp_shape is None else ramp_shape
+        self.controllers = [None, None, None, None]  # what each channel is doing; only the executor thread touches these
+        self.flow_pid = MultiChannelPID(4)  # the flow loops of all the channels, stepped together by the executor
+        self.commands = queue.Queue()  # (future, function, args) for the executor thread to run
+        self.accepting_commands = False  # whether the executor thread will still run what is submitted
+        self._commands_lock = threading.Lock()
+        self.executor_thread = None
 
     def start(self):
-        def start_thread():
-            print("STARTING HANDLER THREAD %s" % threading.current_thread())
-            while self.run_flag.is_set():
-                data_sens = c_double()
-                get_pressure = c_double()
-
-                time.sleep(ElveflowHandler_SDK.SLEEPTIME)
-
-                newline = {}
-                for i in range(1, 5):
-                    error = Elveflow_SDK.OB1_Get_Press(self.instr_ID.value, c_int32(i), 1, byref(self.calib), byref(get_pressure), 1000)
-                    if error != 0:
-                        # self.errorlogger.warning('ERROR CODE PRESSURE %i: %s' % (i, error))
-                        pass
-                    newline[self.header[i]] = get_pressure.value
-                for i in range(1, 5):
-                    error = Elveflow_SDK.OB1_Get_Sens_Data(self.instr_ID.value, c_int32(i), 1, byref(data_sens))
-                    if error != 0:
-                        self.errorlogger.warning('ERROR CODE FLOW SENSOR %i: %s' % (i, error))
-                    newline[self.header[i+4]] = data_sens.value
-
-                newline[self.header[0]] = time.time()
-
-                try:
-                    self.buffer_queue.put(newline, False)
-                except Queue_Full:
-                    pass
-
-            # Cleanup code:
-            try:
-                self.run_flag.set() # set this back on again to let the pressure loops run
-                def closing_function(i):
-                    if i == 4:
-                        def on_finish():
-                            print("Closing Elveflow connection")
-                            print("Elveflow closing error code (zero means good): %s" % Elveflow_SDK.OB1_Destructor(self.instr_ID.value))
-                            self.run_flag.clear() # turn it off, just in case
-                    else:
-                        def on_finish():
-                            closing_function(i+1)
-
-                    self.set_pressure_loop(i, 0, on_finish=on_finish)
-
-                closing_function(1)
-            except RuntimeError:
-                print("Runtime error detected in IO handler thread %s while trying to close. Ignoring." % threading.current_thread())
-            finally:
-                print("DONE WITH HANDLER THREAD %s" % threading.current_thread())
-
-        self.reading_thread = threading.Thread(target=start_thread)
-        self.reading_thread.start()
+        """start the executor thread, which acquires data and runs the channels' controllers"""
+        self.executor_thread = threading.Thread(target=self._run_executor)
+        self.reading_thread = self.executor_thread
+        self.accepting_commands = True
+        self.executor_thread.start()
 
     def stop(self):
-        """Stops the reading thread."""
+        """Stops the executor thread, after ramping all the pressures down to zero."""
         self.run_flag.clear()
 
-    def fetchOne(self):
-        """retrieve the oldest element from the buffer. Afterwards, the element is no longer in the buffer.
-        If nothing is in there, return None. (You cannot tell the difference between the leftmost element of
-        the buffer holding None and the buffer being empty, but in this class, the former case should never happen)"""
+    def executor_running(self):
+        return self.executor_thread is not None and self.executor_thread.is_alive()
+
+    def submit(self, function, *args):
+        """run function(*args) on the executor thread at its next tick and return a Future of
+        the result. If the executor isn't running, there's no contention: run it right here.
+        While it is shutting down, the Future fails straight away"""
+        future = Future()
+        with self._commands_lock:
+            if self.executor_running() and threading.current_thread() is not self.executor_thread:
+                if self.accepting_commands:
+                    self.commands.put((future, function, args))
+                else:
+                    future.set_exception(RuntimeError("the Elveflow connection is closing"))
+                return future
+        _run_into_future(future, function, args)
+        return future
+
+    def _run_executor(self):
+        print("STARTING HANDLER THREAD %s" % threading.current_thread())
+        newline = np.empty(len(self.header))  # reused for every sample; the buffer copies it
+        self.scheduler.reset()
+        last_tick = time.monotonic() - self.scheduler.period
+        last_report_time = time.monotonic()
+        last_reported_misses = 0
+        last_summary_time, last_summary_cursor = time.monotonic(), self.buffer.cursor
+        shutdown_deadline = None
         try:
-            return self.buffer_queue.get(False)
-        except IndexError:
+            while True:
+                if not self.run_flag.is_set():
+                    if shutdown_deadline is None:
+                        # ramp every channel down to zero, all at once
+                        shutdown_deadline = time.monotonic() + ElveflowHandler_SDK.SHUTDOWN_TIMEOUT
+                        for i in range(1, 5):
+                            if self.sensortypes[i-1] != SDK_SENSOR_TYPES["none"]:
+                                self._install_controller(i, self.pressure_ramp(0))
+                    if all(controller is None for controller in self.controllers):
+                        break
+                    if time.monotonic() > shutdown_deadline:
+                        self.errorlogger.warning("Elveflow pressures did not ramp down within %s s" % ElveflowHandler_SDK.SHUTDOWN_TIMEOUT)
+                        break
+                self.scheduler.wait()
+                now = time.monotonic()
+                dt, last_tick = now - last_tick, now
+
+                self._run_commands()
+                self._acquire(newline)
+                self.buffer.append(newline)
+                self._step_controllers(dt, newline)
+
+                if self.scheduler.missed_deadlines > last_reported_misses and time.monotonic() - last_report_time > ElveflowHandler_SDK.SCHEDULE_REPORT_PERIOD:
+                    stats = self.scheduler.stats()
+                    self.errorlogger.warning("Elveflow acquisition missed %d deadlines at %g Hz (RMS jitter %.1f ms, worst %.1f ms)" % (
+                        stats['missed_deadlines'] - last_reported_misses, stats['rate'], stats['jitter']*1000, stats['max_lateness']*1000))
+                    last_reported_misses = stats['missed_deadlines']
+                    last_report_time = time.monotonic()
+                if self.sdk_stats_period and time.monotonic() - last_summary_time >= self.sdk_stats_period:
+                    self._log_sdk_summary(last_summary_time, last_summary_cursor)
+                    last_summary_time, last_summary_cursor = time.monotonic(), self.buffer.cursor
+        finally:
+            self.run_flag.clear()
+            for i in range(1, 5):
+                if self.controllers[i-1] is not None:
+                    self._finish_controller(i, follow_up=False)
+            with self._commands_lock:
+                # nothing submitted after this would ever be run
+                self.accepting_commands = False
+            self._run_commands()
+            print("Closing Elveflow connection")
+            print("Elveflow closing error code (zero means good): %s" % self._timed('OB1_Destructor', None, self.sdk.OB1_Destructor, self.instr_ID.value))
+            print("DONE WITH HANDLER THREAD %s" % threading.current_thread())
+
+    def _acquire(self, newline):
+        """read every channel into newline, in header order"""
+        time_before = time.time()
+        for i in range(1, 5):
+            error, newline[i] = self._get_press(i)
+            if error != 0:
+                # self.errorlogger.warning('ERROR CODE PRESSURE %i: %s' % (i, error))
+                newline[i] = np.nan
+        for i in range(1, 5):
+            error, newline[i+4] = self._get_sens_data(i)
+            if error != 0:
+                self.errorlogger.warning('ERROR CODE FLOW SENSOR %i: %s' % (i, error))
+                newline[i+4] = np.nan
+        time_after = time.time()
+        newline[0] = (time_before + time_after) / 2
+
+    def _run_commands(self):
+        while True:
+            try:
+                future, function, args = self.commands.get_nowait()
+            except queue.Empty:
+                return
+            if self.run_flag.is_set() or function == self._finish_controller:
+                _run_into_future(future, function, args)
+            else:
+                future.set_exception(RuntimeError("the Elveflow connection is closing"))
+
+    def _step_controllers(self, dt, newline):
+        # all the flow loops at once, from the sample that just went into the buffer
+        for i in np.flatnonzero(~np.isnan(self.flow_pid.update(dt, newline[5:9]))) + 1:
+            self._send_pressure(i, self.flow_pid.output[i-1])
+        for i in range(1, 5):
+            controller = self.controllers[i-1]
+            if controller is None:
+                continue
+            if controller.interrupt_event.is_set():
+                self._finish_controller(i)
+                continue
+            setpoint = controller.step(dt, newline[i], newline[i+4])
+            if setpoint is not None:
+                self._send_pressure(i, setpoint)
+            if controller.finished:
+                self.errorlogger.debug("Channel %i: %s done" % (i, type(controller).__name__))
+                self._finish_controller(i)
+
+    def _send_pressure(self, channel_number, value):
+        error = self._set_press(channel_number, value)
+        if error != 0:
+            self.errorlogger.warning('ERROR CODE SETTING PRESSURE %i: %s' % (channel_number, error))
+
+    def _install_controller(self, channel_number, controller):
+        """executor thread only: make controller run channel_number, replacing whatever was"""
+        if self.controllers[channel_number-1] is not None:
+            self._finish_controller(channel_number, follow_up=False)
+        self.controllers[channel_number-1] = controller
+        return controller
+
+    def _finish_controller(self, channel_number, follow_up=True):
+        """executor thread only: retire the channel's controller, starting its follow-up if asked"""
+        controller = self.controllers[channel_number-1]
+        self.controllers[channel_number-1] = controller.follow_up() if follow_up else None
+        try:
+            if controller.on_finish is not None:
+                controller.on_finish()
+        except Exception:
+            self.errorlogger.exception("error after channel %s finished" % channel_number)
+        controller.finish()
+
+    def start_controller(self, channel_number, controller):
+        """have the executor run controller on channel_number from its next tick. Returns controller"""
+        if not self.executor_running():
+            self.errorlogger.warning("the Elveflow connection isn't running; ignoring command for channel %s" % channel_number)
+            self._abandon_controller(controller)
+            return controller
+
+        def installed(future):
+            if future.exception() is not None:
+                # it never ran (the connection is closing), so nothing else will finish it
+                self.errorlogger.warning("the Elveflow connection is closing; ignoring command for channel %s" % channel_number)
+                self._abandon_controller(controller)
+        self.submit(self._install_controller, channel_number, controller).add_done_callback(installed)
+        return controller
+
+    def _abandon_controller(self, controller):
+        """finish a controller that was never installed, as if it had run"""
+        controller.finish()
+        if controller.on_finish is not None:
+            controller.on_finish()
+
+    def acquisition_stats(self):
+        """return the acquisition scheduler's statistics: rate, ticks, missed deadlines and jitter"""
+        return self.scheduler.stats()
+
+    def sdk_stats(self):
+        """return the SDK call statistics (see CallStats.stats), keyed by (function name, channel)"""
+        return self.call_stats.stats()
+
+    def _log_sdk_summary(self, since, since_cursor):
+        elapsed = time.monotonic() - since
+        stats = self.scheduler.stats()
+        lines = ["Elveflow: %.2f samples/s over the last %.0f s (asked for %g); %d missed deadlines in all" % (
+            (self.buffer.cursor - since_cursor) / elapsed, elapsed, stats['rate'], stats['missed_deadlines'])]
+        self.errorlogger.debug('\n    '.join(lines + self.call_stats.summary_lines()))
+
+    def _timed(self, name, channel_number, function, *args):
+        """call function(*args), recording how long it took and the error code it returned"""
+        start = time.perf_counter()
+        error = function(*args)
+        self.call_stats.record(name, channel_number, time.perf_counter() - start, error)
+        return error
+
+    def read_since(self, cursor):
+        """return (new_cursor, block): every sample taken since `cursor` as a
+        (number of columns) x (number of samples) array, columns in header order.
+        Start with a cursor of 0. Each consumer keeps its own cursor, so this never
+        interferes with other readers or with fetchOne/fetchAll."""
+        return self.buffer.read_since(cursor)
+
+    def current_cursor(self):
+        """return the cursor to start from to read only samples taken from now on"""
+        return self.buffer.cursor
+
+    def fetchOne(self):
+        """retrieve the oldest unfetched sample as a dict. Afterwards, fetchOne/fetchAll won't return it again.
+        If nothing is in there, return None."""
+        if self.fetch_cursor >= self.buffer.cursor:
             return None
+        self.fetch_cursor, block = self.buffer.read_since(self.fetch_cursor)
+        self.fetch_cursor -= block.shape[1] - 1  # only consume the first row
+        return self.buffer.rows_as_dicts(block[:, :1])[0]
 
     def peekOne(self):
-        """looks at the oldest element from the buffer, but does NOT remove it from the buffer.
-        If nothing is in there, return None. (You cannot tell the difference between the leftmost element of
-        the buffer holding None and the buffer being empty, but in this class, the former case should never happen).
-
-        NOTE that depending on your use-case, you may wish to call this function while holding the mutex"""
-        try:
-            return self.buffer_queue.queue[0]
-        except IndexError:
+        """looks at the oldest unfetched sample, but does NOT consume it. If nothing is in there, return None."""
+        _, block = self.buffer.read_since(self.fetch_cursor)
+        if block.shape[1] == 0:
             return None
+        return self.buffer.rows_as_dicts(block[:, :1])[0]
 
     def fetchAll(self):
-        """retrieve all elements from the buffer as a list. Afterwards, all elements returned are no longer in the buffer.
-        In this class, the elements of the buffer are all dicts whose keys are the entries of the header"""
-        def generateElements():
-            try:
-                while True:
-                    yield self.buffer_queue.get(False)
-            except Queue_Empty:
-                return
-        return [elt for elt in generateElements()]
+        """retrieve all unfetched samples as a list. Afterwards, fetchOne/fetchAll won't return them again.
+        In this class, the elements of the list are all dicts whose keys are the entries of the header.
+        Prefer read_since, which skips building a dict for every sample."""
+        self.fetch_cursor, block = self.buffer.read_since(self.fetch_cursor)
+        return self.buffer.rows_as_dicts(block)
 
     def getHeader(self):
         """returns the header, a list of strings"""
         return self.header
 
+    def _outparams(self):
+        """the out-parameters for the calling thread, created the first time that thread needs them"""
+        out = self.out_params
+        if not hasattr(out, 'value'):
+            out.value = c_double()
+            out.value_ref = byref(out.value)
+        return out
+
+    def _get_press(self, channel_number):
+        """read one channel's pressure. Returns (error code, pressure in mbar)"""
+        out = self._outparams()
+        error = self._timed('OB1_Get_Press', channel_number, self.sdk.OB1_Get_Press,
+                            self.instr_ID.value, channel_number, 1, self.calib_ref, out.value_ref, 1000)
+        return error, out.value.value
+
+    def _get_sens_data(self, channel_number):
+        """read one channel's flow sensor. Returns (error code, flow rate in µL/min)"""
+        out = self._outparams()
+        error = self._timed('OB1_Get_Sens_Data', channel_number, self.sdk.OB1_Get_Sens_Data,
+                            self.instr_ID.value, channel_number, 1, out.value_ref)
+        return error, out.value.value
+
+    def _set_press(self, channel_number, value):
+        """command one channel's pressure. Returns the error code"""
+        return self._timed('OB1_Set_Press', channel_number, self.sdk.OB1_Set_Press,
+                           self.instr_ID.value, channel_number, value, self.calib_ref, 1000)
+
     def setPressure(self, channel_number=4, value=300):
         """tells the Elveflow to set the pressure directly"""
-        error = Elveflow_SDK.OB1_Set_Press(self.instr_ID.value, channel_number, value, byref(self.calib), 1000)
+        error = self.submit(self._set_press, channel_number, value).result()
         self.errorlogger.info('Set pressure of Channel %i to %s' % (channel_number, value))
         if error != 0:
             self.errorlogger.warning('ERROR CODE SET PRESSURE CHANNEL %i: %s' % (channel_number, error))
 
     def getPressure(self, channel_number=4):
-        """ask the Elveflow to tell us the pressure directly"""
-        get_pressure = c_double()
-        error = Elveflow_SDK.OB1_Get_Press(self.instr_ID.value, c_int32(channel_number), 1, byref(self.calib), byref(get_pressure), 1000)
+        """the pressure of channel_number: the latest sample if we're acquiring, otherwise ask the Elveflow directly"""
+        if self.executor_running():
+            return self._latest(ELVEFLOW_DATA_COLUMNS['Pressure 1 [mbar]'] + channel_number - 1)
+        error, pressure = self._get_press(channel_number)
         if error != 0:
             # self.errorlogger.warning('ERROR CODE PRESSURE %i: %s' % (channel_number, error))
             pass
-        return get_pressure.value
+        return pressure
 
     def getVolume(self, channel_number=4):
-        """ask the Elveflow to tell us the volume sensor reading directly"""
-        get_flowrate = c_double()
-        error = Elveflow_SDK.OB1_Get_Sens_Data(self.instr_ID.value, c_int32(channel_number), 1, byref(get_flowrate))
+        """the flow rate of channel_number: the latest sample if we're acquiring, otherwise ask the Elveflow directly"""
+        if self.executor_running():
+            return self._latest(ELVEFLOW_DATA_COLUMNS['Volume flow rate 1 [µL/min]'] + channel_number - 1)
+        error, flowrate = self._get_sens_data(channel_number)
 
         if error != 0:
             # self.errorlogger.warning('ERROR CODE VOLUME %i: %s' % (channel_number, error))
             pass
-        return get_flowrate.value
-
-    def set_pressure_loop(self, channel_number, value, interrupt_event=None, on_finish=None):
-        """starts a thread that raises the Elveflow pressure without a big spike"""
-        if interrupt_event is None:
-            # if there isn't one already, create a dummy one
-            interrupt_event = threading.Event()
-            interrupt_event.clear()
-        def start_thread(channel_number, target, interrupt_event):
-            if self.sensortypes[channel_number-1] == SDK_SENSOR_TYPES["none"]:
-                self.errorlogger.info("Channel %s is set to \"none\" (%s); ignoring command to set pressure to %s." % (channel_number, self.sensortypes[channel_number-1], target))
-            else:
-                self.errorlogger.debug("Channel %s: starting to set pressure to %s THREAD %s." % (channel_number, target, threading.current_thread()))
-                if target > 8000:
-                    target = 8000
-                if target < 0:
-                    target = 0
-
-                get_pressure = c_double()
-                error = Elveflow_SDK.OB1_Get_Press(self.instr_ID.value, c_int32(channel_number), 1, byref(self.calib), byref(get_pressure), 1000)
-                if error != 0:
-                    self.errorlogger.warning('ERROR CODE GETTING PRESSURE %i: %s' % (channel_number, error))
-                    if on_finish is not None:
-                        on_finish()
-                    return
-
-                curr_pressure = get_pressure.value
-
-                while self.run_flag.is_set() and not interrupt_event.is_set():
-                    # if we have an error reading, don't try to set anything
-                    # self.errorlogger.debug('max slope is %s' % ElveflowHandler_SDK.PRESSURE_MAXSLOPE)
-                    # self.errorlogger.debug('requested slope is %s, and max slope is %s' % (abs(target - curr_pressure)))
-                    if abs(target - curr_pressure) <= ElveflowHandler_SDK.PRESSURE_MAXSLOPE:
-                        # if we're close, just set it and hope for the best
-                        curr_pressure = target
-                        interrupt_event.set()
-                        self.errorlogger.info("Channel %i pressure now set to %s" % (channel_number, curr_pressure))
-                    else:
-                        # otherwise, just make one PRESSURE_MAXSLOPE-sized step in the correct direction
-                        curr_pressure = curr_pressure + math.copysign(ElveflowHandler_SDK.PRESSURE_MAXSLOPE, target - curr_pressure)
-
-                    error = Elveflow_SDK.OB1_Set_Press(self.instr_ID.value, channel_number, curr_pressure, byref(self.calib), 1000)
-                    if error != 0:
-                        self.errorlogger.warning('ERROR CODE SETTING PRESSURE %i: %s' % (channel_number, error))
-                    # self.errorlogger.debug("setting pressure to %s", curr_pressure)
-
-                    time.sleep(ElveflowHandler_SDK.SLEEPTIME)
-
-                self.errorlogger.debug("Channel %s: finished setting pressure THREAD %s." % (channel_number, threading.current_thread()))
-
-            try:
-                if on_finish is not None:
-                    on_finish()
-            except RuntimeError:
-                print("Runtime error detected in pressure loop channel %s thread %s while trying to close. Ignoring." % (channel_number, threading.current_thread()))
-
-        self.command_thread = threading.Thread(target=start_thread, args=(channel_number, value, interrupt_event))
-        self.command_thread.start()
-        return self.command_thread
+        return flowrate
+
+    def _latest(self, column):
+        row = self.buffer.latest()
+        return math.nan if row is None else row[column]
+
+    def pressure_ramp(self, value, shape=None, interrupt_event=None, on_finish=None):
+        """a PressureRamp to value, of the given shape (by default, self.ramp_shape)"""
+        return PressureRamp(value, ElveflowHandler_SDK.PRESSURE_RAMP_RATE, shape=self.ramp_shape if shape is None else shape,
+                            acceleration=ElveflowHandler_SDK.PRESSURE_RAMP_ACCELERATION,
+                            time_constant=ElveflowHandler_SDK.PRESSURE_RAMP_TIME_CONSTANT,
+                            interrupt_event=interrupt_event, on_finish=on_finish)
+
+    def set_pressure_loop(self, channel_number, value, interrupt_event=None, on_finish=None, shape=None):
+        """ramps the Elveflow pressure to value without a big spike. Returns the ramp controller,
+        which can be join()ed, retargeted, cancelled and asked when it will be done"""
+        ramp = self.pressure_ramp(value, shape=shape, interrupt_event=interrupt_event, on_finish=on_finish)
+        if self.sensortypes[channel_number-1] == SDK_SENSOR_TYPES["none"]:
+            self.errorlogger.info("Channel %s is set to \"none\" (%s); ignoring command to set pressure to %s." % (channel_number, self.sensortypes[channel_number-1], value))
+            ramp.finish()
+            if on_finish is not None:
+                on_finish()
+            return ramp
+        self.errorlogger.debug("Channel %s: starting to set pressure to %s." % (channel_number, ramp.target))
+        return self.start_controller(channel_number, ramp)
+
+    def retarget_pressure(self, channel_number, value):
+        """send channel_number's pressure to value instead: the ramp it is on, if any, carries on
+        from where it is to the new value. Returns the ramp"""
+        def retarget():
+            controller = self.controllers[channel_number-1]
+            if isinstance(controller, PressureRamp) and not controller.is_done():
+                controller.retarget(value)
+                return controller
+            return self._install_controller(channel_number, self.pressure_ramp(value))
+        if not self.executor_running() or self.sensortypes[channel_number-1] == SDK_SENSOR_TYPES["none"]:
+            return self.set_pressure_loop(channel_number, value)
+        return self.submit(retarget).result()
 
     def set_volume_loop(self, channel_number, value, interrupt_event=None, pid_constants=None):
-        """starts a thread that sets the Elveflow flow rate"""
-        if interrupt_event is None:
-            # if there isn't one already, create a dummy one
-            interrupt_event = threading.Event()
-            interrupt_event.clear()
+        """holds the Elveflow flow rate at value until interrupt_event is set, then ramps the pressure
+        down to zero. Returns the controller"""
         if pid_constants is None:
             pid_constants = (ElveflowHandler_SDK.VOLUME_KP, ElveflowHandler_SDK.VOLUME_KI, ElveflowHandler_SDK.VOLUME_KD)
-
-        def start_thread(channel_number, target, interrupt_event, pid_constants):
-            self.errorlogger.debug("STARTING PRESSURE LOOP CHANNEL %s THREAD %s." % (channel_number, threading.current_thread()))
-            pid = PID(*pid_constants, setpoint=target)
-            initial_pressure = c_double()
-            error = Elveflow_SDK.OB1_Get_Press(self.instr_ID.value, c_int32(channel_number), 1, byref(self.calib), byref(initial_pressure), 1000)
-            if error != 0:
-                self.errorlogger.warning('ERROR CODE GETTING PRESSURE %i: %s' % (channel_number, error))
-            # self.errorlogger.debug("INITIAL PRESSURE IS %f" % initial_pressure.value)
-
-            while self.run_flag.is_set() and not interrupt_event.is_set():
-                time.sleep(ElveflowHandler_SDK.PID_SLEEPTIME)
-                get_flowrate = c_double()
-                error = Elveflow_SDK.OB1_Get_Sens_Data(self.instr_ID.value, c_int32(channel_number), 1, byref(get_flowrate))
-                if error != 0:
-                    self.errorlogger.warning('ERROR CODE GETTING FLOW RATE %i: %s' % (channel_number, error))
-                else:
-                    # if we have an error reading, don't try to set anything
-                    pressure_to_set = pid(get_flowrate.value) + initial_pressure.value
-
-                    if pressure_to_set > 8000:
-                        pressure_to_set = 8000
-                    elif pressure_to_set < 0:
-                        pressure_to_set = 0
-
-                    error = Elveflow_SDK.OB1_Set_Press(self.instr_ID.value, channel_number, pressure_to_set, byref(self.calib), 1000)
-                    if error != 0:
-                        self.errorlogger.warning('ERROR CODE SETTING PRESSURE %i: %s' % (channel_number, error))
-                    # self.errorlogger.debug(pressure_to_set)
-                    # self.errorlogger.debug(pid.components)
-
-            try:
-                self.errorlogger.debug("DONE WITH FLOW RATE LOOP CHANNEL %s THREAD %s; setting pressure to zero." % (channel_number, threading.current_thread()))
-                a = self.set_pressure_loop(channel_number, 0)
-                a.join()
-                self.errorlogger.debug("ENDING FLOW RATE LOOP CHANNEL %s THREAD %s." % (channel_number, threading.current_thread()))
-            except RuntimeError:
-                print("Runtime error detected in flow rate loop channel %s thread %s while trying to close. Ignoring." % (channel_number, threading.current_thread()))
-
-        self.reading_thread = threading.Thread(target=start_thread, args=(channel_number, value, interrupt_event, pid_constants))
-        self.reading_thread.start()
+        self.errorlogger.debug("STARTING FLOW RATE LOOP CHANNEL %s." % channel_number)
+        return self.start_controller(channel_number, FlowPID(value, pid_constants, self.flow_pid, channel_number-1, then_ramp_to=0,
+                                                             make_ramp=self.pressure_ramp, interrupt_event=interrupt_event))
 
     def run_volume(self, channel_number, value, interrupt_event=None, pid_constants=None, margin=0.5, stable_time=0.5, timeout=60):
         """in the calling thread (i.e. this function is blocking), set the Elveflow flow rate
         Run a volume PID loop until you are within +/- margin of the target value
         for at least stable_time amout of seconds OR until timeout amount of seconds has passed
 
-        Return the last pressure reading"""
-        if interrupt_event is None:
-            # if there isn't one already, create a dummy one
-            interrupt_event = threading.Event()
-            interrupt_event.clear()
+        Return the last pressure set"""
         if pid_constants is None:
             pid_constants = (ElveflowHandler_SDK.VOLUME_KP, ElveflowHandler_SDK.VOLUME_KI, ElveflowHandler_SDK.VOLUME_KD)
 
         self.errorlogger.debug("STARTING PRESSURE LOOP CHANNEL %s THREAD %s." % (channel_number, threading.current_thread()))
-        pid = PID(*pid_constants, setpoint=value)
-        initial_pressure = c_double()
-        error = Elveflow_SDK.OB1_Get_Press(self.instr_ID.value, c_int32(channel_number), 1, byref(self.calib), byref(initial_pressure), 1000)
-        if error != 0:
-            self.errorlogger.warning('ERROR CODE GETTING PRESSURE %i: %s' % (channel_number, error))
-        # self.errorlogger.debug("INITIAL PRESSURE IS %f" % initial_pressure.value)
-
-        pressure_to_set = value
-        amount_of_time_stable = 0
-        init_time = time.time()
-        while self.run_flag.is_set() and not interrupt_event.is_set():
-            if time.time() - init_time > timeout:
-                break
-            time.sleep(ElveflowHandler_SDK.PID_SLEEPTIME)
-            get_flowrate = c_double()
-            error = Elveflow_SDK.OB1_Get_Sens_Data(self.instr_ID.value, c_int32(channel_number), 1, byref(get_flowrate))
-            if error != 0:
-                self.errorlogger.warning('ERROR CODE GETTING FLOW RATE %i: %s' % (channel_number, error))
-                # if we have an error reading, don't try to set anything
-            else:
-                if get_flowrate.value > (value - margin) and get_flowrate.value < (value + margin):
-                    #we've reached the end! Just quit.
-                    amount_of_time_stable += ElveflowHandler_SDK.PID_SLEEPTIME
-                    if amount_of_time_stable > stable_time:
-                        break
-                else:
-                    # We're no longer in the final range. Reset counter
-                    amount_of_time_stable = 0
-
+        controller = self.start_controller(channel_number, FlowPID(value, pid_constants, self.flow_pid, channel_number-1, margin=margin,
+                                                                   stable_time=stable_time, timeout=timeout, interrupt_event=interrupt_event))
+        if not controller.join(timeout + ElveflowHandler_SDK.SHUTDOWN_TIMEOUT):
+            self.errorlogger.warning("Channel %s: the flow rate loop didn't finish within %s s" % (channel_number, timeout))
+        return value if controller.last_setpoint is None else controller.last_setpoint
 
-                pressure_to_set = pid(get_flowrate.value) + initial_pressure.value
 
-                if pressure_to_set > 8000:
-                    pressure_to_set = 8000
-                elif pressure_to_set < 0:
-                    pressure_to_set = 0
-
-                error = Elveflow_SDK.OB1_Set_Press(self.instr_ID.value, channel_number, pressure_to_set, byref(self.calib), 1000)
-                if error != 0:
-                    self.errorlogger.warning('ERROR CODE SETTING PRESSURE %i: %s' % (channel_number, error))
-
-        return pressure_to_set
+def _run_into_future(future, function, args):
+    try:
+        future.set_result(function(*args))
+    except Exception as e:
+        future.set_exception(e)
 
 
 if USE_SDK:
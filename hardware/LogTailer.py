@@ -0,0 +1,102 @@
+"""Follow a growing text log (like `tail -f`), a whole block at a time.
+
+LogTailer hands back complete lines only: a partially written last line is held back
+until its newline arrives. If the file shrinks (it was truncated) or the path now points
+at a different file (it was rotated), the tailer starts again from the beginning of the
+new file and says so, so the caller can expect a fresh header.
+"""
+import os
+import numpy as np
+
+
+class LogTailer:
+    """Read complete lines appended to the file at `path`."""
+    BLOCK_SIZE = 1 << 16  # bytes per read
+    MAX_BLOCKS_PER_CALL = 64  # so that a big backlog is handed over a few MB at a time
+
+    def __init__(self, path, encoding="latin-1"):
+        self.path = path
+        self.encoding = encoding
+        self.file = None
+        self.offset = 0  # file position of the first byte not yet returned as part of a line
+        self.partial = b''
+
+    def open(self):
+        # append mode creates the file if it doesn't exist yet, without touching it otherwise
+        open(self.path, 'ab').close()
+        self.file = open(self.path, 'rb')
+        self.offset = 0
+        self.partial = b''
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def read_lines(self):
+        """return (was_reset, lines). lines is every complete line written since the last call
+        (without line endings); it is empty when there is nothing new. was_reset is True if
+        the file was truncated or replaced, in which case lines start from its beginning."""
+        was_reset = False
+        if self.file is None:
+            self.open()
+        elif self._was_replaced_or_truncated():
+            self.close()
+            self.open()
+            was_reset = True
+
+        self.file.seek(self.offset + len(self.partial))
+        chunks = [self.partial]
+        for _ in range(LogTailer.MAX_BLOCKS_PER_CALL):
+            chunk = self.file.read(LogTailer.BLOCK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        data = b''.join(chunks)
+
+        end = data.rfind(b'\n') + 1
+        self.partial = data[end:]
+        self.offset += end
+        if end == 0:
+            return was_reset, []
+        text = data[:end].decode(self.encoding)
+        return was_reset, [line.rstrip('\r') for line in text.split('\n')[:-1]]
+
+    def _was_replaced_or_truncated(self):
+        try:
+            on_disk = os.stat(self.path)
+        except FileNotFoundError:
+            # rotated away and not recreated yet: keep reading what we have open
+            return False
+        ours = os.fstat(self.file.fileno())
+        if (on_disk.st_ino, on_disk.st_dev) != (ours.st_ino, ours.st_dev):
+            return True
+        return on_disk.st_size < self.offset + len(self.partial)
+
+
+def parse_delimited_block(lines, n_columns, delimiter='\t'):
+    """parse many delimited lines of numbers at once.
+
+    Returns (block, n_rejected): block is an (n_columns) x (number of good lines) float64
+    array. Empty or non-numeric fields become NaN. Blank lines are skipped, and lines with
+    the wrong number of fields are counted in n_rejected and dropped."""
+    rows = [line.split(delimiter) for line in lines if line.strip()]
+    good_rows = [row for row in rows if len(row) == n_columns]
+    n_rejected = len(rows) - len(good_rows)
+    if not good_rows:
+        return np.empty((n_columns, 0)), n_rejected
+    fields = np.array(good_rows)
+    fields[np.char.strip(fields) == ''] = 'nan'
+    try:
+        block = fields.astype(np.float64)
+    except ValueError:
+        # at least one field isn't a number; only now pay for checking them one by one
+        block = np.array([[_float_or_nan(x) for x in row] for row in fields])
+    return block.T, n_rejected
+
+
+def _float_or_nan(string):
+    try:
+        return float(string)
+    except ValueError:
+        return float('nan')
@@ -0,0 +1,155 @@
+"""What the pumps are doing, kept up to date in one place.
+
+Every HPump has a PumpState: whether it is running and which way, its rates, target volume
+and delivered volume. A PumpMonitor polls all the pumps at a fixed rate on the serial I/O
+loop (the pumps on a chain are asked at the same time) and updates their states, so code
+waiting for a pump to stop, or to deliver some volume, waits on the state instead of each
+asking the pump over and over.
+
+While a pump is delivering towards a target volume, its state predicts when it will get
+there from the delivered volume and the rate, and the monitor only checks on it every
+PREDICTED_POLL_PERIOD seconds until PREDICTION_LEAD seconds before then, when it goes back
+to polling at the full rate to catch the pump stopping.
+"""
+import asyncio
+import logging
+import math
+import threading
+import time
+
+from .SerialTransport import io_loop
+
+
+class PumpState:
+    """What is known of a pump. Values are None until known.
+
+    Commands sent to the pump update the state straight away (command); readings from polls
+    (observe) are dropped if a command was sent while they were being made, as they may be
+    from before it."""
+
+    def __init__(self):
+        self.running = None
+        self.infusing = None
+        self.infuse_rate = None
+        self.refill_rate = None
+        self.target_volume = None
+        self.delivered_volume = None
+        self.delivered_at = None  # monotonic time delivered_volume was read
+        self.updated_at = None  # monotonic time of the last command or reading
+        self.polled_at = -math.inf  # monotonic time of the last reading from a PumpMonitor
+        self.max_age = 0  # seconds a PumpMonitor's reading stays good for; 0 if none is running
+        self.generation = 0  # counts commands
+        self.changed = threading.Condition()
+
+    def _set(self, values):
+        self.updated_at = time.monotonic()
+        for name, value in values.items():
+            setattr(self, name, value)
+        if 'delivered_volume' in values:
+            self.delivered_at = self.updated_at
+        self.changed.notify_all()
+
+    def command(self, **values):
+        """record values the pump has just been told to take (None for unknown)"""
+        with self.changed:
+            self.generation += 1
+            self._set(values)
+
+    def observe(self, generation, polled=False, **values):
+        """record values read from the pump (None for unreadable ones, which are left as they
+        were), if no command has been sent since generation. Returns whether they were recorded"""
+        with self.changed:
+            if generation != self.generation:
+                return False
+            self._set({name: value for name, value in values.items() if value is not None})
+            if polled:
+                self.polled_at = self.updated_at
+            return True
+
+    def fresh(self):
+        """whether a PumpMonitor is keeping the state up to date"""
+        return time.monotonic() - self.polled_at <= self.max_age
+
+    def expected_completion(self):
+        """the monotonic time the pump should reach its target volume at its current rate (in
+        µL/min), or None if it isn't running towards one or there's no reading since it started"""
+        with self.changed:
+            rate = self.infuse_rate if self.infusing else self.refill_rate
+            if not self.running or not rate or self.target_volume is None or self.delivered_volume is None:
+                return None
+            return self.delivered_at + max(self.target_volume - self.delivered_volume, 0) / (rate / 60000)
+
+    def time_remaining(self):
+        """seconds until expected_completion, or None"""
+        completion = self.expected_completion()
+        return None if completion is None else max(completion - time.monotonic(), 0)
+
+    def wait_for(self, predicate, timeout):
+        """wait until predicate(state) is true, for up to timeout seconds; returns whether it is"""
+        with self.changed:
+            return self.changed.wait_for(lambda: predicate(self), timeout)
+
+
+class PumpMonitor:
+    """Polls pumps and keeps their states up to date, from the serial I/O loop."""
+    POLL_RATE = 5  # polls per second; set pump_poll_rate in the [Instruments] config to change it
+    FULL_REFRESH_PERIOD = 10  # seconds between reads of the rates, direction and target volume too
+    PREDICTED_POLL_PERIOD = 10  # seconds between polls of a pump whose completion is predicted
+    PREDICTION_LEAD = 1  # seconds before a predicted completion to start polling at the full rate
+
+    def __init__(self, pumps=(), poll_rate=POLL_RATE, errorlogger=None):
+        self.pumps = list(pumps)
+        self.poll_rate = poll_rate
+        self.errorlogger = errorlogger if errorlogger is not None else logging.getLogger('python')
+        self.future = None
+        self._errors = {}  # pump name -> the last error logged, so it is logged once
+        self._next_poll = {}  # pump -> (its state's generation, monotonic time it's next due a poll)
+
+    def set_pumps(self, pumps):
+        for pump in self.pumps:
+            pump.state.max_age = 0
+        self.pumps = list(pumps)
+
+    def start(self):
+        if self.future is None or self.future.done():
+            self.future = asyncio.run_coroutine_threadsafe(self._poll_forever(), io_loop())
+
+    def stop(self):
+        if self.future is not None:
+            self.future.cancel()
+        for pump in self.pumps:
+            pump.state.max_age = 0
+
+    def _schedule(self, pump, now, period):
+        """work out when pump is next due a poll, from its predicted completion if it has one"""
+        next_poll = now + period
+        completion = pump.state.expected_completion()
+        if completion is not None and completion - PumpMonitor.PREDICTION_LEAD > next_poll:
+            next_poll = min(completion - PumpMonitor.PREDICTION_LEAD, now + PumpMonitor.PREDICTED_POLL_PERIOD)
+        self._next_poll[pump] = (pump.state.generation, next_poll)
+        # readings older than this mean the polls have stopped getting through
+        pump.state.max_age = next_poll - now + 2 * period + pump.RESPONSE_TIMEOUT
+
+    async def _poll_forever(self):
+        last_full_refresh = -math.inf
+        while True:
+            start = time.monotonic()
+            period = 1 / self.poll_rate
+            full = start - last_full_refresh >= PumpMonitor.FULL_REFRESH_PERIOD
+            pumps = [pump for pump in self.pumps if pump.enabled]
+            # a command (like starting the pump) makes a pump due straight away
+            due = [pump for pump in pumps if self._next_poll.get(pump, (None, -math.inf))[1] <= start
+                   or self._next_poll[pump][0] != pump.state.generation]
+            for pump in due:
+                pump.state.max_age = max(pump.state.max_age, 2 * period + pump.RESPONSE_TIMEOUT)
+            results = await asyncio.gather(*(pump.async_refresh(full, polled=True) for pump in due), return_exceptions=True)
+            now = time.monotonic()
+            for pump, result in zip(due, results):
+                error = repr(result) if isinstance(result, Exception) else None
+                if error is not None and self._errors.get(pump.name) != error:
+                    self.errorlogger.warning("Couldn't poll %s: %s" % (pump.name, error))
+                self._errors[pump.name] = error
+                self._schedule(pump, now, period)
+            if full:
+                last_full_refresh = start
+            await asyncio.sleep(max(start + period - time.monotonic(), 0))
@@ -0,0 +1,74 @@
+"""Fixed-rate scheduling on the monotonic clock.
+
+Sleeping for a fixed time after doing some work makes the real period "sleep time plus
+work time", and the error piles up. DeadlineScheduler instead keeps an absolute schedule
+of deadlines (start + n * period) and sleeps only until the next one, so work time does not
+accumulate into drift. It also keeps track of how late each tick was and how many ticks
+were missed entirely.
+"""
+import time
+import math
+
+
+class DeadlineScheduler:
+    """Wake up at evenly spaced deadlines, `rate` times per second."""
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        if not rate > 0:
+            raise ValueError("rate must be positive, not %s" % rate)
+        self.rate = float(rate)
+        self.period = 1 / self.rate
+        self.clock = clock
+        self.sleep = sleep
+        self.reset()
+
+    def reset(self):
+        """restart the schedule (and the statistics) from now"""
+        self.next_deadline = self.clock() + self.period
+        self.ticks = 0
+        self.missed_deadlines = 0
+        self.max_lateness = 0.0
+        self._lateness_sum = 0.0
+        self._lateness_sum_sq = 0.0
+
+    def wait(self):
+        """sleep until the next deadline and return how late we woke up, in seconds.
+
+        If we are already more than a whole period past the deadline, the deadlines we
+        blew through are counted as missed and skipped, so we don't try to catch up with
+        a burst of back-to-back ticks."""
+        now = self.clock()
+        remaining = self.next_deadline - now
+        if remaining > 0:
+            self.sleep(remaining)
+            now = self.clock()
+        lateness = now - self.next_deadline
+        if lateness >= self.period:
+            skipped = int(math.floor(lateness / self.period))
+            self.missed_deadlines += skipped
+            self.next_deadline += skipped * self.period
+            lateness -= skipped * self.period
+        self.next_deadline += self.period
+
+        self.ticks += 1
+        self._lateness_sum += lateness
+        self._lateness_sum_sq += lateness * lateness
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+        return lateness
+
+    def stats(self):
+        """return a dict summarizing the schedule so far. Jitter is the RMS lateness, in seconds."""
+        if self.ticks == 0:
+            mean = jitter = 0.0
+        else:
+            mean = self._lateness_sum / self.ticks
+            jitter = math.sqrt(self._lateness_sum_sq / self.ticks)
+        return {
+            'rate': self.rate,
+            'ticks': self.ticks,
+            'missed_deadlines': self.missed_deadlines,
+            'mean_lateness': mean,
+            'jitter': jitter,
+            'max_lateness': self.max_lateness,
+        }
@@ -0,0 +1,204 @@
+"""Rolling statistics of a stream of samples, for telling when a flow has settled.
+
+RollingStatistics follows a handler's samples (anything with read_since, like the Elveflow
+handlers) on a thread of its own and can say, for any column and any time window up to
+`history` seconds, what the mean, standard deviation, slope, minimum and maximum were over
+the most recent window. Mean, standard deviation and slope come from running (prefix) sums,
+so they cost the same however long the window is; the minimum and maximum are one
+vectorized pass over the window.
+
+wait_until_stable blocks until a column has stayed within a tolerance for a whole window,
+which lets a sequence go on as soon as a flow has actually settled, instead of after a fixed
+worst-case time.
+"""
+import logging
+import math
+import threading
+import time
+import numpy as np
+
+# the running sums kept for each column: count, t, t^2, x, x^2 and t*x
+_N, _T, _TT, _X, _XX, _TX = range(6)
+
+
+class RollingStatistics:
+    """Rolling statistics of every column of `source`, over windows of up to `history` seconds.
+
+    Times come from the first column whose name starts with "time" (like the Elveflow's
+    "time [s]"), or from the clock when the samples arrive if there is no such column. NaNs
+    (failed readings) are left out of the statistics."""
+    POLL_PERIOD = 0.1  # seconds between looks at the source
+    HISTORY = 300  # seconds of samples kept by default
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self, source=None, history=HISTORY, errorlogger=None, initial_capacity=INITIAL_CAPACITY):
+        self.source = source
+        self.history = history
+        self.errorlogger = errorlogger if errorlogger is not None else logging.getLogger('python')
+        self.columns = None
+        self.column_index = {}
+        self.time_column = None
+        self._capacity = max(2, int(initial_capacity))
+        self._times = None
+        self._values = None
+        self._sums = None
+        self._end = 0  # rows [0, _end) are kept
+        self._t_ref = 0.0  # times are offset by this in the sums, so they stay small and precise
+        self._changed = threading.Condition()
+        self._stop_event = threading.Event()
+        self.cursor = 0
+        self.thread = None
+
+    def start(self):
+        """start following the source, from its next sample"""
+        self.cursor = self.source.current_cursor()
+        self.thread = threading.Thread(target=self._run, name='RollingStatistics')
+        self.thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        try:
+            while not self._stop_event.is_set():
+                self.cursor, block = self.source.read_since(self.cursor)
+                if block.shape[1] > 0:
+                    if self.columns is None:
+                        self.set_columns(self.source.getHeader())
+                    self.extend(block)
+                self._stop_event.wait(RollingStatistics.POLL_PERIOD)
+        except Exception:
+            self.errorlogger.exception("error while keeping statistics of the Elveflow data")
+
+    def set_columns(self, columns):
+        """say what the columns are called; done from the source's header if there is a source"""
+        with self._changed:
+            self.columns = list(columns)
+            self.column_index = {name: i for i, name in enumerate(self.columns)}
+            time_columns = [i for i, name in enumerate(self.columns) if name.strip().lower().startswith('time')]
+            self.time_column = time_columns[0] if time_columns else None
+            self._times = np.empty(self._capacity)
+            self._values = np.empty((len(self.columns), self._capacity))
+            self._sums = np.zeros((6, len(self.columns), self._capacity + 1))
+            self._end = 0
+
+    def extend(self, block):
+        """add a (number of columns) x (number of rows) block of new samples"""
+        block = np.asarray(block, dtype=np.float64)
+        n = block.shape[1]
+        if n == 0:
+            return
+        if self.time_column is not None:
+            times = block[self.time_column]
+        else:
+            times = np.full(n, time.time())
+        with self._changed:
+            if self._end + n > self._capacity:
+                self._compact(times[-1], n)
+            if self._end == 0:
+                self._t_ref = times[0]
+                self._sums[:, :, self._end] = 0
+            self._times[self._end:self._end+n] = times
+            self._values[:, self._end:self._end+n] = block
+            self._sums[:, :, self._end+1:self._end+n+1] = \
+                self._sums[:, :, self._end, None] + np.cumsum(self._terms(times, block), axis=-1)
+            self._end += n
+            self._changed.notify_all()
+
+    def _terms(self, times, values):
+        """what each sample adds to each running sum: a 6 x (number of columns) x (number of samples) array"""
+        t = np.broadcast_to(times - self._t_ref, values.shape)
+        valid = ~np.isnan(values) & ~np.isnan(t)
+        t = np.where(valid, t, 0.0)
+        x = np.where(valid, values, 0.0)
+        return np.array([valid, t, t*t, x, x*x, t*x], dtype=np.float64)
+
+    def _compact(self, latest_time, n):
+        """drop samples more than history seconds older than latest_time, make room for n more
+        samples, and recompute the sums relative to the oldest kept time"""
+        first = int(np.searchsorted(self._times[:self._end], latest_time - self.history, side='left'))
+        m = self._end - first
+        capacity = self._capacity
+        while 2 * (m + n) > capacity:
+            capacity *= 2
+        times, values = self._times[first:self._end].copy(), self._values[:, first:self._end].copy()
+        self._capacity = capacity
+        self._times = np.empty(capacity)
+        self._values = np.empty((values.shape[0], capacity))
+        self._sums = np.zeros((6, values.shape[0], capacity + 1))
+        self._times[:m] = times
+        self._values[:, :m] = values
+        self._end = m
+        if m > 0:
+            self._t_ref = times[0]
+            self._sums[:, :, 1:m+1] = np.cumsum(self._terms(times, values), axis=-1)
+
+    def stats(self, column, window):
+        """return a dict with the n (number of readings), mean, std, slope (per second), min and
+        max of the column called `column` over the last `window` seconds, and the span (in
+        seconds) of the samples it covers. Everything is NaN if there are no readings"""
+        with self._changed:
+            return self._stats(self.column_index[column], window)
+
+    def _stats(self, c, window):
+        result = dict(n=0, mean=math.nan, std=math.nan, slope=math.nan, min=math.nan, max=math.nan, span=0.0)
+        if self._end == 0:
+            return result
+        latest = self._times[self._end-1]
+        first = int(np.searchsorted(self._times[:self._end], latest - window, side='left'))
+        result['span'] = latest - self._times[first]
+        if first > 0:
+            # there are samples from before the window too, so the window is full
+            result['span'] = max(result['span'], window)
+        s = self._sums[:, c, self._end] - self._sums[:, c, first]
+        n = s[_N]
+        result['n'] = int(round(n))
+        if n < 1:
+            return result
+        mean = s[_X] / n
+        result['mean'] = mean
+        result['std'] = math.sqrt(max(s[_XX] / n - mean * mean, 0.0))
+        t_mean = s[_T] / n
+        t_variance = s[_TT] / n - t_mean * t_mean
+        if t_variance > 0:
+            result['slope'] = (s[_TX] / n - t_mean * mean) / t_variance
+        values = self._values[c, first:self._end]
+        result['min'] = np.nanmin(values)
+        result['max'] = np.nanmax(values)
+        return result
+
+    def is_stable(self, column, tol, window, target=None):
+        """whether every reading of column over the last `window` seconds (which must be
+        covered) is within tol of their mean, and the mean within tol of target, if given"""
+        with self._changed:
+            return self._is_stable(self.column_index[column], tol, window, target)
+
+    def _is_stable(self, c, tol, window, target):
+        s = self._stats(c, window)
+        if s['n'] == 0 or s['span'] < window:
+            return False
+        if target is not None and abs(s['mean'] - target) > tol:
+            return False
+        return s['max'] - s['mean'] <= tol and s['mean'] - s['min'] <= tol
+
+    def wait_until_stable(self, column, tol, window, target=None, timeout=None, interrupt_event=None,
+                          command_while_waiting=None):
+        """block until column is stable (see is_stable). Returns True once it is, or False if
+        timeout seconds pass or interrupt_event is set first. command_while_waiting is called
+        every so often while waiting"""
+        if window > self.history:
+            raise ValueError("can't look at a %g s window when only %g s are kept" % (window, self.history))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._changed:
+                if self.columns is not None and self._is_stable(self.column_index[column], tol, window, target):
+                    return True
+                if (interrupt_event is not None and interrupt_event.is_set()) or \
+                        (deadline is not None and time.monotonic() >= deadline):
+                    return False
+                wait = RollingStatistics.POLL_PERIOD if deadline is None else min(RollingStatistics.POLL_PERIOD, max(deadline - time.monotonic(), 0))
+                self._changed.wait(wait)
+            if command_while_waiting is not None:
+                command_while_waiting()
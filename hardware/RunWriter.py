@@ -0,0 +1,250 @@
+"""Save Elveflow samples to disk on a thread of their own.
+
+RunWriter keeps its own cursor into a handler's sample buffer (see FileIO), so writing
+never holds up acquisition or plotting, and a slow disk only shows up as a growing
+backlog. Samples are formatted a whole block at a time and written out when enough rows
+have piled up or enough time has passed, with an optional fsync every so often. Stopping
+the writer drains everything acquired up to that moment, so no samples are lost.
+
+Where the samples go is up to the sink: CsvSink writes the same CSV files the Elveflow
+tab always has, and ColumnSink writes a binary run: a folder holding one little-endian
+float64 .npy file per column and a JSON sidecar (run.json) with the header, start time,
+markers and a snapshot of the configuration. Writing a run is just copying bytes, and
+load_run memory-maps it back in no time. convert_run_to_csv makes the CSV from a run.
+"""
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import numpy as np
+
+
+class CsvSink:
+    """Write blocks of samples to a CSV file: a header line, then one line per sample."""
+    NUMBER_FORMAT = '%.17g'  # enough digits for every float64 to read back exactly
+
+    def __init__(self, path, header):
+        self.path = path
+        self.file = open(path, 'a', encoding='utf-8', newline='')
+        self.file.write(','.join(_csv_field(name) for name in header) + '\n')
+
+    def write_block(self, block):
+        """write a (number of columns) x (number of rows) block"""
+        np.savetxt(self.file, block.T, fmt=CsvSink.NUMBER_FORMAT, delimiter=',')
+
+    def flush(self, fsync=False):
+        self.file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class ColumnSink:
+    """Write blocks of samples to a binary run folder at `path`; see load_run.
+
+    Each column is a standard .npy file whose header is rewritten with the new length every
+    time the sink is flushed, so a run that was cut short still loads up to its last flush."""
+    SIDECAR = 'run.json'
+    FORMAT = 'SAXSControl columns'
+    VERSION = 1
+    NPY_HEADER_LENGTH = 128  # bytes, fixed so the header can be rewritten in place
+    DTYPE = np.dtype('<f8')
+
+    def __init__(self, path, header, start_time=None, config=None):
+        self.path = path
+        self.header = list(header)
+        self.rows = 0
+        self.markers = []
+        self.metadata = {
+            'format': ColumnSink.FORMAT,
+            'version': ColumnSink.VERSION,
+            'start_time': time.time() if start_time is None else start_time,
+            'columns': [{'name': name, 'file': 'column_%02d.npy' % i} for i, name in enumerate(self.header)],
+            'config': config if config is not None else {},
+        }
+        os.makedirs(path)
+        self.files = [open(os.path.join(path, column['file']), 'w+b') for column in self.metadata['columns']]
+        self.flush()
+
+    def add_marker(self, marker_time, color=None):
+        """note an event (e.g. a line drawn on the graph) at marker_time; saved at the next flush"""
+        self.markers.append({'time': marker_time, 'color': color})
+
+    def write_block(self, block):
+        """write a (number of columns) x (number of rows) block"""
+        for f, values in zip(self.files, block):
+            f.write(np.ascontiguousarray(values, dtype=ColumnSink.DTYPE).tobytes())
+        self.rows += block.shape[1]
+
+    def flush(self, fsync=False):
+        header = _npy_header(self.rows)
+        for f in self.files:
+            f.seek(0)
+            f.write(header)
+            f.seek(0, os.SEEK_END)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        self._write_sidecar()
+
+    def close(self):
+        if self.files:
+            self.flush()
+            for f in self.files:
+                f.close()
+            self.files = []
+
+    def _write_sidecar(self):
+        metadata = dict(self.metadata, rows=self.rows, markers=list(self.markers))
+        temporary = os.path.join(self.path, ColumnSink.SIDECAR + '.tmp')
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, indent=1, ensure_ascii=False)
+        os.replace(temporary, os.path.join(self.path, ColumnSink.SIDECAR))
+
+
+def _npy_header(rows):
+    """the header of a 1-D little-endian float64 .npy file of the given length, always
+    ColumnSink.NPY_HEADER_LENGTH bytes long"""
+    text = "{'descr': '<f8', 'fortran_order': False, 'shape': (%d,), }" % rows
+    length = ColumnSink.NPY_HEADER_LENGTH - 10
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', length) + text.ljust(length - 1).encode('latin1') + b'\n'
+
+
+def load_run(path):
+    """read a run written by ColumnSink. Returns (metadata, columns): the sidecar as a dict,
+    and a dict of column name -> read-only array, memory-mapped rather than read in"""
+    with open(os.path.join(path, ColumnSink.SIDECAR), encoding='utf-8') as f:
+        metadata = json.load(f)
+    columns = {column['name']: np.load(os.path.join(path, column['file']), mmap_mode='r')
+               for column in metadata['columns']}
+    return metadata, columns
+
+
+def convert_run_to_csv(path, csv_path=None, chunk_rows=100000):
+    """write the run at `path` as the CSV file CsvSink would have written, and return its path.
+    By default it goes next to the run, with the same name"""
+    if csv_path is None:
+        csv_path = os.path.splitext(os.path.normpath(path))[0] + '.csv'
+    metadata, columns = load_run(path)
+    header = [column['name'] for column in metadata['columns']]
+    rows = min(len(values) for values in columns.values()) if columns else 0
+    sink = CsvSink(csv_path, header)
+    try:
+        for start in range(0, rows, chunk_rows):
+            sink.write_block(np.array([columns[name][start:start+chunk_rows] for name in header]))
+    finally:
+        sink.close()
+    return csv_path
+
+
+def _csv_field(text):
+    """quote text the way the csv module would, if it needs it"""
+    if any(c in text for c in ',"\r\n'):
+        return '"%s"' % text.replace('"', '""')
+    return text
+
+
+class RunWriter:
+    """Copy every sample from `source` (anything with read_since and current_cursor, like the
+    Elveflow handlers) into `sink`, from the moment start() is called until stop() returns."""
+    POLL_PERIOD = 0.1  # seconds between looks at the source
+    FLUSH_ROWS = 1000  # write out as soon as this many rows are waiting...
+    FLUSH_INTERVAL = 1.0  # ...or when the oldest waiting row is this many seconds old
+    BACKLOG_REPORT_PERIOD = 60  # seconds between warnings about falling behind
+
+    def __init__(self, source, sink, errorlogger=None, fsync_interval=None,
+                 flush_rows=FLUSH_ROWS, flush_interval=FLUSH_INTERVAL):
+        self.source = source
+        self.sink = sink
+        self.errorlogger = errorlogger if errorlogger is not None else logging.getLogger('python')
+        self.fsync_interval = fsync_interval  # seconds between fsyncs; None to leave it to the OS
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.cursor = None
+        self.rows_written = 0
+        self.rows_lost = 0
+        self._pending = []
+        self._pending_rows = 0
+        self._pending_since = None
+        self._last_fsync = time.monotonic()
+        self._last_backlog_report = -np.inf
+        self._stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """start writing every sample taken from now on"""
+        self.cursor = self.source.current_cursor()
+        self.thread = threading.Thread(target=self._run, name='RunWriter')
+        self.thread.start()
+
+    def stop(self):
+        """write out every sample taken up to now, close the sink and return"""
+        self._stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def backlog(self):
+        """return how many samples have been taken but are not on disk yet"""
+        cursor = self.cursor if self.cursor is not None else 0
+        return self.source.current_cursor() - cursor + self._pending_rows
+
+    def stats(self):
+        return {
+            'rows_written': self.rows_written,
+            'rows_lost': self.rows_lost,
+            'backlog': self.backlog(),
+        }
+
+    def _run(self):
+        try:
+            while not self._stop_event.is_set():
+                self._collect()
+                now = time.monotonic()
+                if self._pending_rows >= self.flush_rows or \
+                        (self._pending_rows > 0 and now - self._pending_since >= self.flush_interval):
+                    self._write(fsync=self.fsync_interval is not None and now - self._last_fsync >= self.fsync_interval)
+                self._report_backlog(now)
+                self._stop_event.wait(RunWriter.POLL_PERIOD)
+            # stop() was called: everything taken before then is in the source, so one last read gets it all
+            self._collect()
+            self._write(fsync=self.fsync_interval is not None)
+        except Exception:
+            self.errorlogger.exception("error while saving Elveflow data to %s" % getattr(self.sink, 'path', self.sink))
+        finally:
+            self.sink.close()
+            self.errorlogger.debug("done saving: %d samples written, %d lost" % (self.rows_written, self.rows_lost))
+
+    def _collect(self):
+        new_cursor, block = self.source.read_since(self.cursor)
+        lost = new_cursor - self.cursor - block.shape[1]
+        if lost > 0:
+            # we fell so far behind that the source's buffer wrapped around
+            self.rows_lost += lost
+            self.errorlogger.error("saving fell behind; %d samples were lost" % lost)
+        self.cursor = new_cursor
+        if block.shape[1] > 0:
+            if self._pending_rows == 0:
+                self._pending_since = time.monotonic()
+            self._pending.append(block)
+            self._pending_rows += block.shape[1]
+
+    def _write(self, fsync=False):
+        if self._pending_rows > 0:
+            self.sink.write_block(np.concatenate(self._pending, axis=1))
+            self.rows_written += self._pending_rows
+            self._pending = []
+            self._pending_rows = 0
+        self.sink.flush(fsync=fsync)
+        if fsync:
+            self._last_fsync = time.monotonic()
+
+    def _report_backlog(self, now):
+        backlog = self.backlog()
+        capacity = getattr(getattr(self.source, 'buffer', None), 'capacity', None)
+        if capacity is not None and backlog > capacity // 2 and now - self._last_backlog_report >= RunWriter.BACKLOG_REPORT_PERIOD:
+            self._last_backlog_report = now
+            self.errorlogger.warning("saving is %d samples behind (the buffer holds %d); the disk may be too slow" % (backlog, capacity))
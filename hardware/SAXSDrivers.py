@@ -4,13 +4,22 @@ The class shares a COM port. This enables to configure several pumps though a
 PUMP chain- Therefore it doesn't support multiple pumps connected directly to
 Computer
 
+The instruments' lock argument is only accepted for compatibility: round trips on a
+port are kept apart by its transport (see SerialTransport), so it isn't used.
+
 Version 1-04/04/19
 Pollack Lab- Ccornell University
 Josue San Emeterio
 """
+import asyncio
 import serial
 import serial.tools.list_ports
-import time, os
+import time
+import math
+import re
+from .PumpMonitor import PumpMonitor, PumpState
+from .SerialTransport import run, synchronous, transport_for
+from .WireLog import WireLog
 
 
 def list_available_ports(optional_list=[]):   # Does the optional list input do anything? Should we just initialize an empty list for the output?
@@ -31,18 +40,19 @@ def InstrumentTerminateFunction(instrument_list):
 class SAXSController(serial.Serial):
     """Class for communication with devices using the USB box."""
 
+    SCAN_TIME = 0.5  # seconds to collect the answer to an I2C scan
+
     def __init__(self, logger=[], **kwargs):
         """Initialize class."""
         super().__init__(**kwargs)
         self.logger = logger
         self.enabled = False
-        self.temp_logger = open('log/pump_%d.log' % time.time(), 'w+')
-        # TODO: close properly
+        self.wire_log = WireLog('log/pump_%d.log' % time.time())  # everything sent and received, see SerialTransport
 
     def set_port(self, port, instrument_list=[]):
         """Set the serial port."""
         if self.is_open:
-            self.close()
+            run(transport_for(self).close())
         self.port = port
         self.open()
         self.enabled = True
@@ -51,44 +61,97 @@ class SAXSController(serial.Serial):
             if instrument.pc_connect == False:
                 instrument.set_to_controller(self)
 
-    def scan_i2c(self):
+    async def async_scan_i2c(self):
         """Scan I2C line."""
         if not self.enabled:
             self.logger.info("Microcontroller not set up")
             raise ValueError
-        if not self.is_open:
-            self.open()
-        self.write(b'I')
-        while self.in_waiting > 0:
-            self.logger.info(self.readline().decode())
+        transport = transport_for(self)
+        async with transport.lock:
+            transport.discard_input()
+            await transport.write(b'I')
+            answer = await transport.read_all(SAXSController.SCAN_TIME)
+        for line in answer.decode().splitlines():
+            self.logger.info(line)
+
+    scan_i2c = synchronous(async_scan_i2c)
 
 # To finish for Hardware Configure
     def get_addresses(self):
-        if not self.enabled:
-            self.logger.info("Microcontroller not set up")
-            raise ValueError
-        if not self.is_open:
-            self.open()
         # Check instruments
-        self.write(b'I')
-        while self.in_waiting > 0:
-            self.logger.info(self.readline().decode())
-
-    def read_check(self):
-        value = self.read()
-        self.temp_logger.write("%d:   "%time.time() + repr(value) + "\n")
-        self.temp_logger.flush()
-        os.fsync(self.temp_logger.fileno())
-        return value
-
-    def readline_check(self):
-        value = self.readline()
-        self.temp_logger.write("%d:   "%time.time() + repr(value) + "\n")
-        self.temp_logger.flush()
-        os.fsync(self.temp_logger.fileno())
-        return value
-
-
+        self.scan_i2c()
+
+
+class HarvardChain:
+    """The Harvard pumps daisy-chained on one port.
+
+    Replies are framed by the prompt that ends each of them (a pump's address, then one of
+    :<>*) and handed to whichever query is waiting on that address, so queries to different
+    pumps can go out back to back and be answered in any order. Each pump has one query in
+    flight at a time; a reply nobody is waiting for is logged and dropped."""
+    PROMPT = re.compile(rb"(?<![0-9])([0-9]+)[:<>*]")
+
+    _chains = {}
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.pending = {}  # address -> Future of the reply
+        self._expiry = {}  # address -> loop time the pending reply is given up on
+        self._address_locks = {}
+        self.task = None
+
+    @staticmethod
+    def for_port(port):
+        """the chain on a pyserial port, made on first use"""
+        chain = HarvardChain._chains.get(id(port))
+        if chain is None or chain.transport.serial is not port:
+            chain = HarvardChain._chains[id(port)] = HarvardChain(transport_for(port))
+        return chain
+
+    async def query(self, address, frame, timeout):
+        """send a framed command to the pump at address and return its reply, or b"" if it
+        hasn't answered within timeout seconds"""
+        address = int(address)
+        lock = self._address_locks.setdefault(address, asyncio.Lock())
+        loop = asyncio.get_running_loop()
+        async with lock:
+            # open first: a framing task started on a closed port would see it closed and stop
+            await self.transport.open()
+            if self.task is None or self.task.done():
+                self.task = asyncio.ensure_future(self._frame_replies())
+            earlier = self.pending.get(address)
+            if earlier is not None and not earlier.done():
+                # the reply to a query that was given up on (cancelled) may still come; wait
+                # it out, so it isn't taken for the reply to this one
+                try:
+                    await asyncio.wait_for(earlier, max(self._expiry[address] - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    pass
+            reply = self.pending[address] = loop.create_future()
+            self._expiry[address] = loop.time() + timeout
+            async with self.transport.lock:
+                await self.transport.write(frame)
+            try:
+                # shielded, so that if this is cancelled the reply is still waited for
+                return await asyncio.wait_for(asyncio.shield(reply), timeout)
+            except asyncio.TimeoutError:
+                return b""
+
+    async def _frame_replies(self):
+        def ready(buffer):
+            match = HarvardChain.PROMPT.search(buffer)
+            return match.end() if match else None
+        while True:
+            try:
+                reply = await self.transport.take(ready)
+            except serial.SerialException:
+                return  # the port was closed; the next query starts over
+            address = int(HarvardChain.PROMPT.search(reply).group(1))
+            waiting = self.pending.pop(address, None)
+            if waiting is not None and not waiting.done():
+                waiting.set_result(reply)
+            else:
+                self.transport.errorlogger.debug("Dropped a reply from pump %d that nothing was waiting for: %r" % (address, reply))
 
 
 class HPump:
@@ -105,6 +168,10 @@ class HPump:
     # Variable to keep track if pump has a valid port-> Avoids crashing when not set up
     enabled = False
 
+    RESPONSE_TIMEOUT = 1  # seconds to wait for the pump to finish replying
+    POLL_PERIOD = 0.05  # seconds between status queries while waiting for the pump
+    COMMAND_PERIOD = 0.3  # seconds between calls of command_while_waiting while waiting
+
     def __init__(self, address=0, pc_connect=True, running=False, infusing=True, name="Pump", logger=[], hardware_configuration="", lock=None):
         """Initialize HPump."""
         self.address = str(address)
@@ -115,14 +182,14 @@ class HPump:
         self.name = name
         self.instrument_type = "Pump"
         self.hardware_configuration = hardware_configuration
-        self._lock = lock
+        self.state = PumpState()
         # add init for syringe dismeter,flowrate, Direction etc
 
     # function to initialize ports
     def set_port(self, port, resource=pumpserial):
         """Set the pump port."""
         if resource.is_open:
-            resource.close()
+            run(transport_for(resource).close())
         resource.port = port
         self.pc_connect = True
         HPump.enabled = True
@@ -151,688 +218,448 @@ class HPump:
 # Pump action commands
 # To do in all. Read in confirmstion from pump.
 
-    def start_pump(self, resource=pumpserial):
+    def _transport(self, resource):
+        return transport_for(resource if self.pc_connect else self.controller)
+
+    def _frame(self, command):
+        if self.pc_connect:
+            return (self.address+command+"\n\r").encode()
+        return ("-"+self.address+command+"\n\r").encode()
+
+    def _prompt(self):
+        """a regex matching the pump's prompt (its address then one of :<>*), which ends every
+        reply. Group 1 is the prompt character"""
+        return re.compile(rb"(?:^|[^0-9])" + re.escape(self.address.encode()) + rb"([:<>*])")
+
+    async def _query(self, command, resource, timeout=None):
+        """send a command to the pump and return its reply, as soon as the whole reply is in.
+        If timeout (RESPONSE_TIMEOUT by default) seconds pass first, the reply is incomplete
+        or empty"""
+        timeout = HPump.RESPONSE_TIMEOUT if timeout is None else timeout
+        if self.pc_connect:
+            # the pump chain has a port to itself, so replies are matched to queries by address
+            response = await HarvardChain.for_port(resource).query(self.address, self._frame(command), timeout)
+        else:
+            transport = self._transport(resource)
+            async with transport.lock:
+                transport.discard_input()
+                await transport.write(self._frame(command))
+                response = await transport.read_until(self._prompt(), timeout)
+        if not response:
+            self.logger.debug("No responce from " + self.name)
+        return response
+
+    @staticmethod
+    def _lines(response):
+        """split a reply into lines the way readline would"""
+        return re.findall(rb"[^\n]*\n|[^\n]+", response)
+
+    async def async_start_pump(self, resource=pumpserial):
         """Send a start command to the pump."""
-        with self._lock:
-            responceflag = False
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                while resource.in_waiting > 0:  # Clear Buffer
-                    resource.readline()
-                resource.write((self.address+"RUN\n\r").encode())
-                time.sleep(0.2)
-                if resource.in_waiting == 0:  # give extra time if it hasn't responded
-                    self.logger.debug("No responce: Waiting")
-
-                    time.sleep(0.4)
-                while resource.in_waiting > 0:
-                    pumpanswer = resource.readline()
-                    if (self.address+"<").encode() in pumpanswer:
-                        self.running = True
-                        self.logger.info("Refilling " + self.name)
-                        responceflag = True
-                    elif (self.address+">").encode() in pumpanswer:
-                        self.running = True
-                        self.logger.info("Infusing " + self.name)
-                        responceflag = True
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                while self.controller.in_waiting > 0:  # Clear Buffer
-                    self.controller.readline_check()
-                self.controller.write(("-"+self.address+"RUN\n\r").encode())
-                time.sleep(0.2)
-                if self.controller.in_waiting == 0:  # give more time if it hasn't finished
-                    self.logger.debug("No responce: Waiting")
-                    time.sleep(0.2)
-                while self.controller.in_waiting > 0:
-                    pumpanswer = self.controller.readline_check()
-                    if (self.address+"<").encode() in pumpanswer:
-                        self.running = True
-                        self.logger.info("Refilling " + self.name)
-                        responceflag = True
-                    elif (self.address+">").encode() in pumpanswer:
-                        self.running = True
-                        self.logger.info("Infusing " + self.name)
-                        responceflag = True
-            if not responceflag:
-                self.logger.info("Error starting pump")
-                raise RuntimeError
+        if not HPump.enabled:
+            self.logger.info(self.name+" not enabled")
+            raise ValueError
+        pumpanswer = await self._query("RUN", resource)
+        if (self.address+"<").encode() in pumpanswer:
+            self.running = True
+            self.state.command(running=True, infusing=False, delivered_volume=None)
+            self.logger.info("Refilling " + self.name)
+        elif (self.address+">").encode() in pumpanswer:
+            self.running = True
+            self.state.command(running=True, infusing=True, delivered_volume=None)
+            self.logger.info("Infusing " + self.name)
+        else:
+            self.logger.info("Error starting pump")
+            raise RuntimeError
 
-    def stop_pump(self, resource=pumpserial):
-        with self._lock:
-            responceflag = False
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                while resource.in_waiting > 0:  # Clear Buffer
-                    resource.readline()
-                resource.write((self.address+"STP\n\r").encode())
-                time.sleep(0.2)
-                if resource.in_waiting == 0:  # give extra time if it hasn't responded
-                    time.sleep(0.2)
-                while resource.in_waiting > 0:  # Clear Buffer
-                    pumpanswer = resource.readline()
-                    if (self.address+"*").encode() in pumpanswer:
-                        self.running = False
-                        self.logger.info("Paused " + self.name)
-                        responceflag = True
-                    elif (self.address+":").encode() in pumpanswer:
-                        self.running = False
-                        self.logger.info("Stopped " + self.name)
-                        responceflag = True
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                while self.controller.in_waiting > 0:  # Clear Buffer
-                    self.controller.readline_check()
-                self.controller.write(("-"+self.address+"STP\n\r").encode())
-                time.sleep(0.2)
-                if self.controller.in_waiting == 0:  # give more time if it hasn't finished
-                    self.logger.debug("No responce: Waiting")
-                    time.sleep(0.4)
-                while self.controller.in_waiting > 0:
-                    pumpanswer = self.controller.readline_check()
-                    if (self.address+":").encode() in pumpanswer:
-                        self.running = False
-                        self.logger.info("Paused " + self.name)
-                        responceflag = True
-                    elif (self.address+"*").encode() in pumpanswer:
-                        self.running = False
-                        self.logger.info("Stopped " + self.name)
-                        responceflag = True
-            if not responceflag:
-                self.logger.info("Error Stopping Pump")
-                raise RuntimeError
+    async def async_stop_pump(self, resource=pumpserial):
+        if not HPump.enabled:
+            self.logger.info(self.name+" not enabled")
+            raise ValueError
+        pumpanswer = await self._query("STP", resource)
+        if (self.address+"*").encode() in pumpanswer:
+            self.running = False
+            self.state.command(running=False)
+            self.logger.info("Paused " + self.name)
+        elif (self.address+":").encode() in pumpanswer:
+            self.running = False
+            self.state.command(running=False)
+            self.logger.info("Stopped " + self.name)
+        else:
+            self.logger.info("Error Stopping Pump")
+            raise RuntimeError
 
-    def set_infuse_rate(self, rate, units="UM", resource=pumpserial):
+    async def async_set_infuse_rate(self, rate, units="UM", resource=pumpserial):
         # consider moving to after checking with pump
-        with self._lock:
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
-            ratestr = str(rate).zfill(5)
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                resource.write((self.address+"RAT"+ratestr+units+"\n\r").encode())
-                # val = resource.read(4)
-                # TODO: add possibillity to change units
-
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("-"+self.address+"RAT"+ratestr+units+"\n\r").encode())
-            time.sleep(0.2)
-            if rate == self.check_infuse_rate():
-                self.logger.info(self.name+" infuse Rate set to "+str(rate))
-                self.infuserate = rate
-            else:
-                self.logger.info("Error setting infuse rate for "+self.name)
-                raise RuntimeError
+        if not HPump.enabled:
+            self.logger.info(self.name+" not enabled")
+            raise ValueError
+        ratestr = str(rate).zfill(5)
+        await self._query("RAT"+ratestr+units, resource)
+        # TODO: add possibillity to change units
+        if rate == await self.async_check_infuse_rate(resource):
+            self.logger.info(self.name+" infuse Rate set to "+str(rate))
+            self.infuserate = rate
+            self.state.command(infuse_rate=rate)
+        else:
+            self.logger.info("Error setting infuse rate for "+self.name)
+            raise RuntimeError
 
-    def set_refill_rate(self, rate, units="UM", resource=pumpserial):
+    async def async_set_refill_rate(self, rate, units="UM", resource=pumpserial):
         # consider moving to after checking with pump
-        with self._lock:
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
-
-            ratestr = str(rate).zfill(5)
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                resource.write((self.address+"RFR"+ratestr+units+"\n\r").encode())
+        if not HPump.enabled:
+            self.logger.info(self.name+" not enabled")
+            raise ValueError
 
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("-"+self.address+"RFR"+ratestr+units+"\n\r").encode())
-
-            # TODO: add possibillity to change units
-            time.sleep(0.2)
-            if rate == self.check_refill_rate():
-                self.logger.info(self.name+" refill rate set to "+str(rate))
-                self.fillrate = rate
-            else:
-                self.logger.info("Error setting refill rate for "+self.name)
-                raise RuntimeError
+        ratestr = str(rate).zfill(5)
+        await self._query("RFR"+ratestr+units, resource)
+        # TODO: add possibillity to change units
+        if rate == await self.async_check_refill_rate(resource):
+            self.logger.info(self.name+" refill rate set to "+str(rate))
+            self.fillrate = rate
+            self.state.command(refill_rate=rate)
+        else:
+            self.logger.info("Error setting refill rate for "+self.name)
+            raise RuntimeError
 
-    def set_flow_rate(self, rate, units="UM", resource=pumpserial):
+    async def async_set_flow_rate(self, rate, units="UM", resource=pumpserial):
         # Function to change the current flowrate whether infuse or withdraw
         if not HPump.enabled:
             self.logger.info(self.name+" not enabled")
             raise ValueError
 
         if(self.infusing):
-            return self.set_infuse_rate(rate, units)
+            return await self.async_set_infuse_rate(rate, units, resource)
         else:
-            return self.set_refill_rate(rate, units)
+            return await self.async_set_refill_rate(rate, units, resource)
 
-    def send_command(self, command, resource=pumpserial):   # sends an albitrary command
+    async def async_send_command(self, command, resource=pumpserial):   # sends an albitrary command
         if not HPump.enabled:
             self.logger.info(self.name+" not enabled")
             raise ValueError
-        if self.pc_connect:
-            if not resource.is_open:
-                resource.open()
-            resource.write((command).encode())
-        else:
-            self.controller.write(("-"+command).encode())
+        transport = self._transport(resource)
+        async with transport.lock:
+            await transport.write((command if self.pc_connect else "-"+command).encode())
 
-    def infuse(self, resource=pumpserial):
-        with self._lock:
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
-            self.infusing = True
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                resource.write((self.address+'DIRINF'+"\n\r").encode())
-
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("-"+self.address+"DIRINF"+"\n\r").encode())
-            time.sleep(0.2)
-            self.check_direction("INFUSE")
-            self.logger.info(self.name+" set to infuse")
-
-    def refill(self, resource=pumpserial):
-        with self._lock:
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
-            self.infusing = False
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                resource.write((self.address+'DIRREF'+"\n\r").encode())
+    async def async_infuse(self, resource=pumpserial):
+        if not HPump.enabled:
+            self.logger.info(self.name+" not enabled")
+            raise ValueError
+        self.infusing = True
+        await self._query("DIRINF", resource)
+        await self.async_check_direction("INFUSE", resource)
+        self.state.command(infusing=True)
+        self.logger.info(self.name+" set to infuse")
 
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("-"+self.address+"DIRREF"+"\n\r").encode())
-            time.sleep(0.2)
-            self.check_direction("REFILL")
-            self.logger.info(self.name+" set to refill")
-
-    def reverse(self, resource=pumpserial):
-        with self._lock:
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
-            self.infusing = not self.infusing
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                resource.write((self.address+'DIRREV'+"\n\r").encode())
+    async def async_refill(self, resource=pumpserial):
+        if not HPump.enabled:
+            self.logger.info(self.name+" not enabled")
+            raise ValueError
+        self.infusing = False
+        await self._query("DIRREF", resource)
+        await self.async_check_direction("REFILL", resource)
+        self.state.command(infusing=False)
+        self.logger.info(self.name+" set to refill")
 
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("-"+self.address+"DIRREV"+"\n\r").encode())
-
-    def set_mode_pump(self,  resource=pumpserial):
-        with self._lock:
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                return
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                resource.write((self.address+'MOD PMP'+"\n\r").encode())
+    async def async_reverse(self, resource=pumpserial):
+        if not HPump.enabled:
+            self.logger.info(self.name+" not enabled")
+            raise ValueError
+        self.infusing = not self.infusing
+        await self._query("DIRREV", resource)
 
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("-"+self.address+"MOD PMP"+"\n\r").encode())
-            time.sleep(0.2)
-            self.check_mode("PUMP")
-            self.logger.info(self.name+" mode set to PUMP")
-
-    def set_mode_vol(self,  resource=pumpserial):
-        with self._lock:
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                resource.write((self.address+'MOD VOL'+"\n\r").encode())
+    async def async_set_mode_pump(self,  resource=pumpserial):
+        if not HPump.enabled:
+            self.logger.info(self.name+" not enabled")
+            return
+        await self._query("MOD PMP", resource)
+        await self.async_check_mode("PUMP", resource)
+        self.logger.info(self.name+" mode set to PUMP")
 
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("-"+self.address+"MOD VOL"+"\n\r").encode())
-            time.sleep(0.2)
-            self.check_mode("VOL")
-            self.logger.info(self.name+" mode set to VOL")
-
-    def set_mode_progam(self,  resource=pumpserial):
-        with self._lock:
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                resource.write((self.address+'MOD PGM'+"\n\r").encode())
+    async def async_set_mode_vol(self,  resource=pumpserial):
+        if not HPump.enabled:
+            self.logger.info(self.name+" not enabled")
+            raise ValueError
+        await self._query("MOD VOL", resource)
+        await self.async_check_mode("VOL", resource)
+        self.logger.info(self.name+" mode set to VOL")
 
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("-"+self.address+"MOD PGM"+"\n\r").encode())
-            time.sleep(0.2)
-            self.check_mode("PROG")
-            self.logger.info(self.name+" Mode set to program")
-
-    def set_target_vol(self, vol, resource=pumpserial):
-        with self._lock:
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
-            volstr = str(vol).zfill(5)
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                resource.write((self.address+'TGT'+volstr+"\n\r").encode())
+    async def async_set_mode_progam(self,  resource=pumpserial):
+        if not HPump.enabled:
+            self.logger.info(self.name+" not enabled")
+            raise ValueError
+        await self._query("MOD PGM", resource)
+        await self.async_check_mode("PROG", resource)
+        self.logger.info(self.name+" Mode set to program")
 
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("-"+self.address+'TGT'+volstr+"\n\r").encode())
-
-            time.sleep(0.2)
-            self.logger.info(self.name+" Target Vol is "+str(self.check_target_volume())+" ml")
-
-    def is_running(self, resource=pumpserial):
-        with self._lock:
-            running = False
-            success = False
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                while resource.in_waiting > 0:  # Clear Buffer
-                    resource.readline().decode()
-                resource.write((self.address+"\n\r").encode())  # Query Pump
-                time.sleep(0.2)
-                while resource.in_waiting > 0:
-                    answer = resource.readline().decode()
-                    if self.address in answer:
-                        if "<" in answer:
-                            running = True
-                            success = True
-                        elif ">" in answer:
-                            running = True
-                            success = True
-                        elif ":" in answer:
-                            running = False
-                            success = True
-                        elif "*" in answer:
-                            running = False
-                            success = True
-                if success:
-                    return running
-                else:
-                    self.logger.debug("Failure Connecting to Pump")
-                    return True
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                while self.controller.in_waiting > 0:   # Clear Buffer
-                    self.controller.read_check()
-                self.controller.write(("-"+self.address+"\n\r").encode())
-                time.sleep(0.2)
-                while self.controller.in_waiting > 0:
-                    if self.controller.read_check() == self.address.encode():
-                        answer = self.controller.read_check()
-                        if b"<" == answer:
-                            running = True
-                            success = True
-                        elif b">" == answer:
-                            running = True
-                            success = True
-                        elif b":" == answer:
-                            running = False
-                            success = True
-                        elif b"*" == answer:
-                            running = False
-                            success = True
-                if success:
-                    return running
-                else:
-                    self.logger.debug("Failure Connecting to Pump")
-                    return True
-                    # raise RuntimeError Not raising so that if one fails queue isnt dumped
+    async def async_set_target_vol(self, vol, resource=pumpserial):
+        if not HPump.enabled:
+            self.logger.info(self.name+" not enabled")
+            raise ValueError
+        volstr = str(vol).zfill(5)
+        await self._query('TGT'+volstr, resource)
+        target = await self.async_check_target_volume(resource)
+        self.state.command(target_volume=target)
+        self.logger.info(self.name+" Target Vol is "+str(target)+" ml")
+
+    async def async_status(self, resource=pumpserial):
+        """the pump's prompt: ':' stopped, '*' paused, '>' infusing or '<' refilling, or None
+        if it didn't answer"""
+        if not HPump.enabled:
+            self.logger.info(self.name+" not enabled")
+            raise ValueError
+        match = self._prompt().search(await self._query("", resource))  # Query Pump
+        return match.group(1).decode() if match else None
+
+    async def async_is_running(self, resource=pumpserial):
+        status = await self.async_status(resource)
+        if status is None:
+            self.logger.debug("Failure Connecting to Pump")
+            return True
+            # raise RuntimeError Not raising so that if one fails queue isnt dumped
+        return status in "<>"
+
+    async def async_refresh(self, full=False, polled=False, volume=True, resource=pumpserial):
+        """read what the pump is doing into self.state: whether it's running and, while it is
+        (or if full), the delivered volume if volume, and the rates and target volume if full"""
+        generation = self.state.generation
+        values = {}
+        status = await self.async_status(resource)
+        if status is not None:
+            values['running'] = status in "<>"
+            if status in "<>":
+                values['infusing'] = status == ">"
+        if volume and (values.get('running') or full):
+            values['delivered_volume'] = await self._query_value("DEL", resource, float)
+        if full:
+            values['infuse_rate'] = await self._query_value("RAT", resource, lambda answer: float(answer[0:-7]))
+            values['refill_rate'] = await self._query_value("RFR", resource, lambda answer: float(answer[0:-7]))
+            values['target_volume'] = await self._query_value("TGT", resource, float)
+            direction = await self._query("DIR", resource)
+            if b"INFUSE" in direction or b"REFILL" in direction:
+                values['infusing'] = b"INFUSE" in direction
+        self.state.observe(generation, polled=polled and status is not None, **values)
+
+    def _wait_for_state(self, predicate, endtime, command_while_waiting, volume):
+        """wait until predicate(self.state) is true or the monotonic clock passes endtime, and
+        return whether it is. The state is kept up to date by a PumpMonitor if one is running.
+        If not, the pump is asked directly every POLL_PERIOD, except while it is predicted to be
+        a while yet from finishing (see PumpState.expected_completion), when it's only asked
+        every PumpMonitor.PREDICTED_POLL_PERIOD"""
+        last_command = -math.inf
+        last_refresh = -math.inf
+        announced = False
+        while True:
+            wait = HPump.COMMAND_PERIOD
+            if not self.state.fresh():
+                now = time.monotonic()
+                completion = self.state.expected_completion()
+                if completion is None or now >= min(completion - PumpMonitor.PREDICTION_LEAD, last_refresh + PumpMonitor.PREDICTED_POLL_PERIOD):
+                    # the delivered volume is needed for a prediction, if there's a target to predict
+                    self.refresh(volume=volume or (completion is None and self.state.target_volume is not None))
+                    last_refresh = now
+                    wait = HPump.POLL_PERIOD
+            remaining = self.state.time_remaining()
+            if remaining is not None and not announced:
+                self.logger.info("%s should finish in %.1f s" % (self.name, remaining))
+                announced = True
+            if self.state.wait_for(predicate, max(min(wait, endtime - time.monotonic()), 0)):
+                return True
+            if time.monotonic() >= endtime:
+                return False
+            if time.monotonic() - last_command >= HPump.COMMAND_PERIOD:
+                last_command = time.monotonic()
+                command_while_waiting()
 
     def wait_until_time(self, wait_time, command_while_waiting=lambda *_: None):
-        currenttime = time.time()
-        endtime = currenttime + wait_time
-        while self.is_running() and time.time() < endtime:
-            time.sleep(0.1)
-            command_while_waiting()
-
+        self._wait_for_state(lambda state: state.running is False, time.monotonic() + wait_time, command_while_waiting, volume=False)
 
     def wait_until_stopped(self, timeout=60, command_while_waiting=lambda *_: None):
-        currenttime = 0
-        while self.is_running() and currenttime < timeout:
-            time.sleep(0.1)
-            currenttime += 0.1
-            command_while_waiting()
-        if not currenttime < timeout:
+        if not self._wait_for_state(lambda state: state.running is False, time.monotonic() + timeout, command_while_waiting, volume=False):
             self.logger.info("Pump wait timeout")
             raise RuntimeError
 
-    def infuse_volume(self, volume, rate):
-        self.infuse()
-        time.sleep(0.1)
-        self.set_mode_vol()
-        time.sleep(0.1)
-        self.set_target_vol(volume)
-        time.sleep(0.1)
-        self.set_infuse_rate(rate)
-        time.sleep(0.1)
-        self.start_pump()
+    def wait_until_delivered(self, volume, timeout=60, command_while_waiting=lambda *_: None):
+        """wait until the pump has delivered at least volume (in ml, as get_delivered_volume);
+        returns whether it has before timeout seconds pass"""
+        return self._wait_for_state(lambda state: state.delivered_volume is not None and state.delivered_volume >= volume,
+                                    time.monotonic() + timeout, command_while_waiting, volume=True)
+
+    def time_remaining(self):
+        """seconds until the pump should reach its target volume, or None if that isn't known"""
+        return self.state.time_remaining()
+
+    def known_running(self):
+        """whether the pump is running, from self.state if a PumpMonitor keeps it up to date,
+        or by asking the pump if not"""
+        if self.state.fresh() and self.state.running is not None:
+            return self.state.running
+        return self.is_running()
+
+    async def async_infuse_volume(self, volume, rate, resource=pumpserial):
+        # every command waits for the pump's reply, so they can follow each other directly
+        await self.async_infuse(resource)
+        await self.async_set_mode_vol(resource)
+        await self.async_set_target_vol(volume, resource)
+        await self.async_set_infuse_rate(rate, resource=resource)
+        await self.async_start_pump(resource)
         # self.wait_until_stopped(2*volume*1000/rate)  # wait for it to stop
 
-    def refill_volume(self, volume, rate):
-        self.refill()
-        time.sleep(0.1)
-        self.set_mode_vol()
-        time.sleep(0.1)
-        self.set_target_vol(volume)
-        time.sleep(0.1)
-        self.set_refill_rate(rate)
-        time.sleep(0.1)
-        self.start_pump()
+    async def async_refill_volume(self, volume, rate, resource=pumpserial):
+        await self.async_refill(resource)
+        await self.async_set_mode_vol(resource)
+        await self.async_set_target_vol(volume, resource)
+        await self.async_set_refill_rate(rate, resource=resource)
+        await self.async_start_pump(resource)
         # self.wait_until_stopped(2*volume*1000/rate)  # wait for it to stop
 
-    def check_direction(self, dirstr="k", resource=pumpserial, retry=True):
-        success = False
+    async def async_check_direction(self, dirstr="k", resource=pumpserial, retry=True):
         if not HPump.enabled:
             self.logger.info(self.name+" not enabled")
             raise ValueError
-        if self.pc_connect:
-            if not resource.is_open:
-                resource.open()
-            while resource.in_waiting > 0:  # Clear Buffer
-                resource.readline()
-            resource.write((self.address+"DIR"+"\n\r").encode())  # Query Pump
-            time.sleep(0.2)
-            while resource.in_waiting > 0:
-                if dirstr.encode() in resource.readline():
-                    success = True
-            if not success:
+        if dirstr.encode() not in await self._query("DIR", resource):  # Query Pump
+            if retry:
+                self.logger.debug("Error connecting: retrying")
+                await self.async_check_direction(dirstr, resource, retry=False)
+            else:
                 self.logger.info("Failure Connecting to Pump")
                 raise RuntimeError
-        else:
-            if not self.controller.is_open:
-                self.controller.open()
-            while self.controller.in_waiting > 0:   # Clear Buffer
-                self.controller.read_check()
-            self.controller.write(("-"+self.address+"DIR"+"\n\r").encode())
-            time.sleep(0.2)
-            if self.controller.in_waiting == 0:
-                self.logger.debug("No responce: waiting")
-                time.sleep(0.4)
-            while self.controller.in_waiting > 0:
-                if dirstr.encode() in self.controller.readline_check():
-                    success = True
-            if not success:
-                if retry:
-                    self.logger.debug("Error connecting: retrying")
-                    time.sleep(0.2)
-                    self.check_direction(dirstr, retry=False)
-                else:
-                    self.logger.info("Failure Connecting to Pump")
-                    raise RuntimeError
-
-    def check_mode(self, modestr="k", resource=pumpserial, retry=True):
-        success = False
+
+    async def async_check_mode(self, modestr="k", resource=pumpserial, retry=True):
         if not HPump.enabled:
             self.logger.info(self.name+" not enabled")
             raise ValueError
-        if self.pc_connect:
-            if not resource.is_open:
-                resource.open()
-            while resource.in_waiting > 0:  # Clear Buffer
-                resource.readline()
-            resource.write((self.address+"MOD"+"\n\r").encode())  # Query Pump
-            time.sleep(0.2)
-            while resource.in_waiting > 0:
-                if modestr.encode() in resource.readline():
-                    success = True
-            if not success:
+        if modestr.encode() not in await self._query("MOD", resource):  # Query Pump
+            if retry:
+                self.logger.debug("Error connecting: retrying")
+                await self.async_check_mode(modestr, resource, retry=False)
+            else:
                 self.logger.info("Failure Connecting to Pump")
                 raise RuntimeError
-        else:
-            if not self.controller.is_open:
-                self.controller.open()
-            while self.controller.in_waiting > 0:   # Clear Buffer
-                self.controller.read_check()
-            self.controller.write(("-"+self.address+"MOD"+"\n\r").encode())
-            time.sleep(0.2)
-            if self.controller.in_waiting == 0:
-                self.logger.debug("No responce: waiting")
-                time.sleep(0.4)
-            while self.controller.in_waiting > 0:
-                if modestr.encode() in self.controller.readline_check():
-                    success = True
-            if not success:
-                if retry:
-                    self.logger.debug("Error connecting: retrying")
-                    time.sleep(0.2)
-                    self.check_mode(modestr, retry=False)
-                else:
-                    self.logger.info("Failure Connecting to Pump")
-                    raise RuntimeError
-
-    def check_target_volume(self, resource=pumpserial, retry=True):
-        success = False
+
+    async def _query_value(self, command, resource, parse):
+        """send a query and parse the first line of the reply with a decimal point in it, or
+        return None if there is no such line"""
+        for answer in self._lines(await self._query(command, resource)):
+            if b"." in answer:
+                return parse(answer)
+        return None
+
+    async def async_check_target_volume(self, resource=pumpserial, retry=True):
         if not HPump.enabled:
             self.logger.info(self.name+" not enabled")
             raise ValueError
-        if self.pc_connect:
-            if not resource.is_open:
-                resource.open()
-            while resource.in_waiting > 0:  # Clear Buffer
-                resource.readline().decode()
-            resource.write((self.address+"TGT"+"\n\r").encode())  # Query Pump
-            time.sleep(0.2)
-            while resource.in_waiting > 0:
-                answer = (resource.readline())
-                if b"." in answer:
-                    value = float(answer)
-                    success = True
-
-        else:
-            if not self.controller.is_open:
-                self.controller.open()
-            while self.controller.in_waiting > 0:   # Clear Buffer
-                self.controller.read_check()
-            self.controller.write(("-"+self.address+"TGT"+"\n\r").encode())
-            time.sleep(0.2)
-            if self.controller.in_waiting == 0:
-                self.logger.debug("No responce: waiting")
-                time.sleep(0.4)
-            while self.controller.in_waiting > 0:
-                answer = (self.controller.readline_check())
-                if b"." in answer:
-                    value = float(answer)
-                    success = True
-        if not success:
+        value = await self._query_value("TGT", resource, float)
+        if value is None:
             if retry:
                 self.logger.debug("Error connecting: retrying")
-                time.sleep(0.2)
-                value = self.check_target_volume(retry=False)
+                value = await self.async_check_target_volume(resource, retry=False)
             else:
                 self.logger.info("Failure Connecting to Pump")
                 raise RuntimeError
-
         return value
 
-    def check_infuse_rate(self, resource=pumpserial, retry=True):
-        success = False
+    async def async_check_infuse_rate(self, resource=pumpserial, retry=True):
         if not HPump.enabled:
             self.logger.info(self.name+" not enabled")
             raise ValueError
-        if self.pc_connect:
-            if not resource.is_open:
-                resource.open()
-            while resource.in_waiting > 0:  # Clear Buffer
-                resource.readline()
-            resource.write((self.address+"RAT"+"\n\r").encode())  # Query Pump
-            time.sleep(0.2)
-            while resource.in_waiting > 0:
-                answer = (resource.readline())
-                if b"." in answer:
-                    value = float(answer[0:-7])
-                    success = True
-
-        else:
-            if not self.controller.is_open:
-                self.controller.open()
-            while self.controller.in_waiting > 0:   # Clear Buffer
-                self.controller.read_check()
-            self.controller.write(("-"+self.address+"RAT"+"\n\r").encode())
-            time.sleep(0.2)
-            if self.controller.in_waiting == 0:
-                self.logger.debug("No responce: waiting")
-                time.sleep(0.4)
-            while self.controller.in_waiting > 0:
-                answer = (self.controller.readline_check())
-                if b"." in answer:
-                    value = float(answer[0:-7])
-                    success = True
-        if not success:
+        value = await self._query_value("RAT", resource, lambda answer: float(answer[0:-7]))
+        if value is None:
             if retry:
-                value = self.check_infuse_rate(retry= False)
+                value = await self.async_check_infuse_rate(resource, retry=False)
             else:
                 self.logger.info("Failure Connecting to Pump")
                 raise RuntimeError
         return value
 
-    def check_refill_rate(self, resource=pumpserial, retry=True):
-        success = False
+    async def async_check_refill_rate(self, resource=pumpserial, retry=True):
         if not HPump.enabled:
             self.logger.info(self.name+" not enabled")
             raise ValueError
-        if self.pc_connect:
-            if not resource.is_open:
-                resource.open()
-            while resource.in_waiting > 0:  # Clear Buffer
-                resource.readline()
-            resource.write((self.address+"RFR"+"\n\r").encode())  # Query Pump
-            time.sleep(0.2)
-            while resource.in_waiting > 0:
-                answer = (resource.readline())
-                if b"." in answer:
-                    value = float(answer[0:-7])
-                    success = True
-        else:
-            if not self.controller.is_open:
-                self.controller.open()
-            while self.controller.in_waiting > 0:   # Clear Buffer
-                self.controller.read_check()
-            self.controller.write(("-"+self.address+"RFR"+"\n\r").encode())
-            time.sleep(0.2)
-            if self.controller.in_waiting == 0:
-                self.logger.debug("No responce: waiting")
-                time.sleep(0.4)
-            while self.controller.in_waiting > 0:
-                answer = (self.controller.readline_check())
-                if b"." in answer:
-                    value = float(answer[0:-7])
-                    success = True
-        if not success:
+        value = await self._query_value("RFR", resource, lambda answer: float(answer[0:-7]))
+        if value is None:
             if retry:
                 self.logger.debug("Error connecting: retrying")
-                time.sleep(0.2)
-                value = self.check_refill_rate(retry=False)
+                value = await self.async_check_refill_rate(resource, retry=False)
             else:
                 self.logger.info("Failure Connecting to Pump")
                 raise RuntimeError
         return value
 
-    def get_delivered_volume(self, resource=pumpserial, retry=True):
-        success = False
+    async def async_get_delivered_volume(self, resource=pumpserial, retry=True):
         if not HPump.enabled:
             self.logger.info(self.name+" not enabled")
             raise ValueError
-        if self.pc_connect:
-            if not resource.is_open:
-                resource.open()
-            while resource.in_waiting > 0:  # Clear Buffer
-                resource.readline().decode()
-            resource.write((self.address+"DEL"+"\n\r").encode())  # Query Pump
-            time.sleep(0.2)
-            while resource.in_waiting > 0:
-                answer = (resource.readline())
-                if b"." in answer:
-                    value = float(answer)
-                    success = True
-        else:
-            if not self.controller.is_open:
-                self.controller.open()
-            while self.controller.in_waiting > 0:   # Clear Buffer
-                self.controller.read_check()
-            self.controller.write(("-"+self.address+"DEL"+"\n\r").encode())
-            time.sleep(0.2)
-            if self.controller.in_waiting == 0:
-                self.logger.debug("No responce: waiting")
-                time.sleep(0.4)
-            while self.controller.in_waiting > 0:
-                answer = (self.controller.readline_check())
-                if b"." in answer:
-                    value = float(answer)
-                    success = True
-        if not success:
+        value = await self._query_value("DEL", resource, float)
+        if value is None:
             if retry:
                 self.logger.debug("Error connecting: retrying")
-                time.sleep(0.2)
-                value = self.get_delivered_volume(retry=False)
+                value = await self.async_get_delivered_volume(resource, retry=False)
             else:
                 self.logger.info("Failure Connecting to Pump")
                 raise RuntimeError
         self.logger.info("Delivered "+str(value))
         return value
 
-    def stop(self, resource=pumpserial):
-        with self._lock:
-            if not HPump.enabled:
-                self.logger.info(self.name+" not enabled")
-                return  # not raising error so that the remaining of the stop function isnt dumped
-            if self.pc_connect:
-                if not resource.is_open:
-                    resource.open()
-                resource.write(("\n\r").encode())
+    async def async_stop(self, resource=pumpserial):
+        if not HPump.enabled:
+            self.logger.info(self.name+" not enabled")
+            return  # not raising error so that the remaining of the stop function isnt dumped
+        transport = self._transport(resource)
+        async with transport.lock:
+            await transport.write(("\n\r" if self.pc_connect else "-\n\r").encode())
+        # nothing answers to say whether it stopped, so it isn't known until the next reading
+        self.state.command(running=None)
+
+    start_pump = synchronous(async_start_pump)
+    stop_pump = synchronous(async_stop_pump)
+    set_infuse_rate = synchronous(async_set_infuse_rate)
+    set_refill_rate = synchronous(async_set_refill_rate)
+    set_flow_rate = synchronous(async_set_flow_rate)
+    send_command = synchronous(async_send_command)
+    infuse = synchronous(async_infuse)
+    refill = synchronous(async_refill)
+    reverse = synchronous(async_reverse)
+    set_mode_pump = synchronous(async_set_mode_pump)
+    set_mode_vol = synchronous(async_set_mode_vol)
+    set_mode_progam = synchronous(async_set_mode_progam)
+    set_target_vol = synchronous(async_set_target_vol)
+    status = synchronous(async_status)
+    is_running = synchronous(async_is_running)
+    refresh = synchronous(async_refresh)
+    infuse_volume = synchronous(async_infuse_volume)
+    refill_volume = synchronous(async_refill_volume)
+    check_direction = synchronous(async_check_direction)
+    check_mode = synchronous(async_check_mode)
+    check_target_volume = synchronous(async_check_target_volume)
+    check_infuse_rate = synchronous(async_check_infuse_rate)
+    check_refill_rate = synchronous(async_check_refill_rate)
+    get_delivered_volume = synchronous(async_get_delivered_volume)
+    stop = synchronous(async_stop)
 
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
+    def close(self):
+        run(transport_for(HPump.pumpserial).close())
 
-                self.controller.write(("-\n\r").encode())
 
-    def close(self):
-        if HPump.pumpserial.is_open:
-            HPump.pumpserial.close()
+async def async_pumps_running(pumps, resource=HPump.pumpserial, cached=False):
+    """whether each of the pumps is running, asking them all at once. If cached, pumps whose
+    state a PumpMonitor keeps up to date aren't asked, unless it doesn't know"""
+    async def running(pump):
+        if cached and pump.state.fresh() and pump.state.running is not None:
+            return pump.state.running
+        return await pump.async_is_running(resource)
+    return await asyncio.gather(*(running(pump) for pump in pumps))
+
+
+def pumps_running(pumps, resource=HPump.pumpserial, cached=False):
+    return run(async_pumps_running(pumps, resource, cached))
 
 
 class Rheodyne:
     """Class to control Rheodyne valves."""
 
+    RESPONSE_TIMEOUT = 0.1  # seconds to wait for the valve to answer, as long as the port's read timeout
+
     def __init__(self, name="Rheodyne", valvetype=0, position=0, pc_connect=True, address_I2C=-1, enabled=False, logger=[], hardware_configuration="", lock=None):
         self.name = name                      # valve nickname
         self.valvetype = valvetype            # int to mark max number of valve possions 2 or 6
@@ -848,11 +675,10 @@ class Rheodyne:
         # set port throughuh another function.
         self.instrument_type = "Rheodyne"
         self.hardware_configuration = hardware_configuration
-        self._lock = lock
 
     def set_port(self, port):  # will keep set port accross different classes
         if self.serial_object.is_open:
-            self.serial_object.close()
+            run(transport_for(self.serial_object).close())
         self.serial_object.port = port
         self.enabled = True
         self.pc_connect = True
@@ -873,97 +699,76 @@ class Rheodyne:
             self.address_I2C = address
 
     # """Now the function to actually control de valve."""
-    def switchvalve(self, position, attempts=0, max_attemps=3):  # Lets take int
+    async def async_switchvalve(self, position, attempts=0, max_attemps=3):  # Lets take int
         # this function wont work for positions>10
         # to add that functionality the number must be
         # in hex format => P##  so 10 P0A
         # Need errror handler to check position is integer and less than valve type
-        with self._lock:
-            if attempts > max_attemps:
-                self.logger.info("Error Switching "+self.name)
-                raise RuntimeError  # error valve didnt acknowledge
-            if not self.enabled:
-                self.logger.info(self.name+" not enabled")
-                raise ValueError
-            if self.pc_connect:
-                if not self.serial_object.is_open:
-                    self.serial_object.open()
-                self.serial_object.write(("P0"+str(position)+"\n\r").encode())
-                self.serial_object.read()
-                # self.serial_object.close()           #Trying to be polite and leaving the ports closed
-
-            elif self.address_I2C == -1:
-                self.logger.info(self.name+"I2C Address not set")
-                raise ValueError
-                return -1
-            else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("P%03i%i" % (self.address_I2C, position)).encode())
-                self.controller.read_check()
-
-            # check if switched
-            time.sleep(0.1)
-            if int(self.statuscheck()) == position:  # pump returns this if command acknowledged
-                self.position = position
-                self.logger.info(self.name+" switched to "+str(position))
-                return 0    # Valve acknowledged commsnd
-            else:
-                self.logger.debug("Switching valve %s failed; retrying %i" % (self.name, attempts))
-                self.switchvalve(position, attempts+1, max_attemps)
+        if attempts > max_attemps:
+            self.logger.info("Error Switching "+self.name)
+            raise RuntimeError  # error valve didnt acknowledge
+        if not self.enabled:
+            self.logger.info(self.name+" not enabled")
+            raise ValueError
+        if self.pc_connect:
+            transport = transport_for(self.serial_object)
+            command = "P0"+str(position)+"\n\r"
+        elif self.address_I2C == -1:
+            self.logger.info(self.name+"I2C Address not set")
+            raise ValueError
+        else:
+            transport = transport_for(self.controller)
+            command = "P%03i%i" % (self.address_I2C, position)
+        async with transport.lock:
+            await transport.write(command.encode())
+            await transport.read(1, Rheodyne.RESPONSE_TIMEOUT)
+
+        # check if switched
+        await asyncio.sleep(0.1)
+        if int(await self.async_statuscheck()) == position:  # pump returns this if command acknowledged
+            self.position = position
+            self.logger.info(self.name+" switched to "+str(position))
+            return 0    # Valve acknowledged commsnd
+        else:
+            self.logger.debug("Switching valve %s failed; retrying %i" % (self.name, attempts))
+            return await self.async_switchvalve(position, attempts+1, max_attemps)
 
     # Todo maybe incorporate status check to confirm valve is in the right position
-    def statuscheck(self, iter=0):
+    async def async_statuscheck(self, iter=0):
         maxiterations = 10
         if not self.enabled:
             self.logger.info(self.name+" not enabled")
             raise ValueError
 
         if self.pc_connect:
-            if not self.serial_object.is_open:
-                self.serial_object.open()
-            while self.serial_object.in_waiting > 0:
-                self.serial_object.read()
-            self.serial_object.write("S\n\r".encode())
-            ans = self.serial_object.read(2).decode()
-            self.serial_object.read()
-            while ans not in ["01", "02", "03", "04", "05", "06"]:
-                self.logger.debug("Rechecking Valve: iteration " + str(iter+1))
-                if iter == maxiterations:
-                    self.logger.info("Error Checking Valve Status for "+self.name)
-                    raise RuntimeError
-                time.sleep(0.2)
-                ans = self.statuscheck(iter+1)
-            return ans   # returns valve position
-            # TODO: add error handlers
+            transport = transport_for(self.serial_object)
+            async with transport.lock:
+                transport.discard_input()
+                await transport.write("S\n\r".encode())
+                ans = (await transport.read(2, Rheodyne.RESPONSE_TIMEOUT)).decode()
+                await transport.read(1, Rheodyne.RESPONSE_TIMEOUT)
+            positions = ["01", "02", "03", "04", "05", "06"]
         elif self.address_I2C == -1:
             self.logger.info("Error: I2C Address not set for "+self.name)
             raise ValueError
-            return
         else:
-            if not self.controller.is_open:
-                self.controller.open()
-            while self.controller.in_waiting > 0:
-                self.controller.read_check()
-            self.controller.write(("S%03i" % self.address_I2C).encode())
-            ans = self.controller.read_check().decode()  # need to ensure thwt buffer doesnt build up-> if so switch to readln
-            while ans not in ["1", "2", "3", "4", "5", "6"]:
-                self.logger.debug("Rechecking Valve: iteration " + str(iter+1))
-                if iter == maxiterations:
-                    self.logger.info("Error Checking Valve Status for "+self.name)
-                    raise RuntimeError
-                time.sleep(0.2)
-                ans = self.statuscheck(iter+1)
-            return ans   # returns valve position
-        # TODO: add error handlers
-
-            self.controller.write(("S%03i" % self.address_I2C).encode())
-            ans = self.controller.read_check()  # need to ensure thwt buffer doesnt build up-> if so switch to readln
-            # self.controller.close()
-        return int(ans)   # returns valve position
+            transport = transport_for(self.controller)
+            async with transport.lock:
+                transport.discard_input()
+                await transport.write(("S%03i" % self.address_I2C).encode())
+                ans = (await transport.read(1, Rheodyne.RESPONSE_TIMEOUT)).decode()
+            positions = ["1", "2", "3", "4", "5", "6"]
+        while ans not in positions:
+            self.logger.debug("Rechecking Valve: iteration " + str(iter+1))
+            if iter == maxiterations:
+                self.logger.info("Error Checking Valve Status for "+self.name)
+                raise RuntimeError
+            await asyncio.sleep(0.2)
+            ans = await self.async_statuscheck(iter+1)
+        return ans   # returns valve position
         # TODO: add error handlers
 
-    def seti2caddress(self, address: int):  # Address is in int format
+    async def async_seti2caddress(self, address: int):  # Address is in int format
         # Addres needs to be even int
         if not self.enabled:
             self.logger.info(self.name+" not enabled")
@@ -971,32 +776,36 @@ class Rheodyne:
         if address % 2 == 0:
             if self.pc_connect:
                 s = hex(address)
-                if not self.serial_object.is_open:
-                    self.serial_object.open()
-                self.serial_object.write(("N"+s[2:4]+"\n\r").encode())
+                transport = transport_for(self.serial_object)
+                async with transport.lock:
+                    await transport.write(("N"+s[2:4]+"\n\r").encode())
                 return 0
             elif self.address_I2C == -1:
                 return -1
             else:
-                if not self.controller.is_open:
-                    self.controller.open()
-                self.controller.write(("N%03i%03i" % (self.address_I2C, address)).encode())
-                while(self.controller.in_waiting > 0):
-                    print(self.controller.readline_check())
-                # self.controller.close()
+                transport = transport_for(self.controller)
+                async with transport.lock:
+                    await transport.write(("N%03i%03i" % (self.address_I2C, address)).encode())
+                    answer = await transport.read_all(Rheodyne.RESPONSE_TIMEOUT)
+                for line in answer.decode(errors='replace').splitlines():
+                    self.logger.debug(line)
                 return 0
         else:
             return -1  # TODO: Error because value is not even
-        return  # ans
+
+    switchvalve = synchronous(async_switchvalve)
+    statuscheck = synchronous(async_statuscheck)
+    seti2caddress = synchronous(async_seti2caddress)
 
     def close(self):
-        if self.serial_object.is_open:
-            self.serial_object.close()
+        run(transport_for(self.serial_object).close())
 
 
 class VICI:
     """Class to control a VICI valve."""
 
+    RESPONSE_TIMEOUT = 0.4  # seconds to wait for the valve to answer
+
     def __init__(self, name="VICI", address="", enabled=False, pc_connect=True, position=0, logger=[], hardware_configuration="", lock=None):
         self.name = name
         self.address = address
@@ -1009,11 +818,10 @@ class VICI:
         self.serialobject = self.serialobjectPC
         self.instrument_type = "VICI"
         self.hardware_configuration = hardware_configuration
-        self._lock=lock
 
     def set_port(self, port):
         if self.serialobject.is_open:
-            self.serialobject.close()
+            run(transport_for(self.serialobject).close())
         self.serialobject = self.serialobjectPC
         self.serialobject.port = port
         self.enabled = True
@@ -1024,57 +832,55 @@ class VICI:
 
     def set_to_controller(self, controller):
         if self.serialobject.is_open:
-            self.serialobject.close()
+            run(transport_for(self.serialobject).close())
         self.pc_connect = False
         self.serialobject = controller
         self.enabled = controller.enabled
         self.ControllerKey = "+"
         self.logger.info(self.name+" set to Microntroller")
 
-    def switchvalve(self, position):
-        with self._lock:
-            success = False
-            if isinstance(position, int):
-                if position == 0:
-                    position = 'A'
-                elif position == 1:
-                    position = 'B'
-                else:
-                    self.logger.info("Value not accepted "+str(position))
-                    raise ValueError
-            if not self.enabled:
-                self.logger.info(self.name+" not set up, switching ignored")
+    async def async_switchvalve(self, position):
+        if isinstance(position, int):
+            if position == 0:
+                position = 'A'
+            elif position == 1:
+                position = 'B'
+            else:
+                self.logger.info("Value not accepted "+str(position))
                 raise ValueError
-            if not self.serialobject.is_open:
-                self.serialobject.open()
-            commandtosend = self.ControllerKey+"GO"+position+"\r"
-            while self.serialobject.in_waiting > 0:  # Cler Buffer
-                self.serialobject.readline()
-            self.serialobject.write(commandtosend.encode())
-            time.sleep(0.2)
-            if self.serialobject.in_waiting == 0:  # give extra time
-                time.sleep(0.2)
-            while self.serialobject.in_waiting > 0:  # Read in response
-                if position in self.serialobject.readline().decode():
-                    self.logger.info(self.name+" switched to "+position)
-                    success = True
-            if not success:
-                self.logger.info("Error switching "+self.name)
-                raise RuntimeError
+        if not self.enabled:
+            self.logger.info(self.name+" not set up, switching ignored")
+            raise ValueError
+        commandtosend = self.ControllerKey+"GO"+position+"\r"
+        transport = transport_for(self.serialobject)
+        async with transport.lock:
+            transport.discard_input()
+            await transport.write(commandtosend.encode())
+            # Read in response, up to the end of the line with the position in it
+            answer = await transport.read_until(re.compile(re.escape(position.encode()) + rb"[^\r\n]*[\r\n]"), VICI.RESPONSE_TIMEOUT)
+        if position.encode() in answer:
+            self.logger.info(self.name+" switched to "+position)
+        else:
+            self.logger.info("Error switching "+self.name)
+            raise RuntimeError
 
-    def currentposition(self):
+    async def async_currentposition(self):
         if not self.enabled:
             self.logger.info(self.name+" not set up, Query ignored")
             raise ValueError
 
-        if not self.serialobject.is_open:
-            self.serialobject.open()
         commandtosend = self.ControllerKey+"CP"+"\r"
-        self.serialobject.write(commandtosend.encode())
+        transport = transport_for(self.serialobject)
+        async with transport.lock:
+            transport.discard_input()
+            await transport.write(commandtosend.encode())
+            answer = await transport.read_until(re.compile(rb"[\r\n]"), VICI.RESPONSE_TIMEOUT)
 
         self.logger.info(self.name+" Position Query ")
-        while self.serial_object.in_waiting > 0:
-            self.logger.info(self.serial_object.readline().decode())
+        self.logger.info(answer.decode(errors='replace').strip())
+
+    switchvalve = synchronous(async_switchvalve)
+    currentposition = synchronous(async_currentposition)
 
     def change_values(self, address, name):
         if self.name != name:
@@ -1082,5 +888,5 @@ class VICI:
             self.name = name
 
     def close(self):
-        if self.serial_object.is_open:
-            self.serial_object.close()
+        if self.pc_connect:
+            run(transport_for(self.serialobject).close())
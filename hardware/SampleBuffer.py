@@ -0,0 +1,100 @@
+"""A fixed-capacity, NumPy-backed ring buffer for streaming instrument samples.
+
+Exactly one thread (the acquisition thread) writes into the buffer. Every consumer
+keeps its own read cursor and asks for everything written since then, so readers
+never block the writer and never need a lock.
+"""
+import numpy as np
+
+
+class SampleRingBuffer:
+    """Preallocated columnar storage: one float64 column per data column, plus a write cursor.
+
+    The write cursor counts every row ever written (it never wraps), so a consumer can
+    call read_since(cursor) and get back (new_cursor, block), where block is a
+    (number of columns) x (number of new rows) array. If a consumer falls more than
+    `capacity` rows behind, the oldest rows are gone; read_since silently skips them
+    and adds the number of lost rows to `overruns`."""
+    DEFAULT_CAPACITY = 2**16  # about 5 minutes of data at 200 Hz
+
+    def __init__(self, columns, capacity=DEFAULT_CAPACITY):
+        self.columns = list(columns)
+        self.column_index = {name: i for i, name in enumerate(self.columns)}
+        self.capacity = int(capacity)
+        if self.capacity <= 0:
+            raise ValueError("capacity must be positive, not %s" % capacity)
+        self._data = np.full((len(self.columns), self.capacity), np.nan)
+        self._cursor = 0
+        self.overruns = 0
+
+    @property
+    def cursor(self):
+        """the total number of rows ever written. Rows before this index are complete."""
+        return self._cursor
+
+    def __len__(self):
+        """the number of rows currently held (at most the capacity)"""
+        return min(self._cursor, self.capacity)
+
+    def append(self, row):
+        """write a single row (anything with one value per column). Producer thread only."""
+        self._data[:, self._cursor % self.capacity] = row
+        # publish the row only after it is completely written
+        self._cursor += 1
+
+    def append_block(self, block):
+        """write many rows at once. block must be (number of columns) x (number of rows).
+        Producer thread only."""
+        block = np.asarray(block, dtype=np.float64)
+        n = block.shape[1]
+        if n == 0:
+            return
+        start = self._cursor
+        if n > self.capacity:
+            # only the newest rows can survive anyway
+            start += n - self.capacity
+            block = block[:, -self.capacity:]
+        i = start % self.capacity
+        m = block.shape[1]
+        first = min(m, self.capacity - i)
+        self._data[:, i:i+first] = block[:, :first]
+        if first < m:
+            self._data[:, :m-first] = block[:, first:]
+        self._cursor += n
+
+    def read_since(self, cursor):
+        """return (new_cursor, block) with every row written since `cursor`.
+        block is a fresh (number of columns) x (number of rows) array that the caller owns.
+        Pass the returned cursor back in next time."""
+        end = self._cursor
+        start = max(cursor, end - self.capacity)
+        if start > cursor:
+            self.overruns += start - cursor
+        if start >= end:
+            return max(cursor, end), np.empty((len(self.columns), 0))
+        block = self._copy_range(start, end)
+        # the writer may have lapped us while we were copying; drop anything it overwrote
+        oldest_valid = self._cursor - self.capacity
+        if oldest_valid > start:
+            self.overruns += oldest_valid - start
+            block = block[:, oldest_valid - start:]
+        return end, block
+
+    def latest(self):
+        """return a copy of the most recently written row, or None if nothing has been written"""
+        end = self._cursor
+        if end == 0:
+            return None
+        return self._data[:, (end - 1) % self.capacity].copy()
+
+    def rows_as_dicts(self, block):
+        """convert a block from read_since into a list of dicts keyed by column name.
+        Only for callers that still want the old one-dict-per-sample format."""
+        return [dict(zip(self.columns, row)) for row in block.T.tolist()]
+
+    def _copy_range(self, start, end):
+        i = start % self.capacity
+        n = end - start
+        if i + n <= self.capacity:
+            return self._data[:, i:i+n].copy()
+        return np.concatenate((self._data[:, i:], self._data[:, :n - (self.capacity - i)]), axis=1)
@@ -0,0 +1,522 @@
+"""Simulated serial instruments on pseudo-terminals, for running SAXSDrivers without the beamline.
+
+Each simulated instrument answers the commands SAXSDrivers sends it the way the instrument
+does, and a PseudoTerminal puts one on a Linux pseudo-terminal, whose name is given to the
+driver as its port, so the drivers run unchanged, through pyserial and the serial transport:
+
+- HarvardPumps: a chain of Harvard pumps. Commands are an address, a command (RUN, STP,
+  DEL, TGT, RAT, RFR, DIR, MOD...) and a carriage return; every reply ends with the pump's
+  address and its prompt: ':' stopped, '>' infusing, '<' refilling or '*' paused.
+- RheodyneValve: an MX Series II valve. P0n switches it to position n, S answers its
+  position as two hex digits, and both end with a carriage return.
+- VICIValve: a two-position VICI actuator. GOA/GOB move it and CP asks where it is.
+- SimulatedController: the microcontroller (Microcontroller/saxscontroller.ino). It drives
+  Rheodynes over I2C (Pxxxn, Sxxx, Nxxxyyy and the I scan), passes a command starting with '-'
+  on to the pump chain and one starting with '+' on to the VICI, and, like the firmware,
+  sends back whatever the instrument has answered 100 ms later.
+
+Every reply comes `delay` seconds after the command, and the valves take `switch_time`
+seconds to move. time_buffer_sample_buffer runs the buffer-sample-buffer sequence of the GUI
+on a SimulatedBench and times each step; run this module to do that for both ways of
+connecting the instruments.
+"""
+import heapq
+import itertools
+import logging
+import os
+import queue
+import re
+import select
+import threading
+import time
+import tty
+
+
+class _Outbox:
+    """Hands data to write() when it falls due, in order, from a thread of its own."""
+
+    def __init__(self, write, name):
+        self.write = write
+        self._queue = []  # heap of (monotonic time due, sequence number, data)
+        self._sequence = itertools.count()
+        self._changed = threading.Condition()
+        self._closed = False
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def send(self, data, delay=0):
+        with self._changed:
+            heapq.heappush(self._queue, (time.monotonic() + delay, next(self._sequence), data))
+            self._changed.notify()
+
+    def close(self):
+        with self._changed:
+            self._closed = True
+            self._changed.notify()
+        self.thread.join()
+
+    def _run(self):
+        with self._changed:
+            while not self._closed:
+                if not self._queue:
+                    self._changed.wait()
+                    continue
+                wait = self._queue[0][0] - time.monotonic()
+                if wait > 0:
+                    self._changed.wait(wait)
+                    continue
+                self.write(heapq.heappop(self._queue)[2])
+
+
+class SimulatedDevice:
+    """An instrument on a serial line: bytes come in through receive(), and it answers
+    through send(), `delay` seconds later. Commands end with TERMINATOR; the line feed the
+    drivers send before it is ignored."""
+    TERMINATOR = b"\r"
+    DELAY = 0.01
+
+    def __init__(self, delay=DELAY):
+        self.delay = delay
+        self.commands = []  # every command received, in order
+        self._input = b""
+        self._output = None
+
+    def attach(self, output):
+        """send replies through output(data, delay)"""
+        self._output = output
+
+    def receive(self, data):
+        self._input += data
+        *commands, self._input = self._input.split(self.TERMINATOR)
+        for command in commands:
+            command = command.strip().decode(errors='replace')
+            self.commands.append(command)
+            self.handle(command)
+
+    def handle(self, command):
+        raise NotImplementedError
+
+    def send(self, data, delay=None):
+        if self._output is not None:
+            self._output(data.encode() if isinstance(data, str) else data, self.delay if delay is None else delay)
+
+
+class PseudoTerminal:
+    """A Linux pseudo-terminal with a simulated device on the other end. Give `name` to a
+    driver as its port."""
+
+    def __init__(self, device):
+        self.device = device
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        # the slave end stays open here, so the device stays connected while a driver closes
+        # and reopens the port
+        self.name = os.ttyname(self.slave)
+        self._outbox = _Outbox(self._write, 'Simulated %s' % type(device).__name__)
+        device.attach(self._outbox.send)
+        self._stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._read_forever, name='Simulated %s reader' % type(device).__name__, daemon=True)
+        self.thread.start()
+
+    def _write(self, data):
+        try:
+            os.write(self.master, data)
+        except OSError:
+            pass  # closed
+
+    def _read_forever(self):
+        while not self._stop_event.is_set():
+            if not select.select([self.master], [], [], 0.1)[0]:
+                continue
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                break
+            if data:
+                self.device.receive(data)
+
+    def close(self):
+        self._stop_event.set()
+        self.thread.join()
+        self._outbox.close()
+        if hasattr(self.device, 'close'):
+            self.device.close()
+        os.close(self.slave)
+        os.close(self.master)
+
+
+class SimulatedPump:
+    """One Harvard pump. Rates are in µL/min, volumes in ml."""
+    RATE_UNITS = {'UM': 1, 'UH': 1 / 60, 'MM': 1000, 'MH': 1000 / 60}  # to µL/min
+    MODES = {'PMP': 'PUMP', 'VOL': 'VOL', 'PGM': 'PROG'}
+
+    def __init__(self):
+        self.mode = 'PUMP'
+        self.infusing = True
+        self.infuse_rate = 0.0
+        self.refill_rate = 0.0
+        self.target = 0.0
+        self.running = False
+        self.paused = False
+        self._delivered = 0.0  # up to _since
+        self._since = time.monotonic()
+
+    def delivered(self):
+        """the volume delivered since the pump was started. In VOL mode it stops at the target"""
+        volume = self._delivered
+        if self.running:
+            now = time.monotonic()
+            volume += (self.infuse_rate if self.infusing else self.refill_rate) / 60000 * (now - self._since)
+            if self.mode == 'VOL' and volume >= self.target:
+                volume = self.target
+                self.running = False
+            self._delivered = volume
+            self._since = now
+        return volume
+
+    def prompt(self):
+        if self.running:
+            return '>' if self.infusing else '<'
+        return '*' if self.paused else ':'
+
+    def command(self, command):
+        """carry out a command and return the data it answers with, or None"""
+        self.delivered()
+        match = re.match(r"(RAT|RFR)([0-9.]+)(UM|UH|MM|MH)$", command)
+        if command == "":
+            return None
+        elif command == "RUN":
+            if not self.paused:
+                self._delivered = 0.0
+            self._since = time.monotonic()
+            self.running = True
+            self.paused = False
+        elif command == "STP":
+            # stopping a running pump pauses it; stopping it again stops it
+            self.paused = self.running
+            self.running = False
+        elif command == "DEL":
+            return "%.5f" % self._delivered
+        elif command in ("RAT", "RFR"):
+            return "%.4f ul/m" % (self.infuse_rate if command == "RAT" else self.refill_rate)
+        elif match:
+            rate = float(match.group(2)) * SimulatedPump.RATE_UNITS[match.group(3)]
+            if match.group(1) == "RAT":
+                self.infuse_rate = rate
+            else:
+                self.refill_rate = rate
+        elif command == "TGT":
+            return "%.4f" % self.target
+        elif command.startswith("TGT"):
+            try:
+                self.target = float(command[3:])
+            except ValueError:
+                return "OOR"
+        elif command == "DIR":
+            return "INFUSE" if self.infusing else "REFILL"
+        elif command in ("DIRINF", "DIRREF", "DIRREV"):
+            self.infusing = {"DIRINF": True, "DIRREF": False, "DIRREV": not self.infusing}[command]
+        elif command == "MOD":
+            return self.mode
+        elif command.startswith("MOD ") and command[4:] in SimulatedPump.MODES:
+            self.mode = SimulatedPump.MODES[command[4:]]
+        else:
+            return "?"
+        return None
+
+
+class HarvardPumps(SimulatedDevice):
+    """A chain of Harvard pumps at the given addresses.
+
+    A command with no address goes to pump 0, and a bare carriage return stops every pump
+    without an answer, as the controller's emergency stop relies on."""
+
+    def __init__(self, addresses=(0,), delay=SimulatedDevice.DELAY):
+        super().__init__(delay)
+        self.pumps = {address: SimulatedPump() for address in addresses}
+        self._lock = threading.Lock()
+
+    def handle(self, command):
+        address, command = re.match(r"([0-9]*)(.*)$", command).groups()
+        with self._lock:
+            if address == "" and command == "":
+                for pump in self.pumps.values():
+                    pump.delivered()
+                    pump.running = False
+                return
+            address = int(address or 0)
+            pump = self.pumps.get(address)
+            if pump is None:
+                return  # nothing at that address to answer
+            data = pump.command(command)
+            prompt = pump.prompt()
+        self.send("\r\n" + (data + "\r\n" if data is not None else "") + "%d%s" % (address, prompt))
+
+
+class RheodyneValve(SimulatedDevice):
+    """A Rheodyne MX Series II valve with `positions` positions, at I2C address `i2c_address`.
+    While it is moving it answers a position it doesn't have (99)."""
+    SWITCH_TIME = 0.1
+    MOVING = 99
+
+    def __init__(self, positions=6, position=1, i2c_address=2, delay=SimulatedDevice.DELAY, switch_time=SWITCH_TIME):
+        super().__init__(delay)
+        self.positions = positions
+        self.i2c_address = i2c_address
+        self.switch_time = switch_time
+        self._position = position
+        self._target = position
+        self._arrives = -1
+
+    def position(self):
+        """where the valve is, or MOVING"""
+        if time.monotonic() < self._arrives:
+            return RheodyneValve.MOVING
+        self._position = self._target
+        return self._position
+
+    def switch(self, position):
+        """start moving to position; returns whether it is one the valve has"""
+        if not 1 <= position <= self.positions:
+            return False
+        if position != self.position():
+            self._target = position
+            self._arrives = time.monotonic() + self.switch_time
+        return True
+
+    def handle(self, command):
+        if command.startswith("P"):
+            try:
+                position = int(command[1:], 16)
+            except ValueError:
+                return
+            if self.switch(position):
+                self.send("\r")
+        elif command == "S":
+            self.send("%02X\r" % self.position())
+        elif command.startswith("N"):
+            self.i2c_address = int(command[1:], 16)
+            self.send("\r")
+
+
+class VICIValve(SimulatedDevice):
+    """A two-position VICI actuator, in position A or B. It answers GOA/GOB with the position
+    it is going to, and CP with the one it is at."""
+    SWITCH_TIME = 0.05
+
+    def __init__(self, position='A', delay=SimulatedDevice.DELAY, switch_time=SWITCH_TIME):
+        super().__init__(delay)
+        self.switch_time = switch_time
+        self._position = position
+        self._target = position
+        self._arrives = -1
+
+    def position(self):
+        if time.monotonic() >= self._arrives:
+            self._position = self._target
+        return self._position
+
+    def handle(self, command):
+        command = command.lstrip("0123456789")  # an actuator's ID, if it has one
+        if command in ("GOA", "GOB"):
+            if command[2] != self.position():
+                self._target = command[2]
+                self._arrives = time.monotonic() + self.switch_time
+            self.send("Position is = %s\r" % command[2])
+        elif command == "CP":
+            self.send("Position is = %s\r" % self.position())
+
+
+class SimulatedController(SimulatedDevice):
+    """The microcontroller, with the pump chain on its first serial line, the VICI on its
+    second and Rheodynes on its I2C bus (at their i2c_address).
+
+    It carries out one command at a time, each being whatever has come in when it gets to
+    it, as the firmware does. The pump commands without the '-' framing (R, T, V, E, L, Q, A)
+    aren't simulated, as SAXSDrivers doesn't send them."""
+    FORWARD_DELAY = 0.1  # seconds the firmware waits before passing back an instrument's answer
+    SCAN_PAUSE = 5  # seconds the firmware waits after an I2C scan
+
+    def __init__(self, pumps=None, vici=None, rheodynes=(), delay=0):
+        super().__init__(delay)
+        self.pumps = pumps
+        self.vici = vici
+        self.rheodynes = list(rheodynes)
+        self._lines = {}  # device -> bytes it has answered and the firmware hasn't passed back yet
+        self._lines_lock = threading.Lock()
+        self._outboxes = []
+        for device in (pumps, vici):
+            if device is not None:
+                self._lines[device] = bytearray()
+                outbox = _Outbox(lambda data, device=device: self._collect(device, data), 'Simulated controller line')
+                device.attach(outbox.send)
+                self._outboxes.append(outbox)
+        self._queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='Simulated controller', daemon=True)
+        self.thread.start()
+
+    def receive(self, data):
+        self._queue.put(data)
+
+    def close(self):
+        self._queue.put(None)
+        self.thread.join()
+        for outbox in self._outboxes:
+            outbox.close()
+
+    def _collect(self, device, data):
+        with self._lines_lock:
+            self._lines[device] += data
+
+    def _answer_of(self, device):
+        with self._lines_lock:
+            answer = bytes(self._lines[device])
+            self._lines[device].clear()
+        return answer
+
+    def _rheodyne(self, address):
+        for valve in self.rheodynes:
+            if valve.i2c_address == address:
+                return valve
+        return None
+
+    def _println(self, value):
+        self.send("%s\r\n" % value)
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            self.commands.append(data)
+            self._handle_bytes(data)
+
+    def _handle_bytes(self, data):
+        command, arguments = data[:1], data[1:]
+        if command in (b"P", b"S", b"N") and not re.match(rb"[0-9]{3}", arguments):
+            self._println(-1)
+        elif command == b"P":
+            valve = self._rheodyne(int(arguments[:3]))
+            position = arguments[3] - 48 if len(arguments) > 3 else -49
+            # Wire.endTransmission's result: 0 if the valve took it, 2 if nothing is at the address
+            self._println(0 if valve is not None and valve.switch(position) else 2)
+        elif command == b"S":
+            valve = self._rheodyne(int(arguments[:3]))
+            self._println(valve.position() if valve is not None else -1)
+        elif command == b"N":
+            valve = self._rheodyne(int(arguments[:3]))
+            new_address = int(arguments[3:6] or b"1")
+            if new_address % 2 == 0:
+                if valve is not None:
+                    valve.i2c_address = new_address
+                self._println("Address Changed")
+            else:
+                self._println("Address not acepted")
+        elif command == b"I":
+            self._println("Scanning...")
+            for valve in sorted(self.rheodynes, key=lambda valve: valve.i2c_address):
+                self._println("I2C device found at address 0x%02X  !" % (valve.i2c_address // 2))
+            self._println("done\n" if self.rheodynes else "No I2C devices found\n")
+            time.sleep(SimulatedController.SCAN_PAUSE)
+        elif command in (b"-", b"+"):
+            device = self.pumps if command == b"-" else self.vici
+            if device is not None:
+                device.receive(arguments)
+            time.sleep(SimulatedController.FORWARD_DELAY)
+            if device is not None:
+                self.send(self._answer_of(device))
+        elif command == b"!":
+            if self.pumps is not None:
+                self.pumps.receive(b"\r")
+                self.send(self._answer_of(self.pumps))
+        elif command not in (b"R", b"T", b"V", b"E", b"L", b"Q", b"A", b"F"):
+            self._println(-1)
+
+
+class SimulatedBench:
+    """The instruments of a buffer-sample-buffer run: the pump, the oil and loading valves
+    (Rheodynes) and the sample/buffer valve (the VICI). Either each is on a pseudo-terminal
+    of its own, or they all hang off a SimulatedController on one."""
+
+    def __init__(self, via_controller=False, pump_delay=SimulatedDevice.DELAY, valve_delay=SimulatedDevice.DELAY,
+                 rheodyne_switch_time=RheodyneValve.SWITCH_TIME, vici_switch_time=VICIValve.SWITCH_TIME):
+        self.via_controller = via_controller
+        self.pumps = HarvardPumps(delay=pump_delay)
+        self.oil_valve = RheodyneValve(i2c_address=2, delay=valve_delay, switch_time=rheodyne_switch_time)
+        self.loading_valve = RheodyneValve(i2c_address=4, delay=valve_delay, switch_time=rheodyne_switch_time)
+        self.sample_valve = VICIValve(delay=valve_delay, switch_time=vici_switch_time)
+        if via_controller:
+            self.controller = SimulatedController(self.pumps, self.sample_valve, (self.oil_valve, self.loading_valve))
+            self.terminals = {'controller': PseudoTerminal(self.controller)}
+        else:
+            self.controller = None
+            self.terminals = {name: PseudoTerminal(device) for name, device in
+                              (('pump', self.pumps), ('oil valve', self.oil_valve),
+                               ('loading valve', self.loading_valve), ('sample valve', self.sample_valve))}
+
+    def connect(self, logger=None):
+        """make the SAXSDrivers instruments and set them to the simulators. Returns the pump,
+        oil valve, sample valve and loading valve, and the SAXSController if there is one"""
+        from . import SAXSDrivers
+        logger = logger if logger is not None else logging.getLogger('python')
+        pump = SAXSDrivers.HPump(address=0, name="Pump", logger=logger)
+        oil_valve = SAXSDrivers.Rheodyne(name="Oil valve", address_I2C=self.oil_valve.i2c_address, logger=logger)
+        loading_valve = SAXSDrivers.Rheodyne(name="Loading valve", address_I2C=self.loading_valve.i2c_address, logger=logger)
+        sample_valve = SAXSDrivers.VICI(name="Sample valve", logger=logger)
+        controller = None
+        if self.via_controller:
+            controller = SAXSDrivers.SAXSController(logger=logger, timeout=0.1)
+            controller.set_port(self.terminals['controller'].name)
+            for instrument in (pump, oil_valve, loading_valve, sample_valve):
+                instrument.set_to_controller(controller)
+        else:
+            pump.set_port(self.terminals['pump'].name)
+            oil_valve.set_port(self.terminals['oil valve'].name)
+            loading_valve.set_port(self.terminals['loading valve'].name)
+            sample_valve.set_port(self.terminals['sample valve'].name)
+        return pump, oil_valve, sample_valve, loading_valve, controller
+
+    def close(self):
+        for terminal in self.terminals.values():
+            terminal.close()
+
+
+def time_buffer_sample_buffer(pump, oil_valve, sample_valve, loading_valve, volumes=(0.005, 0.005, 0.005), rate=600,
+                              oil_position=1, loading_position=1, timeout_margin=5):
+    """run the instrument steps of the GUI's buffer-sample-buffer (volumes in ml, rate in
+    µL/min) and return how long each took, as a list of (step, seconds)"""
+    timings = []
+
+    def timed(step, function, *args):
+        start = time.monotonic()
+        function(*args)
+        timings.append((step, time.monotonic() - start))
+
+    for phase, volume, sample_position in zip(("pre-buffer", "sample", "post-buffer"), volumes, (0, 1, 0)):
+        timed(phase + ": oil valve", oil_valve.switchvalve, oil_position)
+        timed(phase + ": sample valve", sample_valve.switchvalve, sample_position)
+        timed(phase + ": loading valve", loading_valve.switchvalve, loading_position)
+        timed(phase + ": start pump", pump.infuse_volume, volume, rate)
+        timed(phase + ": wait for pump", pump.wait_until_stopped, volume / rate * 60000 + timeout_margin)
+    return timings
+
+
+if __name__ == '__main__':
+    # time a buffer-sample-buffer through the drivers with each way of connecting the instruments
+    logging.basicConfig(level=logging.WARNING)
+    for via_controller in (False, True):
+        bench = SimulatedBench(via_controller=via_controller)
+        pump, oil_valve, sample_valve, loading_valve, controller = bench.connect()
+        try:
+            timings = time_buffer_sample_buffer(pump, oil_valve, sample_valve, loading_valve)
+        finally:
+            for instrument in (pump, oil_valve, sample_valve, loading_valve):
+                instrument.close()
+            if controller is not None:
+                from .SerialTransport import run, transport_for
+                run(transport_for(controller).close())
+            bench.close()
+        print("through the controller:" if via_controller else "on their own ports:")
+        for step, seconds in timings:
+            print("  %-30s %7.3f s" % (step, seconds))
+        print("  %-30s %7.3f s" % ("total", sum(seconds for _, seconds in timings)))
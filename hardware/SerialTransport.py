@@ -0,0 +1,199 @@
+"""asyncio transport for the serial instruments.
+
+All serial I/O runs on one asyncio event loop, on a thread of its own. Each port gets a
+SerialTransport: a reader thread that moves whatever comes in on the port into a buffer on
+the loop, and coroutines to write and to wait for replies. A lock per port keeps round trips
+on the same port from mixing, while instruments on different ports are driven at the same
+time. Waiting for a reply is a wait on the loop with a timeout, which can be cancelled,
+rather than a sleep. A port with a `wire_log` (a WireLog) has everything sent and received
+over it recorded there.
+
+The drivers in SAXSDrivers are written as coroutines (the async_* methods), and `synchronous`
+turns each into a blocking method with the old name, so the queue thread and the GUI can
+keep calling them as before.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import threading
+import serial
+
+_loop = None
+_loop_lock = threading.Lock()
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def io_loop():
+    """the event loop all serial I/O runs on, started on first use"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='SerialIO', daemon=True).start()
+        return _loop
+
+
+def run(coroutine, timeout=None):
+    """run a coroutine on the I/O loop and wait for its result. If timeout seconds pass first,
+    the coroutine is cancelled and TimeoutError raised"""
+    loop = io_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        coroutine.close()
+        raise RuntimeError("can't block the serial I/O loop waiting for itself; await the coroutine instead")
+    future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+
+def synchronous(coroutine_method):
+    """make a blocking version of a driver's coroutine method, for callers outside the I/O
+    loop. It calls the method by name, so subclasses overriding the coroutine get it too"""
+    @functools.wraps(coroutine_method)
+    def method(self, *args, **kwargs):
+        return run(getattr(self, coroutine_method.__name__)(*args, **kwargs))
+    return method
+
+
+def transport_for(port):
+    """the SerialTransport of a pyserial port, made on first use. Instruments sharing a port
+    (a pump chain, the controller) share its transport"""
+    with _transports_lock:
+        transport = _transports.get(id(port))
+        if transport is None or transport.serial is not port:
+            transport = _transports[id(port)] = SerialTransport(port, wire_log=getattr(port, 'wire_log', None))
+        return transport
+
+
+class SerialTransport:
+    """Streams over a pyserial port, driven from the I/O loop.
+
+    The port must have a read timeout, so that the reader thread can notice the transport
+    being closed. wire_log, if given, records every chunk of bytes written and read."""
+
+    def __init__(self, port, wire_log=None, errorlogger=None):
+        self.serial = port
+        self.wire_log = wire_log
+        self.errorlogger = errorlogger if errorlogger is not None else logging.getLogger('python')
+        self.loop = io_loop()
+        self._buffer = bytearray()
+        self._data_arrived = None
+        self._lock = None
+        self._stop_event = threading.Event()
+        self.closed = False
+        self.reader_thread = None
+
+    @property
+    def lock(self):
+        """an asyncio.Lock to hold for a whole round trip on the port"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def open(self):
+        """open the port if it isn't, and start reading from it"""
+        if not self.serial.is_open:
+            await self.loop.run_in_executor(None, self.serial.open)
+        self.closed = False
+        if self.reader_thread is None or not self.reader_thread.is_alive():
+            self._stop_event.clear()
+            self.reader_thread = threading.Thread(target=self._read_forever, name='SerialReader %s' % self.serial.port, daemon=True)
+            self.reader_thread.start()
+
+    async def close(self):
+        """stop reading and close the port"""
+        self._stop_event.set()
+        if self.reader_thread is not None:
+            await self.loop.run_in_executor(None, self.reader_thread.join)
+            self.reader_thread = None
+        if self.serial.is_open:
+            self.serial.close()
+        self._buffer.clear()
+        self.closed = True
+        if self._data_arrived is not None:
+            self._data_arrived.set()
+
+    def _read_forever(self):
+        while not self._stop_event.is_set():
+            try:
+                data = self.serial.read(max(self.serial.in_waiting, 1))
+            except (serial.SerialException, OSError, TypeError, AttributeError):
+                # the port was closed from under us
+                if not self._stop_event.is_set():
+                    self.errorlogger.exception("error reading from %s" % self.serial.port)
+                    if self.wire_log is not None:
+                        self.wire_log.dump("error reading from %s" % self.serial.port)
+                break
+            if data:
+                if self.wire_log is not None:
+                    self.wire_log.record('RX', data)
+                self.loop.call_soon_threadsafe(self._feed, data)
+
+    def _feed(self, data):
+        self._buffer += data
+        if self._data_arrived is not None:
+            self._data_arrived.set()
+
+    def discard_input(self):
+        """throw away everything received and not read yet"""
+        self._buffer.clear()
+
+    async def write(self, data):
+        await self.open()
+        if self.wire_log is not None:
+            self.wire_log.record('TX', data)
+        await self.loop.run_in_executor(None, self.serial.write, data)
+
+    async def take(self, ready):
+        """wait until ready(buffer) returns a number of bytes, then take those bytes from the
+        buffer. Only one coroutine can be waiting to take input at a time. Raises
+        SerialException if the transport is closed while waiting"""
+        while True:
+            if self.closed:
+                raise serial.SerialException("%s was closed" % self.serial.port)
+            end = ready(self._buffer)
+            if end is not None:
+                data = bytes(self._buffer[:end])
+                del self._buffer[:end]
+                return data
+            if self._data_arrived is None:
+                self._data_arrived = asyncio.Event()
+            self._data_arrived.clear()
+            await self._data_arrived.wait()
+
+    async def read_until(self, pattern, timeout):
+        """return the input up to the end of the first match of pattern (a compiled bytes
+        regex) as soon as it has come in, or everything that came in if timeout seconds pass
+        first"""
+        await self.open()
+
+        def ready(buffer):
+            match = pattern.search(buffer)
+            return match.end() if match else None
+        try:
+            return await asyncio.wait_for(self.take(ready), timeout)
+        except asyncio.TimeoutError:
+            return await self.take(len)
+
+    async def read_all(self, timeout):
+        """return everything that comes in within timeout seconds"""
+        await self.open()
+        await asyncio.sleep(timeout)
+        return await self.take(len)
+
+    async def read(self, size, timeout):
+        """return size bytes as soon as they have come in, or fewer if timeout seconds pass
+        first, like a pyserial read"""
+        await self.open()
+        try:
+            return await asyncio.wait_for(self.take(lambda buffer: size if len(buffer) >= size else None), timeout)
+        except asyncio.TimeoutError:
+            return await self.take(len)
@@ -0,0 +1,204 @@
+"""Append-only columnar storage for plotting a whole session of samples.
+
+Columns are kept in float64 arrays, so reading a column range is usually a view (no copying
+and no building of lists), and appending a block only touches the new rows. Each column's
+minimum and maximum are kept up to date as blocks arrive, so autoscaling a plot doesn't
+have to scan the whole history.
+
+If there is a time column, the store also keeps a sorted copy of it (the running maximum,
+so a clock that steps backwards can't break the order) to find the rows in a time window
+by binary search. Both plots of the GUI share one store and ask it for read-only views of
+the window they show, so nothing is copied or scanned to draw the latest scan.
+
+If a retention time is given, only the most recent samples are kept in memory. Older ones
+are spilled, a chunk at a time, to a memory-mapped file that is deleted when the store is
+closed, so memory stays flat over a multi-day beamtime while the whole session can still
+be read back.
+"""
+import collections
+import tempfile
+import numpy as np
+
+# All the state a reader needs, swapped in as a whole so that readers on other threads
+# always see a consistent picture. Rows [0, n_spilled) are in the spill file (one row of
+# all the columns per sample), rows [n_spilled, length) are columns of the hot array.
+# Both have one more column than the store: the time index, if there is one.
+_Snapshot = collections.namedtuple('_Snapshot', ['hot', 'spilled', 'n_spilled', 'length'])
+
+
+class TraceStore:
+    """A growable table of samples, appended to a block at a time.
+
+    If time_column is given, that column is stored relative to time_origin (e.g. seconds since
+    the display started) rather than as absolute time, which is what the plots want to show.
+    hot_seconds (which needs a time column) is how much of the most recent history to keep
+    in memory; None keeps everything in memory.
+
+    Only one thread may append. Other threads may read: each read sees every row that was
+    complete when it started."""
+    INITIAL_CAPACITY = 4096
+
+    def __init__(self, columns, time_column=None, time_origin=0.0, initial_capacity=INITIAL_CAPACITY, hot_seconds=None):
+        if hot_seconds is not None and time_column is None:
+            raise ValueError("keeping only recent samples in memory needs a time column")
+        self.columns = list(columns)
+        self.column_index = {name: i for i, name in enumerate(self.columns)}
+        self.time_column = time_column
+        self.time_origin = time_origin
+        self.hot_seconds = hot_seconds
+        # the time index, if any, is stored after the last column
+        self._width = len(self.columns) + (time_column is not None)
+        self._state = _Snapshot(np.empty((self._width, max(1, int(initial_capacity)))), None, 0, 0)
+        self._spill_file = None
+        self._latest_time = -np.inf
+        self._minimum = np.full(len(self.columns), np.nan)
+        self._maximum = np.full(len(self.columns), np.nan)
+
+    def __len__(self):
+        return self._state.length
+
+    @property
+    def n_spilled(self):
+        """how many of the oldest rows live on disk rather than in memory"""
+        return self._state.n_spilled
+
+    def append_block(self, block):
+        """append an (number of columns) x (number of rows) block of raw samples.
+        Returns the block as stored (with the time column shifted)"""
+        block = np.array(block, dtype=np.float64)  # our own copy, since we may shift the time column
+        n = block.shape[1]
+        if n == 0:
+            return block
+        if self.time_column is not None:
+            times = block[self.column_index[self.time_column]]
+            times -= self.time_origin
+            # fmax skips NaN times, so they don't poison the index
+            time_index = np.fmax.accumulate(np.concatenate(([self._latest_time], times)))[1:]
+            self._latest_time = time_index[-1]
+            full_block = np.vstack((block, time_index))
+        else:
+            full_block = block
+        state = self._state
+        if state.length - state.n_spilled + n > state.hot.shape[1]:
+            state = self._make_room(state, n)
+        n_hot = state.length - state.n_spilled
+        # these rows are past the published length, so no reader is looking at them yet
+        state.hot[:, n_hot:n_hot+n] = full_block
+        # fmin/fmax ignore NaNs unless every value is NaN
+        self._minimum = np.fmin(self._minimum, np.fmin.reduce(block, axis=1))
+        self._maximum = np.fmax(self._maximum, np.fmax.reduce(block, axis=1))
+        # publish the rows only after they are completely written
+        self._state = state._replace(length=state.length + n)
+        return block
+
+    def window(self, name, start=0, stop=None):
+        """return a read-only array of rows start to stop of the column called name.
+        It is a view unless the range straddles the spill file and memory"""
+        state = self._state
+        i = self.column_index[name]
+        stop = state.length if stop is None else min(stop, state.length)
+        start = min(max(start, 0), stop)
+        if start >= state.n_spilled:
+            values = state.hot[i, start-state.n_spilled:stop-state.n_spilled]
+        elif stop <= state.n_spilled:
+            values = state.spilled[start:stop, i]
+        else:
+            values = np.concatenate((state.spilled[start:state.n_spilled, i], state.hot[i, :stop-state.n_spilled]))
+        values.flags.writeable = False
+        return values
+
+    def column(self, name):
+        """return every value of the column called name (see window)"""
+        return self.window(name)
+
+    def take(self, name, indices):
+        """return the values of the column called name at the given row numbers"""
+        state = self._state
+        i = self.column_index[name]
+        indices = np.asarray(indices, dtype=np.int64)
+        on_disk = indices < state.n_spilled
+        values = np.empty(len(indices))
+        if state.spilled is not None:
+            values[on_disk] = state.spilled[indices[on_disk], i]
+        values[~on_disk] = state.hot[i, indices[~on_disk] - state.n_spilled]
+        return values
+
+    def index_range(self, t_start=None, t_stop=None):
+        """return (start, stop): the rows with t_start <= time < t_stop (relative to time_origin),
+        found by binary search. None means no limit on that side"""
+        state = self._state
+        start = 0 if t_start is None else self._search_time(state, t_start)
+        stop = state.length if t_stop is None else self._search_time(state, t_stop)
+        return start, max(start, stop)
+
+    def time_window(self, names, t_start=None, t_stop=None):
+        """return a dict of read-only arrays (see window) of the columns called names, for the
+        rows with t_start <= time < t_stop. All of them cover the same rows"""
+        start, stop = self.index_range(t_start, t_stop)
+        return {name: self.window(name, start, stop) for name in names}
+
+    def extrema(self, name):
+        """return (minimum, maximum) of the column called name, ignoring NaNs.
+        Raises ValueError if the column has no numbers in it yet"""
+        i = self.column_index[name]
+        minimum, maximum = self._minimum[i], self._maximum[i]
+        if np.isnan(minimum):
+            raise ValueError("column %r is empty" % name)
+        return minimum, maximum
+
+    def latest(self, name):
+        """return the most recent value of the column called name. Raises IndexError if there is none"""
+        state = self._state
+        if state.length == 0:
+            raise IndexError("the store is empty")
+        return state.hot[self.column_index[name], state.length - state.n_spilled - 1]
+
+    def _search_time(self, state, t):
+        """the number of the first row whose (indexed) time is at or after t"""
+        if state.n_spilled > 0 and state.spilled[state.n_spilled - 1, -1] >= t:
+            return int(np.searchsorted(state.spilled[:state.n_spilled, -1], t, side='left'))
+        n_hot = state.length - state.n_spilled
+        return state.n_spilled + int(np.searchsorted(state.hot[-1, :n_hot], t, side='left'))
+
+    def close(self):
+        """delete the spill file. Only call this once nobody will read from the store again"""
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+    def _make_room(self, state, n):
+        """return a new state with room in memory for n more rows, spilling old rows if we can
+        and growing the in-memory array if we must. The old arrays are left untouched for any
+        reader still looking at them"""
+        n_hot = state.length - state.n_spilled
+        capacity = state.hot.shape[1]
+        n_old = 0
+        if self.hot_seconds is not None and n_hot > 0:
+            times = state.hot[-1, :n_hot]
+            n_old = np.searchsorted(times, times[-1] - self.hot_seconds, side='left')
+            n_old = min(int(n_old), n_hot - 1)
+            if n_old < n_hot // 2:
+                # spilling would barely help: better to grow, and spill a big chunk later on
+                n_old = 0
+        while n_hot - n_old + n > capacity:
+            capacity *= 2
+        spilled = state.spilled
+        if n_old > 0:
+            spilled = self._spill(state, state.hot[:, :n_old])
+        hot = np.empty((self._width, capacity))
+        hot[:, :n_hot-n_old] = state.hot[:, n_old:n_hot]
+        return _Snapshot(hot, spilled, state.n_spilled + n_old, state.length)
+
+    def _spill(self, state, rows):
+        """append rows (columns x number of rows) to the spill file and return its memmap"""
+        n_spilled, m = state.n_spilled, rows.shape[1]
+        spilled = state.spilled
+        if spilled is None or n_spilled + m > spilled.shape[0]:
+            capacity = max(n_spilled + m, 2 * (0 if spilled is None else spilled.shape[0]))
+            if self._spill_file is None:
+                self._spill_file = tempfile.TemporaryFile(prefix='trace_history_')
+            self._spill_file.truncate(capacity * self._width * 8)
+            # readers still holding the old map keep a valid (if shorter) mapping of the file
+            spilled = np.memmap(self._spill_file, dtype=np.float64, mode='r+', shape=(capacity, self._width))
+        spilled[n_spilled:n_spilled+m] = rows.T
+        return spilled
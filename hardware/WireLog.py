@@ -0,0 +1,167 @@
+"""Log of the bytes going over a serial port, kept off the I/O path.
+
+Recording a chunk of traffic only appends it, with a time.time() timestamp, to a ring buffer
+in memory; a thread of its own formats the chunks and writes them out in batches, with an
+fsync every so often, so a slow disk never holds up a round trip. The buffer keeps the most
+recent CAPACITY bytes of traffic whether or not they have been written yet, and dump()
+writes out the last few KB of them to a file of their own: it is called when reading from
+the port fails, and on any uncaught exception, so the traffic leading up to a crash is on
+disk even if the log itself had not caught up.
+
+Each line of the log is a chunk: the time to the microsecond, TX (sent) or RX (received),
+and the bytes.
+"""
+import atexit
+import collections
+import datetime
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+
+_logs = []  # every open WireLog, for the crash hooks
+_hooks_installed = False
+
+
+def format_record(timestamp, direction, data):
+    """one line of the log"""
+    when = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S.%f')
+    return "%s %s %r\n" % (when, direction, data)
+
+
+def dump_all(reason):
+    """dump the recent traffic of every open WireLog"""
+    for log in list(_logs):
+        log.dump(reason)
+
+
+def _dump_then(hook):
+    def dump_then(*args):
+        try:
+            dump_all("uncaught exception")
+        except Exception:
+            pass
+        hook(*args)
+    return dump_then
+
+
+def _install_crash_hooks():
+    global _hooks_installed
+    if not _hooks_installed:
+        _hooks_installed = True
+        sys.excepthook = _dump_then(sys.excepthook)
+        threading.excepthook = _dump_then(threading.excepthook)
+
+
+class WireLog:
+    """Log the traffic of a serial port to the file at `path`, from a thread of its own."""
+    CAPACITY = 256 * 1024  # bytes of traffic kept in memory
+    FLUSH_INTERVAL = 0.5  # seconds between writes to the file
+    FSYNC_INTERVAL = 10  # seconds between fsyncs
+    DUMP_SIZE = 64 * 1024  # bytes of traffic dump() writes out
+
+    def __init__(self, path, errorlogger=None, capacity=CAPACITY,
+                 flush_interval=FLUSH_INTERVAL, fsync_interval=FSYNC_INTERVAL):
+        self.path = path
+        self.errorlogger = errorlogger if errorlogger is not None else logging.getLogger('python')
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(path, 'a', encoding='utf-8')
+        self.records_lost = 0
+        self._records = collections.deque()  # (sequence number, timestamp, 'TX' or 'RX', bytes)
+        self._size = 0  # bytes of traffic in _records
+        self._next = 0  # sequence number of the next record
+        self._written = 0  # sequence number of the first record not written yet
+        self._lost = 0  # records dropped before they were written, since the last write
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._last_fsync = time.monotonic()
+        self._stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='WireLog', daemon=True)
+        self.thread.start()
+        _logs.append(self)
+        _install_crash_hooks()
+        atexit.register(self.close)
+
+    def record(self, direction, data):
+        """note bytes just sent ('TX') or received ('RX'); cheap enough to call on every chunk"""
+        timestamp = time.time()
+        data = bytes(data)
+        with self._lock:
+            self._records.append((self._next, timestamp, direction, data))
+            self._next += 1
+            self._size += len(data)
+            while self._size > self.capacity and len(self._records) > 1:
+                sequence, _, _, old = self._records.popleft()
+                self._size -= len(old)
+                if sequence >= self._written:
+                    # the writer has fallen a whole buffer behind
+                    self._written = sequence + 1
+                    self._lost += 1
+
+    def recent(self, size=DUMP_SIZE):
+        """the latest records holding up to size bytes of traffic, oldest first"""
+        records = []
+        total = 0
+        with self._lock:
+            for record in reversed(self._records):
+                total += len(record[3])
+                if records and total > size:
+                    break
+                records.append(record)
+        return records[::-1]
+
+    def dump(self, reason=None, size=DUMP_SIZE):
+        """write the last size bytes of traffic to a file next to the log, and return its path"""
+        self.flush()
+        path = '%s_dump_%d.log' % (os.path.splitext(self.path)[0], time.time())
+        with open(path, 'w', encoding='utf-8') as f:
+            if reason is not None:
+                f.write("# %s\n" % reason)
+            f.writelines(format_record(timestamp, direction, data) for _, timestamp, direction, data in self.recent(size))
+            f.flush()
+            os.fsync(f.fileno())
+        self.errorlogger.info("Last %d KB of serial traffic saved to %s" % (size // 1024, path))
+        return path
+
+    def flush(self, fsync=False):
+        """write out everything recorded so far"""
+        with self._file_lock:
+            if self.file.closed:
+                return
+            with self._lock:
+                first = self._records[0][0] if self._records else self._next
+                records = list(itertools.islice(self._records, max(self._written - first, 0), None))
+                self._written = self._next
+                lost, self._lost = self._lost, 0
+            self.records_lost += lost
+            if lost:
+                self.file.write("# %d records lost: the log fell behind\n" % lost)
+            self.file.writelines(format_record(timestamp, direction, data) for _, timestamp, direction, data in records)
+            self.file.flush()
+            if fsync:
+                os.fsync(self.file.fileno())
+                self._last_fsync = time.monotonic()
+
+    def close(self):
+        """write out everything recorded and close the file"""
+        self._stop_event.set()
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.flush(fsync=True)
+        with self._file_lock:
+            self.file.close()
+        if self in _logs:
+            _logs.remove(self)
+        atexit.unregister(self.close)
+
+    def _run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush(fsync=time.monotonic() - self._last_fsync >= self.fsync_interval)
+            except Exception:
+                self.errorlogger.exception("error writing the serial log %s" % self.path)
@@ -0,0 +1,97 @@
+import unittest
+from unittest.mock import Mock
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from widgets.BlitRenderer import BlitRenderer
+
+
+class FakeWidget:
+    """stands in for a Tk widget: runs `after` callbacks only when told to"""
+    def __init__(self):
+        self.pending = None
+
+    def after(self, ms, callback):
+        self.pending = callback
+        return 'after#1'
+
+    def after_cancel(self, after_id):
+        self.pending = None
+
+    def tick(self):
+        callback, self.pending = self.pending, None
+        callback()
+
+
+class BlittingCanvas(FigureCanvasAgg):
+    blits = 0
+
+    def blit(self, bbox=None):
+        self.blits += 1
+
+
+class TestBlitRenderer(unittest.TestCase):
+
+    def setUp(self):
+        self.figure = Figure()
+        self.canvas = BlittingCanvas(self.figure)
+        self.ax = self.figure.add_subplot(111)
+        self.line = self.ax.plot([], [])[0]
+        self.widget = FakeWidget()
+        self.axes_changed = False
+        self.renderer = BlitRenderer(self.widget, self.canvas, lambda: self.axes_changed, [self.line], max_frame_rate=10)
+
+    def test_redraw_only_when_needed(self):
+        self.assertEqual(self.renderer.period_ms, 100)
+        self.renderer.start()
+        self.widget.tick()  # first frame draws everything
+        self.assertEqual((self.renderer.frames, self.renderer.full_redraws), (1, 1))
+        self.assertTrue(self.line.get_animated())
+
+        self.widget.tick()  # nothing changed: nothing drawn
+        self.assertEqual(self.renderer.frames, 1)
+
+        self.renderer.mark_dirty()
+        self.widget.tick()  # new data: blit the line only
+        self.assertEqual((self.renderer.frames, self.renderer.full_redraws), (2, 1))
+
+        self.axes_changed = True
+        self.renderer.mark_dirty()
+        self.widget.tick()  # the axes changed: draw everything again
+        self.assertEqual((self.renderer.frames, self.renderer.full_redraws), (3, 2))
+        self.assertEqual(self.canvas.blits, 3)
+
+        self.renderer.stop()
+        self.assertIsNone(self.widget.pending)
+
+    def test_outside_redraw_asks_for_a_frame(self):
+        self.renderer.start()
+        self.widget.tick()
+        self.canvas.draw()  # e.g. the window was resized
+        self.widget.tick()
+        self.assertEqual((self.renderer.frames, self.renderer.full_redraws), (2, 1))
+
+    def test_errors_dont_stop_the_frames(self):
+        errorlogger = Mock()
+        failing = [True]
+
+        def draw_frame():
+            if failing[0]:
+                raise ValueError("shape mismatch")
+            return False
+        renderer = BlitRenderer(self.widget, self.canvas, draw_frame, [self.line], errorlogger=errorlogger)
+        renderer.start()
+        for _ in range(3):
+            renderer.mark_dirty()
+            self.widget.tick()
+        # logged once, and still scheduled
+        errorlogger.exception.assert_called_once()
+        self.assertIsNotNone(self.widget.pending)
+        failing[0] = False
+        renderer.mark_dirty()
+        self.widget.tick()
+        self.assertEqual(renderer.frames, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import time
+import unittest
+from unittest.mock import Mock
+import numpy as np
+
+from hardware import FileIO
+from hardware.CallStats import CallStats, LatencyHistogram
+from hardware.ElveflowSimulator import SimulatedOB1
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        latencies = np.random.default_rng(0).lognormal(np.log(2e-3), 0.5, 10000)
+        histogram = LatencyHistogram()
+        for latency in latencies:
+            histogram.record(latency)
+        for q in (50, 90, 99):
+            self.assertAlmostEqual(histogram.percentile(q) / np.percentile(latencies, q), 1, delta=0.04)
+        self.assertEqual(histogram.max, latencies.max())
+        self.assertEqual(histogram.summary()['count'], 10000)
+
+    def test_errors(self):
+        stats = CallStats()
+        stats.record('OB1_Get_Press', 1, 0.001)
+        stats.record('OB1_Get_Press', 1, 0.002, error=-8000)
+        stats.record('OB1_Get_Press', 1, 0.003, error=-8000)
+        stats.record('OB1_Set_Press', 2, 0.001, error=7)
+        result = stats.stats()
+        self.assertEqual(result[('OB1_Get_Press', 1)]['errors'], {-8000: 2})
+        self.assertEqual(result[('OB1_Set_Press', 2)]['errors'], {7: 1})
+        self.assertEqual(len(stats.summary_lines()), 2)
+
+
+class TestHandlerStats(unittest.TestCase):
+
+    def test_sdk_calls_are_timed(self):
+        errorlogger = Mock()
+        handler = FileIO.ElveflowHandler_SDK(sourcename='simulator', errorlogger=errorlogger, sensortypes=[4, 0, 0, 0],
+                                             sdk=SimulatedOB1(call_latency=0.002), acquisition_rate=50, sdk_stats_period=0.2)
+        handler.start()
+        try:
+            time.sleep(0.5)
+        finally:
+            handler.stop()
+            handler.executor_thread.join(timeout=10)
+        stats = handler.sdk_stats()
+        self.assertGreater(stats[('OB1_Get_Press', 1)]['count'], 5)
+        self.assertGreater(stats[('OB1_Get_Sens_Data', 4)]['p50'], 0.0015)
+        self.assertEqual(stats[('OB1_Destructor', None)]['count'], 1)
+        summaries = [call[0][0] for call in errorlogger.debug.call_args_list if 'samples/s' in call[0][0]]
+        self.assertTrue(summaries)
+        self.assertIn('OB1_Get_Press ch1', summaries[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
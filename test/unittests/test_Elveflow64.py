@@ -0,0 +1,72 @@
+import unittest
+from unittest.mock import Mock
+
+from hardware.Elveflow_SDK import Elveflow64
+from hardware import FileIO
+
+
+class CountingDLL:
+    """stands in for a CDLL, counting how often each function is looked up"""
+    def __init__(self):
+        self.lookups = {}
+        self.functions = {}
+
+    def __getattr__(self, name):
+        self.lookups[name] = self.lookups.get(name, 0) + 1
+        return self.functions.setdefault(name, Mock(name=name, return_value=0))
+
+
+class TestPrototypes(unittest.TestCase):
+
+    def test_bind_prototypes(self):
+        dll = CountingDLL()
+        prototypes = Elveflow64.bind_prototypes(dll)
+        for name, argtypes in Elveflow64.OB1_PROTOTYPES.items():
+            self.assertEqual(dll.lookups[name], 1)
+            self.assertIs(getattr(prototypes, name), dll.functions[name])
+            self.assertEqual(dll.functions[name].argtypes, argtypes)
+            self.assertIs(dll.functions[name].restype, Elveflow64.c_int32)
+
+        # calling through the bound prototypes never looks anything up again
+        prototypes.OB1_Get_Press(0, 1, 1, None, None, 1000)
+        prototypes.OB1_Get_Press(0, 2, 1, None, None, 1000)
+        self.assertEqual(dll.lookups['OB1_Get_Press'], 1)
+
+
+class TestHandlerSDKCalls(unittest.TestCase):
+
+    def setUp(self):
+        self.dll = CountingDLL()
+        self.sdk = Elveflow64.bind_prototypes(self.dll)
+
+        def get_press(instr_id, channel, acquire, calib, pressure, length):
+            pressure._obj.value = 100.0 * channel
+            return 0
+        self.dll.functions['OB1_Get_Press'].side_effect = get_press
+
+        def get_sens_data(instr_id, channel, acquire, data):
+            data._obj.value = -1.0 * channel
+            return 0
+        self.dll.functions['OB1_Get_Sens_Data'].side_effect = get_sens_data
+
+        self.handler = FileIO.ElveflowHandler_SDK(sourcename='test', errorlogger=Mock(), sensortypes=[0, 0, 0, 0], sdk=self.sdk)
+
+    def test_reads(self):
+        self.assertEqual(self.handler.getPressure(3), 300.0)
+        self.assertEqual(self.handler.getVolume(2), -2.0)
+        self.assertEqual(self.handler.getPressure(1), 100.0)
+
+        # the same out-parameter and calibration references are reused on every call
+        first_call, second_call = self.dll.functions['OB1_Get_Press'].call_args_list[-2:]
+        self.assertIs(first_call[0][3], second_call[0][3])
+        self.assertIs(first_call[0][4], second_call[0][4])
+
+    def test_set_pressure(self):
+        self.handler.setPressure(2, 1234)
+        args = self.dll.functions['OB1_Set_Press'].call_args[0]
+        self.assertEqual(args[1:3], (2, 1234))
+        self.assertIs(args[3], self.handler.calib_ref)
+
+
+if __name__ == '__main__':
+    unittest.main()
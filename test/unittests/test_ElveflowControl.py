@@ -0,0 +1,189 @@
+import threading
+import unittest
+from unittest.mock import Mock
+import numpy as np
+
+from hardware.Elveflow_SDK import Elveflow64
+from hardware import FileIO
+from hardware.ElveflowControl import PressureRamp, FlowPID, MultiChannelPID, plan_ramp, RAMP_SHAPES, MAX_PRESSURE
+
+
+class TestControllers(unittest.TestCase):
+
+    def test_pressure_ramp(self):
+        ramp = PressureRamp(1000, rate=500)
+        setpoints = [ramp.step(0.5, 100, 0) for _ in range(4)]
+        self.assertEqual(setpoints, [350, 600, 850, 1000])
+        self.assertTrue(ramp.finished)
+        self.assertEqual(ramp.remaining_time(), 0)
+        self.assertEqual(PressureRamp(10**6, rate=1).target, MAX_PRESSURE)
+
+    def test_ramp_shapes(self):
+        for shape in RAMP_SHAPES:
+            trajectory = plan_ramp(500, 4000, 888, shape=shape, acceleration=2000, time_constant=0.5)
+            speed = np.diff(trajectory.pressures) / np.diff(trajectory.times)
+            self.assertEqual(trajectory.pressure_at(0), 500)
+            self.assertEqual(trajectory.pressure_at(trajectory.duration), 4000)
+            self.assertLessEqual(speed.max(), 888 + 1e-6, shape)
+            self.assertGreaterEqual(speed.min(), -1e-6, shape)
+        # an s-curve replanned while heading the wrong way turns around smoothly
+        trajectory = plan_ramp(1000, 0, 888, shape='s-curve', acceleration=2000, initial_velocity=800)
+        self.assertAlmostEqual(trajectory.pressures.max(), 1000 + 800**2 / 4000)
+        self.assertLessEqual(np.abs(np.diff(trajectory.pressures, 2)).max(), 2000 * 0.01**2 + 1e-6)
+
+    def test_retarget(self):
+        clock = [100.0]
+        ramp = PressureRamp(2000, rate=1000, shape='s-curve', acceleration=4000, clock=lambda: clock[0])
+        setpoints = [ramp.step(0.1, 0, 0) for _ in range(10)]
+        self.assertAlmostEqual(ramp.expected_completion(), 100 + ramp.trajectory.duration)
+        ramp.retarget(500)
+        while not ramp.finished:
+            setpoints.append(ramp.step(0.1, 0, 0))
+        self.assertEqual(setpoints[-1], 500)
+        self.assertEqual(ramp.remaining_time(), 0)
+        # no jumps when the target changed mid-flight
+        self.assertLessEqual(np.abs(np.diff(setpoints)).max(), 100 + 1e-6)
+
+    def test_flow_pid_settles(self):
+        # four channels whose flow rates are a tenth, a fifth, ... of their pressures
+        gains = np.array([10, 5, 10/3, 2.5])
+        regulator = MultiChannelPID(4)
+        pressure = np.zeros(4)
+        pids = [FlowPID(50, (0, 20, 0), regulator, i, margin=0.5, stable_time=1, timeout=60) for i in range(4)]
+        while not all(pid.finished for pid in pids):
+            flowrate = pressure / gains
+            output = regulator.update(0.1, flowrate)
+            pressure = np.where(np.isnan(output), pressure, output)
+            for pid, p, f in zip(pids, pressure, flowrate):
+                if not pid.finished:
+                    pid.step(0.1, p, f)
+        np.testing.assert_allclose(pressure / gains, 50, atol=0.5)
+        self.assertTrue(all(pid.elapsed < 60 for pid in pids))
+        self.assertFalse(regulator.active.any())
+        self.assertIsNone(pids[0].follow_up())
+        ramp = FlowPID(50, (1, 1, 0), regulator, 0, then_ramp_to=0,
+                       make_ramp=lambda target: PressureRamp(target, rate=100, shape='s-curve', acceleration=400)).follow_up()
+        self.assertIsInstance(ramp, PressureRamp)
+        self.assertEqual((ramp.target, ramp.shape), (0, 's-curve'))
+
+    def test_anti_windup(self):
+        regulator = MultiChannelPID(2)
+        regulator.engage(0, 100, (0, 1000, 0), offset=0)
+        regulator.engage(1, 100, (1, 0, 0), offset=7990)
+        # a flow that can't be reached: the output pins at the clamp...
+        for _ in range(100):
+            output = regulator.update(0.1, [0, 0])
+        np.testing.assert_array_equal(output, [MAX_PRESSURE, MAX_PRESSURE])
+        # ...without the integral running away, so it comes off the clamp as soon as the flow overshoots
+        self.assertLessEqual(regulator.integral[0], MAX_PRESSURE + 1000 * 100 * 0.1)
+        self.assertLess(regulator.update(0.1, [200, np.nan])[0], MAX_PRESSURE)
+        regulator.release(1)
+        self.assertTrue(np.isnan(regulator.update(0.1, [200, 0])[1]))
+
+class FakeOB1:
+    """stands in for the OB1 prototypes: pressures go straight to what was last set"""
+    def __init__(self):
+        self.pressures = [0.0] * 5
+        self.threads = set()
+        self.OB1_Initialization = Mock(return_value=0)
+        self.OB1_Add_Sens = Mock(return_value=0)
+        self.Elveflow_Calibration_Default = Mock(return_value=0)
+        self.OB1_Destructor = Mock(return_value=0)
+
+    def OB1_Get_Press(self, instr_id, channel, acquire, calib, pressure, length):
+        self.threads.add(threading.current_thread())
+        pressure._obj.value = self.pressures[channel]
+        return 0
+
+    def OB1_Get_Sens_Data(self, instr_id, channel, acquire, data):
+        self.threads.add(threading.current_thread())
+        data._obj.value = self.pressures[channel] / 10
+        return 0
+
+    def OB1_Set_Press(self, instr_id, channel, value, calib, length):
+        self.threads.add(threading.current_thread())
+        self.pressures[channel] = value
+        return 0
+
+
+class TestExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.ob1 = FakeOB1()
+        self.handler = FileIO.ElveflowHandler_SDK(sourcename='test', errorlogger=Mock(), sensortypes=[5, 5, 5, 0],
+                                                  sdk=self.ob1, acquisition_rate=200)
+
+    def test_ramps_run_together(self):
+        self.handler.start()
+        try:
+            finished = []
+            ramps = [self.handler.set_pressure_loop(i, 1000, on_finish=lambda i=i: finished.append(i)) for i in (1, 2)]
+            for ramp in ramps:
+                self.assertTrue(ramp.join(timeout=10))
+            self.assertEqual(sorted(finished), [1, 2])
+            self.assertEqual(self.ob1.pressures[1:3], [1000, 1000])
+            self.assertEqual(self.handler.getPressure(3), 0)
+            # changing course mid-ramp keeps the same ramp going
+            ramp = self.handler.set_pressure_loop(3, 4000)
+            self.assertIs(self.handler.retarget_pressure(3, 200), ramp)
+            self.assertTrue(ramp.join(timeout=10))
+            self.assertEqual(self.ob1.pressures[3], 200)
+            # channel 4 has no sensor, so it is left alone
+            self.handler.set_pressure_loop(4, 1000).join(timeout=10)
+            self.assertEqual(self.ob1.pressures[4], 0)
+        finally:
+            self.handler.stop()
+            self.handler.executor_thread.join(timeout=10)
+        # stopping ramps everything back down before closing the connection
+        self.assertEqual(self.ob1.pressures[1:4], [0, 0, 0])
+        self.ob1.OB1_Destructor.assert_called_once()
+        # and the instrument was only ever talked to from the executor thread
+        self.assertEqual(self.ob1.threads, {self.handler.executor_thread})
+
+    def test_interrupt(self):
+        self.handler.ramp_shape = 's-curve'
+        self.handler.pressure_ramp = Mock(wraps=self.handler.pressure_ramp)
+        self.handler.start()
+        try:
+            stop = threading.Event()
+            pid = self.handler.set_volume_loop(1, 20, interrupt_event=stop, pid_constants=(0, 20, 0))
+            # both channels are regulated at once; the flow rate is a tenth of the pressure
+            pressure = self.handler.run_volume(2, 30, pid_constants=(0, 20, 0), margin=0.5, stable_time=0.1, timeout=10)
+            self.assertAlmostEqual(pressure, 300, delta=5)
+            self.assertTrue(self.handler.flow_pid.active[0])
+            stop.set()
+            self.assertTrue(pid.join(timeout=10))
+            # ramped down by the same planner as every other ramp, so in the configured shape
+            self.handler.pressure_ramp.assert_called_once_with(0)
+        finally:
+            self.handler.stop()
+            self.handler.executor_thread.join(timeout=10)
+        self.assertEqual(self.ob1.pressures[1], 0)
+        # and so is the ramp down of every channel with a sensor when stopping
+        self.assertEqual(self.handler.pressure_ramp.call_count, 4)
+
+    def test_submit_while_closing(self):
+        closing = threading.Event()
+        closed = threading.Event()
+
+        def destructor(instr_id):
+            closing.set()
+            closed.wait(10)
+            return 0
+        self.ob1.OB1_Destructor = destructor
+        self.handler.start()
+        self.handler.stop()
+        try:
+            self.assertTrue(closing.wait(10))
+            # the executor thread is still alive, but will never run it
+            with self.assertRaises(RuntimeError):
+                self.handler.submit(self.handler.getPressure, 1).result(timeout=1)
+        finally:
+            closed.set()
+            self.handler.executor_thread.join(timeout=10)
+        # once it's gone, calls run right away again
+        self.assertEqual(self.handler.submit(lambda: 5).result(timeout=1), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
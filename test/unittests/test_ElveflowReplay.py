@@ -0,0 +1,65 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import Mock
+import numpy as np
+
+from hardware import FileIO
+from hardware.RunWriter import CsvSink, ColumnSink
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.header = ['time [s]', 'Pressure 1 [mbar]', 'Volume flow rate 1 [µL/min]']
+        n = 1000
+        # 100 s recorded at 10 Hz
+        self.data = np.array([1.6e9 + np.arange(n) / 10, np.arange(n) * 2.0, np.sin(np.arange(n))])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def replay(self, path, speed):
+        handler = FileIO.ElveflowHandler_Replay(path, errorlogger=Mock(), speed=speed)
+        start = time.monotonic()
+        handler.start()
+        self.assertTrue(handler.finished.wait(timeout=10))
+        elapsed = time.monotonic() - start
+        handler.reading_thread.join()
+        cursor, block = handler.read_since(0)
+        self.assertEqual(cursor, self.data.shape[1])
+        self.assertEqual(handler.getHeader(), self.header)
+        return handler, block, elapsed
+
+    def test_csv_at_speed(self):
+        path = os.path.join(self.directory.name, 'run.csv')
+        sink = CsvSink(path, self.header)
+        sink.write_block(self.data)
+        sink.close()
+        handler, block, elapsed = self.replay(path, speed=500)
+        # the original timestamps, at 500 times the original pace
+        np.testing.assert_allclose(block, self.data, rtol=1e-14)
+        self.assertGreater(elapsed, 0.15)
+        self.assertEqual(handler.getPressure(1), self.data[1, -1])
+
+    def test_tsv_and_run_as_fast_as_possible(self):
+        path = os.path.join(self.directory.name, 'elveflow.txt')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\t'.join(self.header) + '\n')
+            for row in self.data.T:
+                f.write('\t'.join(repr(float(x)) for x in row) + '\n')
+        _, block, _ = self.replay(path, speed=None)
+        np.testing.assert_array_equal(block, self.data)
+
+        path = os.path.join(self.directory.name, 'run')
+        sink = ColumnSink(path, self.header)
+        sink.write_block(self.data)
+        sink.close()
+        _, block, _ = self.replay(path, speed=float('inf'))
+        np.testing.assert_array_equal(block, self.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
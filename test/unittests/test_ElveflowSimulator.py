@@ -0,0 +1,77 @@
+import unittest
+import threading
+from unittest.mock import Mock
+import numpy as np
+
+from hardware import FileIO
+from hardware.ElveflowSimulator import SimulatedOB1
+
+
+class TestPlant(unittest.TestCase):
+
+    def test_step_response(self):
+        ob1 = SimulatedOB1(regulator_time_constant=0.05, max_slew_rate=1000, flow_time_constant=0.5,
+                           flow_resistance=[100, 100, 50, 50], pressure_noise=0, flow_noise=0)
+        ob1.sensortypes[:] = 4
+        ob1.setpoint[:] = 2000
+        ob1.advance(0.5)
+        # slew-limited to start with...
+        np.testing.assert_allclose(ob1.pressure, 500)
+        for _ in range(100):
+            ob1.advance(0.1)
+        # ...and then settled, with the flow following through the resistance
+        np.testing.assert_allclose(ob1.pressure, 2000)
+        np.testing.assert_allclose(ob1.flowrate, [20, 20, 40, 40], rtol=1e-3)
+
+    def test_from_config(self):
+        ob1 = SimulatedOB1.from_config({'simulator_flow_resistance': '10, 20, 30, 40', 'simulator_call_latency': '0.002'})
+        np.testing.assert_array_equal(ob1.flow_resistance, [10, 20, 30, 40])
+        self.assertEqual(ob1.call_latency, 0.002)
+        self.assertEqual(ob1.flow_time_constant[0], SimulatedOB1.FLOW_TIME_CONSTANT)
+
+
+class TestSimulatedHandler(unittest.TestCase):
+
+    def test_flow_control(self):
+        ob1 = SimulatedOB1(flow_time_constant=0.1, seed=0)
+        handler = FileIO.ElveflowHandler_SDK(sourcename='simulator', errorlogger=Mock(), sensortypes=[4, 0, 0, 4],
+                                             sdk=ob1, acquisition_rate=100)
+        handler.start()
+        try:
+            self.assertTrue(handler.set_pressure_loop(1, 1000).join(timeout=10))
+            handler.run_volume(4, 10, pid_constants=(20, 300, 0), margin=0.5, stable_time=0.5, timeout=30)
+            self.assertAlmostEqual(handler.getVolume(4), 10, delta=1)
+            self.assertAlmostEqual(handler.getPressure(1), 1000, delta=5)
+        finally:
+            handler.stop()
+            handler.executor_thread.join(timeout=30)
+        np.testing.assert_array_equal(ob1.setpoint, 0)
+        self.assertEqual(ob1.calls['OB1_Destructor'], 1)
+
+    def test_commands_while_stopping(self):
+        ob1 = SimulatedOB1(seed=0)
+        handler = FileIO.ElveflowHandler_SDK(sourcename='simulator', errorlogger=Mock(), sensortypes=[4, 0, 0, 4],
+                                             sdk=ob1, acquisition_rate=100)
+        handler.start()
+        try:
+            self.assertTrue(handler.set_pressure_loop(1, 2000).join(timeout=10))
+            handler.stop()  # still running while the pressure ramps down
+            on_finish = Mock()
+            ramp = handler.set_pressure_loop(4, 1000, on_finish=on_finish)
+            result = []
+            thread = threading.Thread(target=lambda: result.append(handler.run_volume(4, 10, timeout=30)))
+            thread.start()
+            thread.join(timeout=10)
+            self.assertFalse(thread.is_alive())
+            self.assertEqual(result, [10])
+            self.assertTrue(ramp.join(timeout=0))
+            on_finish.assert_called_once()
+            self.assertTrue(handler.executor_running())
+        finally:
+            handler.stop()
+            handler.executor_thread.join(timeout=30)
+        np.testing.assert_array_equal(ob1.setpoint, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+import collections
+import re
+import threading
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+from hardware.SAXSDrivers import HPump, async_pumps_running
+from hardware.SerialTransport import run, transport_for
+
+
+class FakePumpPort:
+    """A serial port with a chain of Harvard pumps behind it, each of which replies after `delay` seconds."""
+
+    def __init__(self, delay=0.01, timeout=0.1):
+        self.delay = delay
+        self.timeout = timeout
+        self.port = 'fake'
+        self.is_open = True
+        self.running = {}
+        self.rate = 0  # µL/min, for all the pumps
+        self.target = {}  # ml
+        self.delivered = {}
+        self.started = {}
+        self.replies = 0
+        self.queries = collections.Counter()  # by address
+        self.exchanges = []  # [time asked, time answered or None] for each query
+        self._buffer = b""
+        self._changed = threading.Condition()
+        self._line = threading.Lock()
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def most_in_flight(self):
+        """the most queries that were waiting for their replies at once"""
+        exchanges = list(self.exchanges)
+        return max((sum(1 for asked, answered in exchanges if asked <= start and (answered is None or answered > start))
+                    for start, _ in exchanges), default=0)
+
+    @property
+    def in_waiting(self):
+        return len(self._buffer)
+
+    def read(self, size=1):
+        with self._changed:
+            self._changed.wait_for(lambda: self._buffer, self.timeout)
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+            return data
+
+    def _delivered(self, address):
+        """the volume delivered so far; the pump stops once it reaches its target"""
+        delivered = self.delivered.get(address, 0.0)
+        if self.running.get(address):
+            delivered += self.rate / 60000 * (time.monotonic() - self.started[address])
+            if address in self.target and delivered >= self.target[address]:
+                self.running[address] = False
+                delivered = self.delivered[address] = self.target[address]
+        return delivered
+
+    def write(self, data):
+        if not data.strip():
+            # a bare line end stops every pump, without an answer
+            for address in list(self.running):
+                self.delivered[address] = self._delivered(address)
+                self.running[address] = False
+            return
+        address, command = re.match(r"([0-9]+)(.*)", data.decode().strip()).groups()
+        self.queries[address] += 1
+        self.exchanges.append([time.monotonic(), None])
+        delivered = self._delivered(address)
+        if command == "RUN":
+            self.running[address] = True
+            self.started[address] = time.monotonic()
+            self.delivered[address] = 0.0
+        elif command == "STP":
+            self.running[address] = False
+            self.delivered[address] = delivered
+        elif command.startswith("RAT") and len(command) > 3:
+            self.rate = int(command[3:8])
+        elif command.startswith("TGT") and len(command) > 3:
+            self.target[address] = float(command[3:])
+        if command == "RAT":
+            reply = "\n\r%.4f ul/m\n\r" % self.rate
+        elif command == "DEL":
+            reply = "\n\r%.5f\n\r" % delivered
+        elif command == "TGT":
+            reply = "\n\r%.5f\n\r" % self.target.get(address, 0)
+        else:
+            reply = "\n\r"
+        reply += address + (">" if self.running.get(address) else ":")
+        threading.Timer(self.delay, self._reply, (reply.encode(), len(self.exchanges) - 1)).start()
+
+    def _reply(self, data, exchange):
+        with self._line:
+            with self._changed:
+                # the prompt comes in a moment after the rest, as it would over a slow line
+                self._buffer += data[:-2]
+                self._changed.notify_all()
+            time.sleep(0.005)
+            with self._changed:
+                self._buffer += data[-2:]
+                self.replies += 1
+                self.exchanges[exchange][1] = time.monotonic()
+                self._changed.notify_all()
+
+
+class TestHPump(unittest.TestCase):
+
+    def setUp(self):
+        HPump.enabled = True
+        self.port = FakePumpPort()
+        self.pump = HPump(address=0, logger=Mock(), lock=threading.RLock())
+
+    def tearDown(self):
+        HPump.enabled = False
+        run(transport_for(self.port).close())
+
+    @patch.object(HPump, 'RESPONSE_TIMEOUT', 10)
+    def test_queries_return_with_the_reply(self):
+        start = time.monotonic()
+        self.assertFalse(self.pump.is_running(resource=self.port))
+        # not held up until the timeout
+        self.assertLess(time.monotonic() - start, HPump.RESPONSE_TIMEOUT / 5)
+        self.assertEqual(self.port.replies, 1)
+        self.pump.start_pump(resource=self.port)
+        self.assertTrue(self.pump.running)
+        self.assertTrue(self.pump.is_running(resource=self.port))
+        self.pump.set_infuse_rate(25, resource=self.port)
+        self.assertEqual(self.pump.check_infuse_rate(resource=self.port), 25)
+
+    def test_query_after_reopening(self):
+        self.assertFalse(self.pump.is_running(resource=self.port))
+        # as set_port does
+        run(transport_for(self.port).close())
+        self.assertFalse(self.port.is_open)
+        # not running, which it would say if the reply went unread
+        self.assertFalse(self.pump.is_running(resource=self.port))
+        self.assertTrue(self.port.is_open)
+        self.pump.start_pump(resource=self.port)
+        self.assertTrue(self.pump.running)
+
+    def test_no_reply(self):
+        self.port.write = lambda data: None
+        start = time.monotonic()
+        # not knowing, it says the pump is running, so nothing waiting on it goes on early
+        self.assertTrue(self.pump.is_running(resource=self.port))
+        self.assertGreaterEqual(time.monotonic() - start, HPump.RESPONSE_TIMEOUT)
+        with self.assertRaises(RuntimeError):
+            self.pump.start_pump(resource=self.port)
+
+    def test_ports_run_concurrently(self):
+        other_port = FakePumpPort(delay=0.2)
+        self.port.delay = 0.2
+        try:
+            threads = [threading.Thread(target=self.pump.is_running, kwargs={'resource': port}) for port in (self.port, other_port)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # each port was asked before the other answered
+            (asked, answered), (other_asked, other_answered) = self.port.exchanges[0], other_port.exchanges[0]
+            self.assertLess(max(asked, other_asked), min(answered, other_answered))
+            # but queries on the same port take turns
+            threads = [threading.Thread(target=self.pump.is_running, kwargs={'resource': self.port}) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(self.port.replies, 3)
+            self.assertEqual(self.port.most_in_flight(), 1)
+        finally:
+            run(transport_for(other_port).close())
+
+    def test_chain_is_pipelined(self):
+        self.port.delay = 0.2
+        pumps = [HPump(address=address, logger=Mock()) for address in range(3)]
+        pumps[1].start_pump(resource=self.port)
+        # a reply from a pump nobody asked is dropped, not taken for another pump's
+        self.port.write(b"5\n\r")
+        running = run(async_pumps_running(pumps, resource=self.port))
+        self.assertEqual(running, [False, True, False])
+        # all three asked before the first answer, along with the stray one
+        self.assertEqual(self.port.most_in_flight(), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
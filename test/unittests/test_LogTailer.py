@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest.mock import Mock
+import numpy as np
+
+from hardware.LogTailer import LogTailer, parse_delimited_block
+from hardware import FileIO
+
+
+class TestLogTailer(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'log.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, text, mode='a'):
+        with open(self.path, mode, newline='') as f:
+            f.write(text)
+
+    def test_partial_lines(self):
+        tailer = LogTailer(self.path)
+        self.assertEqual(tailer.read_lines(), (False, []))
+        self.write('a\tb\r\n1\t2')
+        self.assertEqual(tailer.read_lines(), (False, ['a\tb']))
+        self.assertEqual(tailer.read_lines(), (False, []))
+        self.write('\n3\t4\n')
+        self.assertEqual(tailer.read_lines(), (False, ['1\t2', '3\t4']))
+        tailer.close()
+
+    def test_truncation_and_rotation(self):
+        tailer = LogTailer(self.path)
+        self.write('header\n1\n2\n')
+        self.assertEqual(tailer.read_lines(), (False, ['header', '1', '2']))
+
+        self.write('header\n', mode='w')
+        self.assertEqual(tailer.read_lines(), (True, ['header']))
+
+        os.rename(self.path, self.path + '.old')
+        self.write('header\n5\n')
+        self.assertEqual(tailer.read_lines(), (True, ['header', '5']))
+        tailer.close()
+
+    def test_parse_delimited_block(self):
+        block, n_rejected = parse_delimited_block(['1\t2\t', '', '3\tx\t', '4\t5'], 3)
+        self.assertEqual(n_rejected, 1)
+        np.testing.assert_array_equal(block, [[1, 3], [2, np.nan], [np.nan, np.nan]])
+
+
+class TestElveflowHandlerESI(unittest.TestCase):
+
+    def test_backlog(self):
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, 'esi.txt')
+            with open(path, 'w', newline='') as f:
+                f.write('Time [s]\tPressure\t\n')
+                for i in range(5000):
+                    f.write('%.1f\t%d\t\n' % (i / 10, i))
+
+            handler = FileIO.ElveflowHandler_ESI(sourcename=path, errorlogger=Mock())
+            handler.start()
+            deadline = time.time() + 10
+            while (handler.buffer is None or handler.buffer.cursor < 5000) and time.time() < deadline:
+                time.sleep(0.01)
+            handler.stop()
+            handler.reading_thread.join()
+
+            self.assertEqual(handler.getHeader(), ['Time [s]', 'Pressure', ''])
+            cursor, block = handler.read_since(0)
+            self.assertEqual(cursor, 5000)
+            np.testing.assert_array_equal(block[1], np.arange(5000))
+            first = handler.fetchOne()
+            self.assertEqual((first['Time [s]'], first['Pressure']), (0.0, 0.0))
+            self.assertEqual(len(handler.fetchAll()), 4999)
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    unittest.main()
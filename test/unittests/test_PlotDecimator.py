@@ -0,0 +1,47 @@
+import unittest
+import numpy as np
+
+from widgets.PlotDecimator import MinMaxPyramid
+
+
+class TestMinMaxPyramid(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.y = rng.normal(size=100000)
+        self.y[12345] = 50  # a spike that striding would miss
+        self.y[54321] = -50
+        self.y[200:300] = np.nan
+
+    def test_incremental_matches_one_shot(self):
+        one_shot = MinMaxPyramid()
+        one_shot.extend(self.y)
+        incremental = MinMaxPyramid()
+        for start in range(0, len(self.y), 777):
+            incremental.extend(self.y[start:start + 777])
+        for a, b in zip(one_shot.levels, incremental.levels):
+            np.testing.assert_array_equal(a.idx_min[:a.length], b.idx_min[:b.length])
+            np.testing.assert_array_equal(a.idx_max[:a.length], b.idx_max[:b.length])
+            np.testing.assert_array_equal(a.val_min[:a.length], self.y[a.idx_min[:a.length]])
+
+    def test_keeps_spikes_and_ends(self):
+        pyramid = MinMaxPyramid()
+        pyramid.extend(self.y)
+        x = np.arange(len(self.y)) * 0.1
+        for start, stop in [(0, len(self.y)), (10001, 60003), (12000, 12400)]:
+            idx = pyramid.indices(self.y.__getitem__, start, stop, 500)
+            x_dec, y_dec = x[idx], self.y[idx]
+            self.assertLessEqual(len(y_dec), 2 * 500 + 2)
+            self.assertEqual(np.nanmax(y_dec), np.nanmax(self.y[start:stop]))
+            self.assertEqual(np.nanmin(y_dec), np.nanmin(self.y[start:stop]))
+            self.assertEqual((x_dec[0], x_dec[-1]), (x[start], x[stop - 1]))
+            self.assertTrue(np.all(np.diff(x_dec) > 0))
+
+    def test_short_range_is_not_decimated(self):
+        pyramid = MinMaxPyramid()
+        pyramid.extend(self.y)
+        np.testing.assert_array_equal(pyramid.indices(self.y.__getitem__, 5, 105, 100), np.arange(5, 105))
+
+
+if __name__ == '__main__':
+    unittest.main()
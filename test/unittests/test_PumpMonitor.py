@@ -0,0 +1,104 @@
+import threading
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+from hardware.PumpMonitor import PumpMonitor
+from hardware.SAXSDrivers import HPump, async_pumps_running
+from hardware.SerialTransport import run, transport_for
+from test_HPump import FakePumpPort
+
+
+class MonitoredPump(HPump):
+    """an HPump on a FakePumpPort instead of the class's port"""
+
+    def __init__(self, port, **kwargs):
+        super().__init__(logger=Mock(), **kwargs)
+        self.port = port
+
+    async def async_refresh(self, full=False, polled=False, volume=True, resource=None):
+        return await super().async_refresh(full, polled, volume, self.port)
+
+    async def async_is_running(self, resource=None):
+        return await super().async_is_running(self.port)
+
+
+class TestPumpMonitor(unittest.TestCase):
+
+    def setUp(self):
+        HPump.enabled = True
+        self.port = FakePumpPort()
+        self.port.rate = 600  # 10 µL/s
+        self.pumps = [MonitoredPump(self.port, address=address) for address in (0, 1)]
+        self.monitor = PumpMonitor(self.pumps, poll_rate=20, errorlogger=Mock())
+
+    def tearDown(self):
+        self.monitor.stop()
+        HPump.enabled = False
+        run(transport_for(self.port).close())
+
+    def test_waiters_share_the_polls(self):
+        pump = self.pumps[0]
+        pump.set_target_vol(0.005, resource=self.port)
+        pump.start_pump(resource=self.port)
+        self.assertIs(pump.state.running, True)
+        self.monitor.start()
+        replies = self.port.replies
+        start = time.monotonic()
+        waiters = [threading.Thread(target=pump.wait_until_stopped, args=(5,)) for _ in range(3)]
+        for waiter in waiters:
+            waiter.start()
+        self.assertTrue(pump.wait_until_delivered(0.002, timeout=5))
+        self.assertGreaterEqual(pump.state.delivered_volume, 0.002)
+        for waiter in waiters:
+            waiter.join()
+        elapsed = time.monotonic() - start
+        # 5 µL at 10 µL/s, noticed within a poll or two
+        self.assertAlmostEqual(elapsed, 0.5, delta=0.2)
+        self.assertIs(pump.state.running, False)
+        self.assertTrue(pump.state.fresh())
+        # only the monitor asked the pumps anything: a status and a volume per running pump per poll
+        self.assertLess(self.port.replies - replies, 3 * 20 * elapsed + 10)
+        self.assertEqual(pump.state.target_volume, 0.005)
+        self.assertEqual(self.pumps[1].state.running, False)
+
+    def test_without_a_monitor(self):
+        pump = self.pumps[1]
+        pump.set_target_vol(0.002, resource=self.port)
+        pump.start_pump(resource=self.port)
+        self.assertFalse(pump.state.fresh())
+        start = time.monotonic()
+        pump.wait_until_stopped(5)
+        self.assertAlmostEqual(time.monotonic() - start, 0.2, delta=0.15)
+        self.assertFalse(pump.known_running())
+
+    def test_stop_is_not_taken_from_the_cache(self):
+        pump = self.pumps[0]
+        pump.start_pump(resource=self.port)
+        self.monitor.start()
+        self.assertTrue(pump.state.wait_for(lambda state: state.fresh() and state.running, 1))
+        pump.stop(resource=self.port)
+        self.assertEqual(run(async_pumps_running([pump], resource=self.port, cached=True)), [False])
+        self.assertFalse(pump.known_running())
+
+    @patch.object(PumpMonitor, 'PREDICTION_LEAD', 0.2)
+    def test_predicted_completion(self):
+        for pump, monitor in ((self.pumps[0], self.monitor), (self.pumps[1], None)):
+            pump.set_infuse_rate(600, resource=self.port)
+            pump.set_target_vol(0.015, resource=self.port)  # 1.5 s
+            pump.start_pump(resource=self.port)
+            if monitor is not None:
+                monitor.start()
+            queries = self.port.queries[pump.address]
+            start = time.monotonic()
+            pump.wait_until_stopped(5)
+            elapsed = time.monotonic() - start
+            self.assertAlmostEqual(elapsed, 1.5, delta=0.2)
+            # asked how far it had got, then left alone until near the end
+            self.assertLess(self.port.queries[pump.address] - queries, 16)
+            self.assertTrue([call for call in pump.logger.info.call_args_list if call[0][0].startswith("Pump should finish in 1.")])
+            self.monitor.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
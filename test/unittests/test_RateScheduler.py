@@ -0,0 +1,48 @@
+import unittest
+
+from hardware.RateScheduler import DeadlineScheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestDeadlineScheduler(unittest.TestCase):
+
+    def test_no_drift(self):
+        clock = FakeClock()
+        scheduler = DeadlineScheduler(50, clock=clock, sleep=clock.sleep)
+        for i in range(100):
+            scheduler.wait()
+            clock.now += 0.013  # the work done each tick must not add up
+        self.assertAlmostEqual(clock.now, 100.0 + 100 * 0.02 + 0.013)
+        self.assertEqual(scheduler.stats()['missed_deadlines'], 0)
+
+    def test_missed_deadlines(self):
+        clock = FakeClock()
+        scheduler = DeadlineScheduler(10, clock=clock, sleep=clock.sleep)
+        scheduler.wait()
+        clock.now += 0.35  # overrun by more than three periods
+        lateness = scheduler.wait()
+        self.assertAlmostEqual(lateness, 0.05)
+        stats = scheduler.stats()
+        self.assertEqual(stats['missed_deadlines'], 2)
+        self.assertEqual(stats['ticks'], 2)
+        # and then we are back on the original grid
+        scheduler.wait()
+        self.assertAlmostEqual(clock.now, 100.5)
+
+    def test_bad_rate(self):
+        with self.assertRaises(ValueError):
+            DeadlineScheduler(0)
+
+
+if __name__ == '__main__':
+    unittest.main()
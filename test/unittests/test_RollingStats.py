@@ -0,0 +1,56 @@
+import threading
+import unittest
+import numpy as np
+
+from hardware.RollingStats import RollingStatistics
+
+
+class TestRollingStatistics(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = RollingStatistics(history=20, initial_capacity=16)
+        self.stats.set_columns(['time [s]', 'flow'])
+
+    def feed(self, times, values):
+        self.stats.extend(np.array([times, values]))
+
+    def test_matches_direct_computation(self):
+        random = np.random.default_rng(0)
+        times = 1.6e9 + np.arange(2000) / 10
+        values = 3 * (times - times[0]) + random.standard_normal(len(times))
+        values[::7] = np.nan
+        # in blocks of all sizes, so the sums are compacted and rebased along the way
+        for i in range(0, len(times), 37):
+            self.feed(times[i:i+37], values[i:i+37])
+        s = self.stats.stats('flow', 5)
+        in_window = times >= times[-1] - 5
+        t, x = times[in_window], values[in_window]
+        t, x = t[~np.isnan(x)], x[~np.isnan(x)]
+        self.assertEqual(s['n'], len(x))
+        self.assertAlmostEqual(s['mean'], x.mean(), places=6)
+        self.assertAlmostEqual(s['std'], x.std(), places=6)
+        self.assertAlmostEqual(s['slope'], np.polyfit(t - t[0], x, 1)[0], places=6)
+        self.assertEqual((s['min'], s['max']), (x.min(), x.max()))
+        self.assertEqual(s['span'], 5)
+
+    def test_wait_until_stable(self):
+        # settling towards 25 µL/min
+        times = np.arange(0, 20, 0.1)
+        values = 25 - 10 * np.exp(-times)
+        self.feed(times[:30], values[:30])
+        self.assertFalse(self.stats.is_stable('flow', 0.1, 2))
+        self.assertFalse(self.stats.wait_until_stable('flow', 0.1, 2, timeout=0.05))
+
+        waiter_result = []
+        waiter = threading.Thread(target=lambda: waiter_result.append(self.stats.wait_until_stable('flow', 0.1, 2, target=25, timeout=10)))
+        waiter.start()
+        self.feed(times[30:], values[30:])
+        waiter.join()
+        self.assertEqual(waiter_result, [True])
+        self.assertFalse(self.stats.is_stable('flow', 0.1, 2, target=20))
+        # a window longer than the data isn't stable yet, however flat the data are
+        self.assertFalse(self.stats.is_stable('flow', 100, 19.95 + 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import csv
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import Mock
+import numpy as np
+
+from hardware.SampleBuffer import SampleRingBuffer
+from hardware.RunWriter import RunWriter, CsvSink, ColumnSink, load_run, convert_run_to_csv
+
+
+class BufferSource:
+    """the part of an Elveflow handler that RunWriter uses"""
+    def __init__(self, columns, capacity=1000):
+        self.buffer = SampleRingBuffer(columns, capacity=capacity)
+
+    def read_since(self, cursor):
+        return self.buffer.read_since(cursor)
+
+    def current_cursor(self):
+        return self.buffer.cursor
+
+
+class TestRunWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'run.csv')
+        self.source = BufferSource(['time [s]', 'Pressure 1 [mbar]'])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def read_csv(self):
+        with open(self.path, encoding='utf-8', newline='') as f:
+            return list(csv.reader(f))
+
+    def test_no_samples_lost_on_stop(self):
+        self.source.buffer.append_block([[0, 1], [5, 6]])  # before saving started: not saved
+        writer = RunWriter(self.source, CsvSink(self.path, self.source.buffer.columns), errorlogger=Mock(),
+                           flush_rows=10**6, flush_interval=10**6, fsync_interval=0)
+        writer.start()
+        producer = threading.Thread(target=lambda: [self.source.buffer.append([1e9 + i / 10, i]) for i in range(500)])
+        producer.start()
+        producer.join()
+        writer.stop()
+
+        rows = self.read_csv()
+        self.assertEqual(rows[0], ['time [s]', 'Pressure 1 [mbar]'])
+        self.assertEqual(len(rows), 501)
+        np.testing.assert_array_equal(np.array(rows[1:], dtype=float)[:, 1], np.arange(500))
+        self.assertEqual(rows[2], ['1000000000.1', '1'])
+        self.assertEqual(writer.stats(), {'rows_written': 500, 'rows_lost': 0, 'backlog': 0})
+
+    def test_numbers_read_back_exactly(self):
+        times = 1.7e9 + np.array([0.123456789, 1 / 3, 2 / 3])
+        sink = CsvSink(self.path, self.source.buffer.columns)
+        sink.write_block(np.array([times, [0.1, 1e-300, -np.pi]]))
+        sink.close()
+        rows = np.array(self.read_csv()[1:], dtype=float)
+        np.testing.assert_array_equal(rows[:, 0], times)
+        np.testing.assert_array_equal(rows[:, 1], [0.1, 1e-300, -np.pi])
+
+    def test_lost_samples_are_counted(self):
+        errorlogger = Mock()
+        writer = RunWriter(self.source, CsvSink(self.path, ['a,b', 'c']), errorlogger=errorlogger)
+        writer.cursor = 0
+        self.source.buffer.append_block(np.zeros((2, 1500)))
+        writer._collect()
+        self.assertEqual(writer.rows_lost, 500)
+        self.assertEqual(writer.backlog(), 1000)
+        errorlogger.error.assert_called_once()
+        writer._write()
+        writer.sink.close()
+        rows = self.read_csv()
+        self.assertEqual(rows[0], ['a,b', 'c'])
+        self.assertEqual(len(rows), 1001)
+
+
+class TestColumnSink(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'run_1.run')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_round_trip_and_csv(self):
+        header = ['time [s]', 'Pressure 1 [mbar]']
+        sink = ColumnSink(self.path, header, start_time=123.0, config={'Elveflow': {'save_format': 'columns'}})
+        metadata, columns = load_run(self.path)  # readable straight away, with no rows
+        self.assertEqual(len(columns['time [s]']), 0)
+
+        sink.write_block(np.array([[1.5, 2.5], [10, np.nan]]))
+        sink.add_marker(2.0, 'chartreuse')
+        sink.flush(fsync=True)
+        sink.write_block(np.array([[3.5], [30]]))
+        sink.close()
+
+        metadata, columns = load_run(self.path)
+        self.assertEqual(metadata['rows'], 3)
+        self.assertEqual(metadata['start_time'], 123.0)
+        self.assertEqual(metadata['markers'], [{'time': 2.0, 'color': 'chartreuse'}])
+        self.assertEqual(metadata['config']['Elveflow']['save_format'], 'columns')
+        self.assertIsInstance(columns['time [s]'], np.memmap)
+        np.testing.assert_array_equal(columns['Pressure 1 [mbar]'], [10, np.nan, 30])
+        np.testing.assert_array_equal(np.load(os.path.join(self.path, 'column_00.npy')), [1.5, 2.5, 3.5])
+
+        csv_path = convert_run_to_csv(self.path, chunk_rows=2)
+        self.assertEqual(csv_path, os.path.join(self.folder, 'run_1.csv'))
+        with open(csv_path, encoding='utf-8', newline='') as f:
+            self.assertEqual(list(csv.reader(f)), [header, ['1.5', '10'], ['2.5', 'nan'], ['3.5', '30']])
+
+    def test_through_run_writer(self):
+        source = BufferSource(['a', 'b'])
+        writer = RunWriter(source, ColumnSink(self.path, ['a', 'b']), errorlogger=Mock())
+        writer.start()
+        source.buffer.append_block(np.arange(20.0).reshape(2, 10))
+        writer.stop()
+        _, columns = load_run(self.path)
+        np.testing.assert_array_equal(columns['b'], np.arange(10, 20))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,10 @@
+import os
 import unittest
-from unittest.mock import patch, Mock, PropertyMock
+from unittest.mock import patch, Mock
 
-from SAXSDrivers import list_available_ports, stop_instruments, SAXSController, HPump
+from hardware.SAXSDrivers import list_available_ports, InstrumentTerminateFunction, SAXSController, HPump
+from hardware.SerialSimulator import HarvardPumps, PseudoTerminal, SimulatedController
+from hardware.SerialTransport import run, transport_for
 
 
 class TestDrivers(unittest.TestCase):
@@ -9,32 +12,33 @@ class TestDrivers(unittest.TestCase):
     @patch('serial.tools.list_ports.comports')
     def test_list_ports(self, mock_comports):
         mock_comports.return_value = [1,2,3]
-        self.assertEquals(len(list_available_ports()), 3)
-        self.assertEquals(len(list_available_ports([1])), 3)
+        self.assertEqual(len(list_available_ports()), 3)
+        self.assertEqual(len(list_available_ports([1])), 3)
 
     def test_stop_instruments(self):
         mock_instrument = Mock()
         with self.assertRaises(TypeError):
-            stop_instruments(mock_instrument)
-        stop_instruments([mock_instrument])
+            InstrumentTerminateFunction(mock_instrument)
+        InstrumentTerminateFunction([mock_instrument])
         mock_instrument.stop.assert_called_once()
         mock_instrument.reset_mock()
-        stop_instruments([mock_instrument, mock_instrument])
-        self.assertEquals(mock_instrument.stop.call_count, 2)
+        InstrumentTerminateFunction([mock_instrument, mock_instrument])
+        self.assertEqual(mock_instrument.stop.call_count, 2)
 
 
+@patch('hardware.SAXSDrivers.WireLog', Mock())
 class TestSAXSController(unittest.TestCase):
 
-    @patch('SAXSDrivers.SAXSController.open')
+    @patch('hardware.SAXSDrivers.SAXSController.open')
     def test_set_port(self, mock_open):
-        test_controller = SAXSController()
+        test_controller = SAXSController(logger=Mock())
+        test_controller.fd = None  # as a real open would set it, on posix
         test_controller.close = Mock(wraps=test_controller.close)
         test_controller.is_open = False
         test_controller.set_port('COM1')
         test_controller.close.assert_not_called()
         mock_open.assert_called_once()
 
-        #mock_close.reset_mock()
         mock_open.reset_mock()
         test_controller.close.reset_mock()
 
@@ -43,70 +47,66 @@ class TestSAXSController(unittest.TestCase):
         test_controller.close.assert_called_once()
         mock_open.assert_called_once()
 
-    @patch('SAXSDrivers.SAXSController.open')
-    @patch('serial.Serial.write')
-    def test_scan(self, mock_write, mock_open):
-        test_controller = SAXSController()
-        type(test_controller).in_waiting = PropertyMock(return_value=0)
+    @unittest.skipUnless(os.name == 'posix', "the simulators run on pseudo-terminals")
+    @patch.object(SimulatedController, 'SCAN_PAUSE', 0)
+    def test_scan(self):
+        simulator = SimulatedController()
+        terminal = PseudoTerminal(simulator)
+        test_controller = SAXSController(logger=Mock(), timeout=0.1)
+        try:
+            with self.assertRaises(ValueError):
+                test_controller.scan_i2c()
+            test_controller.set_port(terminal.name)
+            test_controller.scan_i2c()
+            self.assertEqual(simulator.commands, [b'I'])
+            test_controller.logger.info.assert_any_call("No I2C devices found")
+
+            # closed, and opened again to scan
+            run(transport_for(test_controller).close())
+            test_controller.scan_i2c()
+            self.assertEqual(simulator.commands, [b'I', b'I'])
+        finally:
+            run(transport_for(test_controller).close())
+            terminal.close()
 
-        test_controller.is_open = False
-        test_controller.scan_i2c()
-        mock_open.assert_called_once()
-        mock_write.assert_called_with(b'I')
-
-        mock_open.reset_mock()
-        mock_write.reset_mock()
-
-        test_controller.is_open = True
-        test_controller.scan_i2c()
-        mock_open.assert_not_called()
-        mock_write.assert_called_with(b'I')
 
 class TestHPump(unittest.TestCase):
 
-    @patch('SAXSDrivers.HPump.pumpserial')
+    def tearDown(self):
+        HPump.enabled = False
+
+    @patch('hardware.SAXSDrivers.HPump.pumpserial')
     def test_set_port(self, mock_serial):
-        test_pump = HPump()
-        test_pump.set_port('COM1')
+        test_pump = HPump(logger=Mock())
+        test_pump.set_port('COM1', resource=mock_serial)
         self.assertTrue(HPump.enabled)
         self.assertTrue(test_pump.pc_connect)
-
-    @patch('SAXSDrivers.HPump.pumpserial.open')
-    @patch('SAXSDrivers.HPump.pumpserial.write')
-    @patch('SAXSDrivers.HPump.pumpserial.close')
-    def test_stop_pump(self, mock_close, mock_write, mock_open):
-        test_pump = HPump()
-
-        HPump.enabled = True
-        self.pc_connect = True
-        test_pump.start_pump()
-        mock_close.assert_called_once()
-        mock_write.assert_called_once()
-        mock_open.assert_called_once()
-
-        mock_close.reset_mock()
-        mock_write.reset_mock()
-        mock_open.reset_mock()
-
-        self.pc_connect = False
-        mock_controller = Mock(is_open=False)
-        test_pump.set_to_controller(mock_controller)
-        test_pump.start_pump()
-        mock_controller.open.assert_called_once()
-        mock_controller.open.reset_mock()
-
-        mock_controller.is_open = True
-        test_pump.start_pump()
-        mock_controller.open.assert_not_called()
-        mock_controller.write.assert_called()
-
-
-
-
-
-
-
-
+        self.assertEqual(mock_serial.port, 'COM1')
+
+    @unittest.skipUnless(os.name == 'posix', "the simulators run on pseudo-terminals")
+    @patch('hardware.SAXSDrivers.WireLog', Mock())
+    def test_start_pump(self):
+        pumps = HarvardPumps()
+        simulator = SimulatedController(pumps=HarvardPumps())
+        terminals = [PseudoTerminal(pumps), PseudoTerminal(simulator)]
+        test_pump = HPump(logger=Mock())
+        test_controller = SAXSController(logger=Mock(), timeout=0.1)
+        try:
+            test_pump.set_port(terminals[0].name)
+            test_pump.start_pump()
+            self.assertEqual(pumps.commands, ["0RUN"])
+            self.assertTrue(pumps.pumps[0].running)
+
+            test_controller.set_port(terminals[1].name)
+            test_pump.set_to_controller(test_controller)
+            test_pump.start_pump()
+            self.assertEqual(simulator.commands, [b"-0RUN\n\r"])
+            self.assertTrue(simulator.pumps.pumps[0].running)
+        finally:
+            test_pump.close()
+            run(transport_for(test_controller).close())
+            for terminal in terminals:
+                terminal.close()
 
 
 if __name__ == '__main__':
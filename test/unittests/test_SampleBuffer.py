@@ -0,0 +1,62 @@
+import unittest
+import numpy as np
+
+from hardware.SampleBuffer import SampleRingBuffer
+
+
+class TestSampleRingBuffer(unittest.TestCase):
+
+    def test_read_since(self):
+        buffer = SampleRingBuffer(['a', 'b'], capacity=8)
+        cursor, block = buffer.read_since(0)
+        self.assertEqual(cursor, 0)
+        self.assertEqual(block.shape, (2, 0))
+
+        for i in range(5):
+            buffer.append([i, 10*i])
+        cursor, block = buffer.read_since(0)
+        self.assertEqual(cursor, 5)
+        np.testing.assert_array_equal(block, [[0, 1, 2, 3, 4], [0, 10, 20, 30, 40]])
+
+        buffer.append([5, 50])
+        cursor, block = buffer.read_since(cursor)
+        self.assertEqual(cursor, 6)
+        np.testing.assert_array_equal(block, [[5], [50]])
+
+    def test_wraparound_and_overrun(self):
+        buffer = SampleRingBuffer(['a'], capacity=4)
+        for i in range(6):
+            buffer.append([i])
+        cursor, block = buffer.read_since(3)
+        self.assertEqual(cursor, 6)
+        np.testing.assert_array_equal(block, [[3, 4, 5]])
+
+        # a reader that fell behind only gets what is still there
+        cursor, block = buffer.read_since(0)
+        np.testing.assert_array_equal(block, [[2, 3, 4, 5]])
+        self.assertEqual(buffer.overruns, 2)
+        np.testing.assert_array_equal(buffer.latest(), [5])
+
+    def test_append_block(self):
+        buffer = SampleRingBuffer(['a', 'b'], capacity=4)
+        buffer.append_block([[0, 1, 2], [0, -1, -2]])
+        buffer.append_block([[3, 4], [-3, -4]])
+        cursor, block = buffer.read_since(1)
+        self.assertEqual(cursor, 5)
+        np.testing.assert_array_equal(block, [[1, 2, 3, 4], [-1, -2, -3, -4]])
+
+        # a block bigger than the whole buffer keeps only its newest rows
+        buffer.append_block(np.arange(12).reshape(2, 6))
+        cursor, block = buffer.read_since(cursor)
+        self.assertEqual(cursor, 11)
+        np.testing.assert_array_equal(block, [[2, 3, 4, 5], [8, 9, 10, 11]])
+
+    def test_rows_as_dicts(self):
+        buffer = SampleRingBuffer(['a', 'b'], capacity=4)
+        buffer.append([1, 2])
+        _, block = buffer.read_since(0)
+        self.assertEqual(buffer.rows_as_dicts(block), [{'a': 1.0, 'b': 2.0}])
+
+
+if __name__ == '__main__':
+    unittest.main()
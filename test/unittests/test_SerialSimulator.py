@@ -0,0 +1,143 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import Mock, patch
+import serial
+
+from hardware.SAXSDrivers import HPump, Rheodyne, VICI, SAXSController, async_pumps_running
+from hardware.SerialSimulator import (HarvardPumps, PseudoTerminal, RheodyneValve, SimulatedBench, SimulatedController,
+                                      VICIValve, time_buffer_sample_buffer)
+from hardware.SerialTransport import run, transport_for
+
+
+@unittest.skipUnless(os.name == 'posix', "the simulators run on pseudo-terminals")
+class TestSimulators(unittest.TestCase):
+
+    def setUp(self):
+        self.terminals = []
+        self.ports = []
+        HPump.enabled = True
+
+    def tearDown(self):
+        HPump.enabled = False
+        for port in self.ports:
+            run(transport_for(port).close())
+        for terminal in self.terminals:
+            terminal.close()
+
+    def open(self, device, **kwargs):
+        terminal = PseudoTerminal(device)
+        self.terminals.append(terminal)
+        port = serial.Serial(terminal.name, timeout=0.1, **kwargs)
+        self.ports.append(port)
+        return port
+
+    def test_pump_chain(self):
+        pumps = HarvardPumps(addresses=(0, 1), delay=0.2)
+        port = self.open(pumps, baudrate=9600, stopbits=2)
+        pump = HPump(address=1, logger=Mock())
+        pump.infuse_volume(0.01, 600, resource=port)  # 1 s
+        self.assertEqual(pumps.commands[-1], "1RUN")
+        self.assertEqual(pump.check_target_volume(resource=port), 0.01)
+        start = time.monotonic()
+        self.assertEqual(run(async_pumps_running([HPump(address=0, logger=Mock()), pump], resource=port)), [False, True])
+        # both asked at once
+        self.assertLess(time.monotonic() - start, 0.35)
+        time.sleep(0.8)
+        self.assertEqual(pump.get_delivered_volume(resource=port), 0.01)
+        self.assertEqual(pump.status(resource=port), ":")
+        pump.start_pump(resource=port)
+        pump.stop_pump(resource=port)
+        self.assertEqual(pump.status(resource=port), "*")
+
+    def test_valves(self):
+        rheodyne = Rheodyne(logger=Mock())
+        rheodyne.set_port(self.open(RheodyneValve(switch_time=0.3), baudrate=19200).port)
+        self.ports.append(rheodyne.serial_object)
+        start = time.monotonic()
+        rheodyne.switchvalve(4)
+        # still moving when first asked, so asked again
+        self.assertGreater(time.monotonic() - start, 0.3)
+        self.assertEqual(rheodyne.statuscheck(), "04")
+        vici_valve = VICIValve()
+        vici = VICI(logger=Mock())
+        vici.set_port(self.open(vici_valve, baudrate=9600).port)
+        self.ports.append(vici.serialobject)
+        vici.switchvalve(1)
+        time.sleep(VICIValve.SWITCH_TIME)
+        vici.currentposition()
+        vici.logger.info.assert_called_with("Position is = B")
+        self.assertEqual(vici_valve.commands, ["GOB", "CP"])
+
+    @patch.object(SimulatedController, 'SCAN_PAUSE', 0)
+    def test_controller(self):
+        directory = tempfile.TemporaryDirectory()
+        valve = RheodyneValve(i2c_address=6)
+        simulator = SimulatedController(HarvardPumps(), VICIValve(), [valve])
+        self.terminals.append(PseudoTerminal(simulator))
+        cwd = os.getcwd()
+        os.chdir(directory.name)  # for the controller's log
+        try:
+            controller = SAXSController(logger=Mock(), timeout=0.1)
+        finally:
+            os.chdir(cwd)
+        self.ports.append(controller)
+        try:
+            controller.set_port(self.terminals[0].name)
+            controller.scan_i2c()
+            controller.logger.info.assert_any_call("I2C device found at address 0x03  !")
+            rheodyne = Rheodyne(logger=Mock(), address_I2C=6)
+            rheodyne.set_to_controller(controller)
+            rheodyne.switchvalve(2)
+            self.assertEqual(valve.position(), 2)
+            pump = HPump(logger=Mock())
+            pump.set_to_controller(controller)
+            pump.start_pump()
+            self.assertEqual(simulator.commands[-1], b"-0RUN\n\r")
+            pump.stop()
+            time.sleep(0.2)
+            self.assertFalse(simulator.pumps.pumps[0].running)
+        finally:
+            controller.wire_log.close()
+            directory.cleanup()
+
+
+@unittest.skipUnless(os.name == 'posix', "the simulators run on pseudo-terminals")
+class TestBench(unittest.TestCase):
+
+    def test_buffer_sample_buffer(self):
+        directory = tempfile.TemporaryDirectory()
+        cwd = os.getcwd()
+        for via_controller in (False, True):
+            bench = SimulatedBench(via_controller=via_controller)
+            os.chdir(directory.name)
+            try:
+                pump, oil_valve, sample_valve, loading_valve, controller = bench.connect(logger=Mock())
+            finally:
+                os.chdir(cwd)
+            try:
+                timings = time_buffer_sample_buffer(pump, oil_valve, sample_valve, loading_valve, volumes=(0.002, 0.003, 0.002))
+            finally:
+                for instrument in (pump, oil_valve, sample_valve, loading_valve):
+                    instrument.close()
+                if controller is not None:
+                    run(transport_for(controller).close())
+                    controller.wire_log.close()
+                bench.close()
+                HPump.enabled = False
+            self.assertEqual(len(timings), 15)
+            self.assertEqual(bench.sample_valve.position(), 'A')
+            self.assertEqual(bench.pumps.pumps[0].delivered(), 0.002)
+            pumping = sum(seconds for step, seconds in timings if step.endswith("wait for pump"))
+            # 7 µL at 10 µL/s, each stop noticed within a status query and a volume query
+            self.assertGreater(pumping, 0.65)
+            self.assertLess(pumping, 0.7 + 3 * (0.15 + 2 * SimulatedController.FORWARD_DELAY * via_controller))
+            if via_controller:
+                # every pump command is held up by the controller's 100 ms
+                self.assertGreater(dict(timings)["sample: start pump"], 9 * SimulatedController.FORWARD_DELAY)
+        directory.cleanup()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+import numpy as np
+
+from hardware.TraceStore import TraceStore
+
+
+class TestTraceStore(unittest.TestCase):
+
+    def test_append_and_grow(self):
+        store = TraceStore(['time', 'p'], time_column='time', time_origin=1000.0, initial_capacity=4)
+        store.append_block([[1000.0, 1001.0, 1002.0], [5.0, np.nan, 7.0]])
+        early_view = store.column('p')
+        self.assertEqual(store.n_spilled, 0)
+        store.append_block([[1003.0, 1004.0, 1005.0], [1.0, 9.0, 2.0]])
+
+        self.assertEqual(len(store), 6)
+        np.testing.assert_array_equal(store.column('time'), [0, 1, 2, 3, 4, 5])
+        np.testing.assert_array_equal(early_view, [5, np.nan, 7])
+        self.assertEqual(store.extrema('p'), (1.0, 9.0))
+        self.assertEqual(store.extrema('time'), (0.0, 5.0))
+        self.assertEqual(store.latest('p'), 2.0)
+
+    def test_time_window(self):
+        store = TraceStore(['time', 'p'], time_column='time')
+        # a clock that steps backwards, and a missing time, must not break the search
+        store.append_block([[0, 1, 2, np.nan, 4, 3.5, 6, 7], [0, 1, 2, 3, 4, 5, 6, 7]])
+        self.assertEqual(store.index_range(2, 5), (2, 6))
+        self.assertEqual(store.index_range(None, 1), (0, 1))
+        window = store.time_window(['p'], 6)
+        np.testing.assert_array_equal(window['p'], [6, 7])
+        self.assertFalse(window['p'].flags.writeable)
+        self.assertFalse(window['p'].flags.owndata)
+        self.assertTrue(np.isnan(store.column('time')[3]))
+
+    def test_views_are_read_only(self):
+        store = TraceStore(['a'])
+        store.append_block([[1.0]])
+        with self.assertRaises(ValueError):
+            store.column('a')[0] = 2.0
+
+    def test_empty(self):
+        store = TraceStore(['a', 'b'])
+        store.append_block(np.empty((2, 0)))
+        self.assertEqual(len(store.column('a')), 0)
+        with self.assertRaises(ValueError):
+            store.extrema('a')
+        with self.assertRaises(IndexError):
+            store.latest('b')
+        store.append_block([[np.nan], [1.0]])
+        with self.assertRaises(ValueError):
+            store.extrema('a')
+
+    def test_spill_to_disk(self):
+        store = TraceStore(['time', 'p'], time_column='time', time_origin=10.0, initial_capacity=64, hot_seconds=50)
+        for start in range(0, 1000, 25):
+            t = np.arange(start, start + 25, dtype=float)
+            store.append_block([t + 10.0, t * 2])
+            self.assertLessEqual(store.window('time', store.n_spilled).shape[0], 128)
+        self.assertEqual(len(store), 1000)
+        self.assertGreater(store.n_spilled, 800)
+        np.testing.assert_array_equal(store.column('p'), np.arange(1000) * 2)
+        np.testing.assert_array_equal(store.window('time', 10, 20), np.arange(10, 20))
+        np.testing.assert_array_equal(store.take('p', [0, 500, store.n_spilled, 999]),
+                                      [0, 1000, 2 * store.n_spilled, 1998])
+        self.assertEqual(store.latest('time'), 999)
+        self.assertEqual(store.index_range(123.5), (124, 1000))
+        self.assertEqual(store.index_range(990, 995), (990, 995))
+        self.assertEqual(store.index_range(5000), (1000, 1000))
+        window = store.time_window(['time', 'p'], 100, 110)
+        np.testing.assert_array_equal(window['p'], np.arange(100, 110) * 2)
+        self.assertEqual(store.extrema('p'), (0, 1998))
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
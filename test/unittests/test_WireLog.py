@@ -0,0 +1,76 @@
+import ast
+import os
+import re
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import Mock
+
+from hardware.SAXSDrivers import HPump
+from hardware.SerialTransport import run, transport_for
+from hardware.WireLog import WireLog
+from test_HPump import FakePumpPort
+
+
+class TestWireLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'pump.log')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_both_directions_are_logged(self):
+        HPump.enabled = True
+        port = FakePumpPort()
+        port.wire_log = WireLog(self.path, errorlogger=Mock(), flush_interval=0.05)
+        try:
+            HPump(address=0, logger=Mock()).is_running(resource=port)
+            time.sleep(0.2)
+            # written out in the background, without waiting for close
+            with open(self.path) as f:
+                lines = f.readlines()
+        finally:
+            HPump.enabled = False
+            run(transport_for(port).close())
+            port.wire_log.close()
+        self.assertEqual(lines[0].split(' ', 2)[2], "TX b'0\\n\\r'\n")
+        self.assertRegex(lines[0], r"^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d{6} TX ")
+        self.assertEqual(b"".join(ast.literal_eval(line.split(' RX ')[1]) for line in lines[1:]), b"\n\r0:")
+
+    def test_recent_traffic_is_kept_for_a_dump(self):
+        log = WireLog(self.path, errorlogger=Mock(), capacity=1000, flush_interval=60)
+        try:
+            for i in range(200):
+                log.record('RX', b"%09d\n" % i)
+            # the writer never got a look in, so all but the last 1000 bytes are gone
+            dump = log.dump("testing", size=100)
+            with open(dump) as f:
+                self.assertEqual(f.readline(), "# testing\n")
+                self.assertEqual([ast.literal_eval(line.split(' RX ')[1]) for line in f], [b"%09d\n" % i for i in range(190, 200)])
+            log.record('TX', b"bye")
+        finally:
+            log.close()
+        self.assertEqual(log.records_lost, 100)
+        with open(self.path) as f:
+            lines = f.readlines()
+        self.assertEqual(lines[0], "# 100 records lost: the log fell behind\n")
+        self.assertEqual(len(lines), 1 + 100 + 1)
+        self.assertTrue(lines[-1].endswith(" TX b'bye'\n"))
+
+    def test_recording_from_many_threads(self):
+        log = WireLog(self.path, errorlogger=Mock(), flush_interval=0.01)
+        threads = [threading.Thread(target=lambda: [log.record('RX', b"x") for _ in range(1000)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        log.close()
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 4000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+"""Redraw a matplotlib figure embedded in Tk from the Tk event loop, using blitting.
+
+Drawing a whole figure is slow, and matplotlib and Tk both expect to be driven from the main
+thread. BlitRenderer runs on the Tk main loop with `after()`, at most `max_frame_rate`
+times a second, and only when someone has said the data changed. Usually it just pastes a
+cached picture of the axes (the background) and draws the lines on top of it; the whole
+figure is only redrawn when the axes themselves (limits, labels, size) change.
+"""
+import logging
+import threading
+import tkinter as tk
+
+
+class BlitRenderer:
+    """Draw `artists` on `canvas` (a FigureCanvasTkAgg) from the Tk event loop of `widget`.
+
+    draw_frame is called on the Tk thread before each frame. It should update the artists
+    (e.g. Line2D.set_data) and anything else that lives on the Tk thread, and return True if
+    it changed anything else on the figure (e.g. axis limits), in which case the whole figure
+    is redrawn. An error in a frame is logged and the next frame goes ahead as usual."""
+    MAX_FRAME_RATE = 5  # frames per second
+
+    def __init__(self, widget, canvas, draw_frame, artists=(), max_frame_rate=MAX_FRAME_RATE, errorlogger=None):
+        if not max_frame_rate > 0:
+            raise ValueError("the frame rate must be positive, not %s" % max_frame_rate)
+        self.widget = widget
+        self.canvas = canvas
+        self.draw_frame = draw_frame
+        self.errorlogger = errorlogger if errorlogger is not None else logging.getLogger('python')
+        self.period_ms = max(1, int(round(1000 / max_frame_rate)))
+        self.artists = []
+        self.frames = 0
+        self.full_redraws = 0
+        self._dirty = threading.Event()
+        self._full_redraw_needed = True
+        self._drawing = False
+        self._background = None
+        self._after_id = None
+        self._last_error = None  # logged once, not every frame it happens
+        self.set_artists(artists)
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+
+    def set_artists(self, artists):
+        """change which artists are redrawn every frame. Takes effect at the next frame"""
+        for artist in self.artists:
+            artist.set_animated(False)
+        self.artists = list(artists)
+        for artist in self.artists:
+            # animated artists are left out of full redraws, so the cached background doesn't have them
+            artist.set_animated(True)
+        self.invalidate()
+
+    def mark_dirty(self):
+        """ask for a new frame. Safe to call from any thread"""
+        self._dirty.set()
+
+    def invalidate(self):
+        """ask for a new frame, redrawing the whole figure. Safe to call from any thread"""
+        self._full_redraw_needed = True
+        self._dirty.set()
+
+    def start(self):
+        if self._after_id is None:
+            self._after_id = self.widget.after(self.period_ms, self._frame)
+
+    def stop(self):
+        if self._after_id is not None:
+            try:
+                self.widget.after_cancel(self._after_id)
+            except tk.TclError:
+                pass  # the window is already gone
+            self._after_id = None
+
+    def _frame(self):
+        self._after_id = None
+        try:
+            if self._dirty.is_set():
+                self._dirty.clear()
+                if self.draw_frame():
+                    self._full_redraw_needed = True
+                self._render()
+            self._last_error = None
+        except tk.TclError:
+            return  # the window was closed under us: stop quietly
+        except Exception as e:
+            if repr(e) != self._last_error:
+                self.errorlogger.exception("Error drawing the graph")
+            self._last_error = repr(e)
+        try:
+            self._after_id = self.widget.after(self.period_ms, self._frame)
+        except tk.TclError:
+            pass
+
+    def _render(self):
+        figure = self.canvas.figure
+        if self._full_redraw_needed or self._background is None:
+            self._drawing = True
+            try:
+                self.canvas.draw()  # caches the background, through _on_draw
+            finally:
+                self._drawing = False
+            self.full_redraws += 1
+        else:
+            self.canvas.restore_region(self._background)
+        for artist in self.artists:
+            figure.draw_artist(artist)
+        self.canvas.blit(figure.bbox)
+        self.frames += 1
+
+    def _on_draw(self, event):
+        self._background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self._full_redraw_needed = False
+        if not self._drawing:
+            # someone else (e.g. a window resize) redrew the figure without our artists
+            self._dirty.set()
@@ -1,9 +1,13 @@
 import tkinter as tk
 import tkinter.font
 import logging
-import csv
 import numpy as np
-from hardware import FileIO
+from hardware import FileIO, ElveflowSimulator
+from hardware.TraceStore import TraceStore
+from widgets.PlotDecimator import MinMaxPyramid
+from widgets.BlitRenderer import BlitRenderer
+from hardware.RunWriter import RunWriter, CsvSink, ColumnSink
+from hardware.RollingStats import RollingStatistics
 import threading
 import time
 import os.path
@@ -21,6 +25,9 @@ logger = logging.getLogger('python')
 class ElveflowDisplay(tk.Canvas):
     """Build a widget to show the Elveflow graph."""
     POLLING_PERIOD = 1
+    HISTORY_MINUTES = 60  # how much Elveflow history to keep in memory; older data goes to a temporary file
+    FRAME_RATE = 5  # maximum redraws of the graph per second
+    AUTOSCALE_HEADROOM = 0.05  # fraction of the data range left free on each side of auto-scaled axes
     PADDING = 2
     OUTPUT_FOLDER = "Elveflow"
     COLOR_Y1 = 'tab:red'
@@ -70,7 +77,7 @@ class ElveflowDisplay(tk.Canvas):
         self.exit_lock = threading.Lock() # to make shutdown not hang.
         self.run_flag = threading.Event()
         self.save_flag = threading.Event()
-        self.saveFileNameSuffix_var.set("_%d.csv" % time.time())
+        self.saveFileNameSuffix_var.set(self._save_suffix())
 
         # tkinter elements
         # https://stackoverflow.com/questions/31440167/placing-plot-on-tkinter-main-window-in-python
@@ -189,19 +196,39 @@ class ElveflowDisplay(tk.Canvas):
         self.canvas = matplotlib.backends.backend_tkagg.FigureCanvasTkAgg(self.the_fig, self)
         self.canvas.draw()
         self.canvas.get_tk_widget().grid(row=0, column=0, rowspan=rowcounter, padx=ElveflowDisplay.PADDING, pady=ElveflowDisplay.PADDING)
+        # draws from the Tk event loop, whenever the poll thread says there's new data
+        self.renderer = BlitRenderer(self, self.canvas, self.update_plot,
+                                     max_frame_rate=float(self.elveflow_config.get('plot_frame_rate', ElveflowDisplay.FRAME_RATE)),
+                                     errorlogger=self.errorlogger)
+        for var in (self.data_x_label_var, self.data_y1_label_var, self.data_y2_label_var, self.data_y3_label_var):
+            var.trace('w', lambda *_: self.renderer.invalidate())
 
         self._initialize_variables()
+        self.renderer.start()
         self.run_flag.set()
 
     def _initialize_variables(self):
         """create or reset all the internal variables"""
         self.elveflow_handler = None
-        self.data = []
+        # the poll thread appends under exit_lock, and stop() has already told it to finish
+        with self.exit_lock:
+            if getattr(self, 'data', None) is not None:
+                self.data.close()  # deletes its spill file
+            self.data = None  # a TraceStore, created once the handler knows its header
+        self.data_cursor = 0  # how far into the handler's buffer we have read
+        self.pyramids = {}  # a MinMaxPyramid per column of self.data, for decimating the plots
+        self.flow_stats = None  # RollingStatistics of the handler's samples, while it runs
         self.run_flag.clear()
         self.save_flag.clear()
+        for line in getattr(self, 'the_lines', []):
+            line.remove()
         self.the_line1 = self.ax1.plot([], [], color=ElveflowDisplay.COLOR_Y1)[0]
         self.the_line2 = self.ax2.plot([], [], color=ElveflowDisplay.COLOR_Y2)[0]
         self.the_line3 = self.ax3.plot([], [], color=ElveflowDisplay.COLOR_Y3)[0]
+        self.the_lines = [self.the_line1, self.the_line2, self.the_line3]
+        self.renderer.set_artists(self.the_lines)
+        self.axes_state = None  # the labels and limits the axes were last drawn with
+        self.autoscale_limits = [None, None, None, None]  # x, y1, y2, y3
         self.data_x_label_optionmenu.config(state=tk.DISABLED)
         self.data_y1_label_optionmenu.config(state=tk.DISABLED)
         self.data_y2_label_optionmenu.config(state=tk.DISABLED)
@@ -233,6 +260,21 @@ class ElveflowDisplay(tk.Canvas):
             self.data_y2_label_optionmenu['menu'].add_command(label=item, command=lambda item=item: self.data_y2_label_var.set(item))
             self.data_y3_label_optionmenu['menu'].add_command(label=item, command=lambda item=item: self.data_y3_label_var.set(item))
 
+    def _backend(self):
+        """elveflow_backend from the config: sdk (the real OB1), simulator or replay"""
+        backend = self.elveflow_config.get('elveflow_backend', 'sdk').strip().lower()
+        if backend not in ('sdk', 'simulator', 'replay'):
+            self.errorlogger.warning("Unknown elveflow_backend %r; using the Elveflow SDK" % backend)
+            return 'sdk'
+        return backend
+
+    def _sdk_backend(self):
+        """the OB1 functions to use: None for the real Elveflow64.dll, or a SimulatedOB1"""
+        if self._backend() == 'simulator':
+            self.errorlogger.warning("Using a simulated Elveflow OB1, not the real one")
+            return ElveflowSimulator.SimulatedOB1.from_config(self.elveflow_config)
+        return None
+
     def start(self):
         if self.elveflow_handler is not None:
             raise RuntimeError("the elveflow_handler is already running!")
@@ -241,7 +283,12 @@ class ElveflowDisplay(tk.Canvas):
         self.data_y2_label_optionmenu.config(state=tk.NORMAL)
         self.data_y3_label_optionmenu.config(state=tk.NORMAL)
 
-        if FileIO.USE_SDK:
+        if self._backend() == 'replay':
+            # nothing to control: the pressure settings stay disabled
+            speed = float(self.elveflow_config.get('replay_speed', 1))
+            self.errorlogger.warning("Replaying %s at %gx instead of reading the Elveflow" % (self.elveflow_config.get('replay_file'), speed))
+            self.elveflow_handler = FileIO.ElveflowHandler_Replay(self.elveflow_config.get('replay_file'), errorlogger=self.errorlogger, speed=speed)
+        elif FileIO.USE_SDK:
             # self.sourcename_entry.config(state=tk.DISABLED)
             for item in self.pressureSettingActive_toggle:
                 item.config(state=tk.NORMAL)
@@ -255,6 +302,10 @@ class ElveflowDisplay(tk.Canvas):
                                                            errorlogger=self.errorlogger,
                                                            sensortypes=list(map(lambda x: FileIO.SDK_SENSOR_TYPES[x],
                                                                                 [self.elveflow_config['sensor1_type'], self.elveflow_config['sensor2_type'], self.elveflow_config['sensor3_type'], self.elveflow_config['sensor4_type']])),  # TODO: make this not ugly
+                                                           acquisition_rate=float(self.elveflow_config.get('acquisition_rate', FileIO.ElveflowHandler_SDK.ACQUISITION_RATE)),
+                                                           sdk=self._sdk_backend(),
+                                                           ramp_shape=self.elveflow_config.get('ramp_shape', FileIO.ElveflowHandler_SDK.RAMP_SHAPE).strip().lower(),
+                                                           sdk_stats_period=float(self.elveflow_config.get('sdk_stats_period', FileIO.ElveflowHandler_SDK.SDK_STATS_PERIOD)),
                                                            )
             # self.sourcename_var.set(str(self.elveflow_handler.sourcename, encoding='ascii'))
         else:
@@ -274,6 +325,9 @@ class ElveflowDisplay(tk.Canvas):
         self.data_y2_label_var.set(ElveflowDisplay.DEFAULT_Y2_LABEL)
         self.data_y3_label_var.set(ElveflowDisplay.DEFAULT_Y3_LABEL)
         self.elveflow_handler.start()
+        self.flow_stats = RollingStatistics(self.elveflow_handler, errorlogger=self.errorlogger,
+                                            history=float(self.elveflow_config.get('stats_history', RollingStatistics.HISTORY)))
+        self.flow_stats.start()
         self.populate_dropdowns()
 
         self.run_flag.set()  # reset in preparation for if we start up the connection again
@@ -286,12 +340,18 @@ class ElveflowDisplay(tk.Canvas):
                             # simulate `while run_flag.is_set()` but protected by a lock
                             # really only useful during closedown
                             break
-                        new_data = self.elveflow_handler.fetchAll()
-                        self.data.extend(new_data)
-                        self.update_plot()
-                    if save_flag.is_set():
-                        for dict_ in new_data:
-                            self.saveFileWriter.writerow([str(dict_[key]) for key in self.elveflow_handler.header])
+                        self.data_cursor, new_data = self.elveflow_handler.read_since(self.data_cursor)
+                        if self.data is None and self.elveflow_handler.getHeader() is not None:
+                            header = self.elveflow_handler.getHeader()
+                            history_minutes = float(self.elveflow_config.get('history_minutes', ElveflowDisplay.HISTORY_MINUTES))
+                            self.data = TraceStore(header, time_column=header[0], time_origin=self.starttime,
+                                                   hot_seconds=60 * history_minutes)
+                            self.pyramids = {name: MinMaxPyramid() for name in header}
+                        if self.data is not None:
+                            stored = self.data.append_block(new_data)
+                            for name, pyramid in self.pyramids.items():
+                                pyramid.extend(stored[self.data.column_index[name]])
+                        self.renderer.mark_dirty()
                     time.sleep(ElveflowDisplay.POLLING_PERIOD)
             finally:
                 if self.started_shutting_down:
@@ -307,7 +367,7 @@ class ElveflowDisplay(tk.Canvas):
         if FileIO.USE_SDK:
             self.startSaving_button.config(state=tk.NORMAL)
             self.saveFileName_entry.config(state=tk.NORMAL)
-            self.saveFileNameSuffix_var.set("_%d.csv" % time.time())
+            self.saveFileNameSuffix_var.set(self._save_suffix())
 
     def stop(self, shutdown=False):
         import traceback
@@ -315,6 +375,8 @@ class ElveflowDisplay(tk.Canvas):
         self.errorlogger.debug('\n'.join(traceback.format_stack()))
         if self.elveflow_handler is not None:
             self.elveflow_handler.stop()
+        if self.flow_stats is not None:
+            self.flow_stats.stop()
         if FileIO.USE_SDK:
             for item in self.pressureSettingActive_var:
                 item.set(False)
@@ -329,6 +391,7 @@ class ElveflowDisplay(tk.Canvas):
                     pass
         self.stop_saving(shutdown=shutdown)
         if shutdown:
+            self.renderer.stop()
             self.started_shutting_down = True
 
             if not self.run_flag.is_set():
@@ -348,10 +411,21 @@ class ElveflowDisplay(tk.Canvas):
             self.stopSaving_button.config(state=tk.NORMAL)
             self.startSaving_button.config(state=tk.DISABLED)
             self.saveFileName_entry.config(state=tk.DISABLED)
-            self.saveFile = open(os.path.join(ElveflowDisplay.OUTPUT_FOLDER, self.saveFileName_var.get() + self.saveFileNameSuffix_var.get()), 'a', encoding="utf-8", newline='')
-            self.saveFileWriter = csv.writer(self.saveFile)
-            self.saveFileWriter.writerow(self.elveflow_handler.header)
-            self.errorlogger.debug('started saving to %s' % self.saveFile.name)
+            self.saveFile = os.path.join(ElveflowDisplay.OUTPUT_FOLDER, self.saveFileName_var.get() + self.saveFileNameSuffix_var.get())
+            # the writer has its own thread and its own cursor into the handler's buffer, so
+            # a slow disk doesn't hold up plotting
+            fsync_interval = self.elveflow_config.get('save_fsync_interval', '')
+            if self._save_format() == 'columns':
+                parser = getattr(self.elveflow_config, 'parser', None)
+                config = {name: dict(parser[name]) for name in parser.sections()} if parser is not None else dict(self.elveflow_config)
+                sink = ColumnSink(self.saveFile, self.elveflow_handler.header, config=config)
+            else:
+                sink = CsvSink(self.saveFile, self.elveflow_handler.header)
+            self.saveFileWriter = RunWriter(self.elveflow_handler, sink,
+                                            errorlogger=self.errorlogger,
+                                            fsync_interval=float(fsync_interval) if fsync_interval else None)
+            self.saveFileWriter.start()
+            self.errorlogger.debug('started saving to %s' % self.saveFile)
         else:
             self.errorlogger.error('cannot start saving (header is unknown). Try again in a moment')
 
@@ -364,39 +438,62 @@ class ElveflowDisplay(tk.Canvas):
             self.startSaving_button.config(state=tk.NORMAL)
             self.saveFileName_entry.config(state=tk.NORMAL)
 
-        self.saveFileNameSuffix_var.set("_%d.csv" % time.time())
+        self.saveFileNameSuffix_var.set(self._save_suffix())
+
+        if self.saveFileWriter is not None:
+            # returns once every sample taken up to now is written
+            self.saveFileWriter.stop()
+            self.errorlogger.debug('saved to %s: %s' % (self.saveFile, self.saveFileWriter.stats()))
+            self.saveFile = None
+            self.saveFileWriter = None
+
+    def wait_until_stable(self, channel, tol, window, target=None, timeout=None, interrupt_event=None, command_while_waiting=None):
+        """block until the flow rate of Elveflow channel `channel` has stayed within tol µL/min
+        for the last window seconds (see RollingStatistics.wait_until_stable). Returns whether it did"""
+        if self.flow_stats is None:
+            raise RuntimeError("the Elveflow isn't running")
+        return self.flow_stats.wait_until_stable('Volume flow rate %d [µL/min]' % channel, tol, window, target=target, timeout=timeout,
+                                                 interrupt_event=interrupt_event, command_while_waiting=command_while_waiting)
 
-        if self.saveFile is not None:
-            self.saveFile.close()
+    def _save_format(self):
+        """'csv' for plain text files, or 'columns' for binary runs (see hardware.RunWriter)"""
+        return self.elveflow_config.get('save_format', 'csv')
+
+    def _save_suffix(self):
+        return "_%d.%s" % (time.time(), 'run' if self._save_format() == 'columns' else 'csv')
+
+    def add_marker(self, marker_time, color=None):
+        """record an event (like a line on the main graph) in the file being saved, if it can hold them"""
+        sink = getattr(self.saveFileWriter, 'sink', None)
+        if hasattr(sink, 'add_marker'):
+            sink.add_marker(marker_time, color)
 
     def update_plot(self):
-        data_x_label_var = self.data_x_label_var.get()
-        data_y1_label_var = self.data_y1_label_var.get()
-        data_y2_label_var = self.data_y2_label_var.get()
-        data_y3_label_var = self.data_y3_label_var.get()
-        self.ax1.set_xlabel(data_x_label_var, fontsize=14)
-        self.ax1.set_ylabel(data_y1_label_var, fontsize=14, color=ElveflowDisplay.COLOR_Y1)
-        self.ax2.set_ylabel(data_y2_label_var, fontsize=14, color=ElveflowDisplay.COLOR_Y2)
-        self.ax3.set_ylabel(data_y3_label_var, fontsize=14, color=ElveflowDisplay.COLOR_Y3)
+        """bring the lines, and the axes if need be, up to date with the data.
+        Called on the Tk thread by self.renderer before each frame; returns True if the axes changed"""
+        labels = (self.data_x_label_var.get(), self.data_y1_label_var.get(),
+                  self.data_y2_label_var.get(), self.data_y3_label_var.get())
+        data_x_label_var, data_y1_label_var, data_y2_label_var, data_y3_label_var = labels
         try:
-            data_x = np.array([elt[data_x_label_var] for elt in self.data])
-            data_y1 = np.array([elt[data_y1_label_var] for elt in self.data])
-            data_y2 = np.array([elt[data_y2_label_var] for elt in self.data])
-            data_y3 = np.array([elt[data_y3_label_var] for elt in self.data])
-            if data_x_label_var == self.elveflow_handler.header[0]:
-                data_x -= self.starttime
-            if data_y1_label_var == self.elveflow_handler.header[0]:
-                data_y1 -= self.starttime
-            if data_y2_label_var == self.elveflow_handler.header[0]:
-                data_y2 -= self.starttime
-            if data_y3_label_var == self.elveflow_handler.header[0]:
-                data_y3 -= self.starttime
-            extremes = [np.nanmin(data_x), np.nanmax(data_x), np.nanmin(data_y1), np.nanmax(data_y1), np.nanmin(data_y2), np.nanmax(data_y2), np.nanmin(data_y3), np.nanmax(data_y3)]
-            if len(data_x) > 0:
+            if self.data is None:
+                raise ValueError("no data yet")
+            # the store keeps times relative to self.starttime already.
+            # Find the rows once so all three lines cover the same samples
+            if data_x_label_var == self.data.time_column:
+                # only draw what's inside the time limits, plus one point either side so the lines reach the edges
+                start, stop = self.data.index_range(self.axisLimits_numbers[0], self.axisLimits_numbers[1])
+                start, stop = max(0, start - 1), min(len(self.data), stop + 1)
+            else:
+                start, stop = 0, len(self.data)
+            width = int(self.ax1.get_window_extent().width)
+            extremes = [*self.data.extrema(data_x_label_var), *self.data.extrema(data_y1_label_var),
+                        *self.data.extrema(data_y2_label_var), *self.data.extrema(data_y3_label_var)]
+            extremes = self._autoscale(extremes)
+            if stop > start:
                 # https://stackoverflow.com/questions/4098131/how-to-update-a-plot-in-matplotlib/4098938#4098938
-                self.the_line1.set_data(data_x, data_y1)
-                self.the_line2.set_data(data_x, data_y2)
-                self.the_line3.set_data(data_x, data_y3)
+                self.the_line1.set_data(*self.decimated(data_x_label_var, data_y1_label_var, start, stop, width))
+                self.the_line2.set_data(*self.decimated(data_x_label_var, data_y2_label_var, start, stop, width))
+                self.the_line3.set_data(*self.decimated(data_x_label_var, data_y3_label_var, start, stop, width))
         except (ValueError, KeyError):
             extremes = [*self.ax1.get_xlim(), *self.ax1.get_ylim(), *self.ax2.get_ylim(), *self.ax3.get_ylim()]
         if extremes[1] - extremes[0] == 0:
@@ -410,32 +507,54 @@ class ElveflowDisplay(tk.Canvas):
 
         limits = [item if item is not None else extremes[i]
                   for (i, item) in enumerate(self.axisLimits_numbers)]
-        self.ax1.set_xlim(*limits[0:2])
-        self.ax1.set_ylim(*limits[2:4])
-        self.ax2.set_ylim(*limits[4:6])
-        self.ax3.set_ylim(*limits[6:8])
-
-        # HACK:
-        # self.canvas.draw doesn't shut down properly for whatever reason when clicking the exit button
-        # so instead, spawn a daemon thread (a thread that automatically dies at the end of the program -
-        # we haven't been using them elsewhere because they don't allow for graceful exiting/handling of
-        # acquired resources, but I think it shouldn't matter if we crash-exit drawing to the screen
-        # because we're closing the screen anyway, even if it becomes corrupted)
-        def thisIsDumb():
-            self.canvas.draw()
-        tempThread = threading.Thread(target=thisIsDumb, daemon=True)
-        tempThread.start()
 
         # also update the main tab's sheath pressure display
         # TODO!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
         try:
-            self.maingui.initialize_sheath_display_var.set('Sheath pressure:\n%d' % self.data[-1][
+            self.maingui.initialize_sheath_display_var.set('Sheath pressure:\n%d' % self.data.latest(
                 "Pressure %s [mbar]" %
                 (FileIO.ELVEFLOW_DATA_COLUMNS["Pressure 1 [mbar]"] + int(self.elveflow_config["elveflow_sheath_channel"]) - 1)
-                ])
-        except IndexError:
+                ))
+        except (IndexError, AttributeError, KeyError):
             pass
 
+        axes_state = (labels, tuple(limits))
+        if axes_state == self.axes_state:
+            return False
+        self.axes_state = axes_state
+        self.ax1.set_xlabel(data_x_label_var, fontsize=14)
+        self.ax1.set_ylabel(data_y1_label_var, fontsize=14, color=ElveflowDisplay.COLOR_Y1)
+        self.ax2.set_ylabel(data_y2_label_var, fontsize=14, color=ElveflowDisplay.COLOR_Y2)
+        self.ax3.set_ylabel(data_y3_label_var, fontsize=14, color=ElveflowDisplay.COLOR_Y3)
+        self.ax1.set_xlim(*limits[0:2])
+        self.ax1.set_ylim(*limits[2:4])
+        self.ax2.set_ylim(*limits[4:6])
+        self.ax3.set_ylim(*limits[6:8])
+        return True
+
+    def _autoscale(self, extremes):
+        """pad each (min, max) pair of extremes with some headroom, and keep the previous padded
+        limits while the data still fit snugly inside them, so that the axes (and so the whole
+        figure) don't have to be redrawn every time a new sample arrives"""
+        headroom = ElveflowDisplay.AUTOSCALE_HEADROOM
+        limits = []
+        for k in range(4):
+            low, high = extremes[2*k], extremes[2*k+1]
+            span = high - low
+            previous = self.autoscale_limits[k]
+            if not (previous is not None and previous[0] <= low and high <= previous[1]
+                    and previous[1] - previous[0] <= span * (1 + 4*headroom)):
+                self.autoscale_limits[k] = (low - headroom*span, high + headroom*span)
+            limits.extend(self.autoscale_limits[k])
+        return limits
+
+    def decimated(self, data_x_label, data_y_label, start, stop, width):
+        """return (x, y) data for samples start to stop, reduced to about two points per pixel
+        of a plot `width` pixels wide, keeping every bucket's minimum and maximum"""
+        idx = self.pyramids[data_y_label].indices(lambda indices: self.data.take(data_y_label, indices),
+                                                  start, stop, max(1, width))
+        return self.data.take(data_x_label, idx), self.data.take(data_y_label, idx)
+
     def start_pressure(self, channel=1, isPressure=True):
         i = channel - 1
         pressureValue = self.pressureValue_var[i]
@@ -537,7 +656,7 @@ class ElveflowDisplay(tk.Canvas):
             except ValueError:
                 x.set("")
                 self.axisLimits_numbers[i] = None
-        self.update_plot() # just, like, don't do this and also close the program at the same time
+        self.renderer.invalidate()
 
 class Toggle(tk.Label):
     # https://www.reddit.com/r/learnpython/comments/7sx953/how_to_add_a_toggle_switch_in_tkinter/
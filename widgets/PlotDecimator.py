@@ -0,0 +1,140 @@
+"""Min/max decimation of long traces for plotting.
+
+A screen can't show more than a couple of points per pixel column, so there is no point
+handing matplotlib hundreds of thousands of samples. Plain striding would hide pressure
+spikes, so instead each bucket of samples is represented by its minimum and its maximum:
+the decimated line looks the same as the full one, spikes and all.
+
+MinMaxPyramid keeps those (argmin, argmax) pairs for buckets of 4, 16, 64, ... samples,
+updated incrementally as data arrive, so drawing any range of the trace at any zoom only
+touches about as many samples as there are pixels.
+"""
+import numpy as np
+
+
+class _IndexLevel:
+    """one level of the pyramid: for each bucket of `bucket` samples, the index and value of
+    its minimum and its maximum"""
+    FIELDS = (('idx_min', np.int64), ('idx_max', np.int64), ('val_min', np.float64), ('val_max', np.float64))
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.length = 0
+        for name, dtype in _IndexLevel.FIELDS:
+            setattr(self, name, np.empty(256, dtype=dtype))
+
+    def extend(self, idx_min, idx_max, val_min, val_max):
+        n = len(idx_min)
+        if self.length + n > len(self.idx_min):
+            capacity = len(self.idx_min)
+            while capacity < self.length + n:
+                capacity *= 2
+            for name, dtype in _IndexLevel.FIELDS:
+                new = np.empty(capacity, dtype=dtype)
+                new[:self.length] = getattr(self, name)[:self.length]
+                setattr(self, name, new)
+        self.idx_min[self.length:self.length+n] = idx_min
+        self.idx_max[self.length:self.length+n] = idx_max
+        self.val_min[self.length:self.length+n] = val_min
+        self.val_max[self.length:self.length+n] = val_max
+        # publish only after writing, for readers on other threads
+        self.length += n
+
+
+class MinMaxPyramid:
+    """Multi-resolution min/max index of one growing column.
+
+    Feed it every new sample of the column with extend(), from the thread that appends to
+    the column; indices() may then be called from any thread. The pyramid keeps the values
+    it needs, so it never has to look back at old samples, which may be on disk."""
+    BASE_BUCKET = 4  # samples per bucket at the finest level
+    FACTOR = 4  # each level's buckets hold this many of the previous level's
+
+    def __init__(self):
+        self.levels = [_IndexLevel(MinMaxPyramid.BASE_BUCKET)]
+        self._pending = np.empty(0)  # samples not yet making up a whole bucket
+
+    def extend(self, values):
+        """fold new samples into the pyramid"""
+        values = np.concatenate((self._pending, np.asarray(values, dtype=np.float64)))
+        bucket = MinMaxPyramid.BASE_BUCKET
+        level = self.levels[0]
+        n_new = len(values) // bucket
+        self._pending = values[n_new*bucket:]
+        if n_new > 0:
+            chunk = values[:n_new*bucket].reshape(n_new, bucket)
+            pick_min, pick_max = _nan_argmin(chunk), _nan_argmax(chunk)
+            offsets = level.length * bucket + bucket * np.arange(n_new)
+            level.extend(offsets + pick_min, offsets + pick_max,
+                         _pick(chunk, pick_min), _pick(chunk, pick_max))
+
+        k = 1
+        while self.levels[k-1].length >= MinMaxPyramid.FACTOR:
+            previous = self.levels[k-1]
+            if k == len(self.levels):
+                self.levels.append(_IndexLevel(previous.bucket * MinMaxPyramid.FACTOR))
+            level = self.levels[k]
+            n_new = previous.length // MinMaxPyramid.FACTOR - level.length
+            if n_new > 0:
+                first = level.length * MinMaxPyramid.FACTOR
+                last = first + n_new * MinMaxPyramid.FACTOR
+                shape = (n_new, MinMaxPyramid.FACTOR)
+                val_min = previous.val_min[first:last].reshape(shape)
+                val_max = previous.val_max[first:last].reshape(shape)
+                pick_min, pick_max = _nan_argmin(val_min), _nan_argmax(val_max)
+                level.extend(_pick(previous.idx_min[first:last].reshape(shape), pick_min),
+                             _pick(previous.idx_max[first:last].reshape(shape), pick_max),
+                             _pick(val_min, pick_min), _pick(val_max, pick_max))
+            k += 1
+
+    def indices(self, take, start, stop, n_buckets):
+        """return sorted indices of samples in [start, stop) that draw like the whole range on
+        a plot n_buckets pixels wide: the first and last samples, and the minimum and maximum
+        of each of n_buckets equal slices of the range. take(indices) must return the values
+        of the column at those (sorted) indices"""
+        if stop - start <= 2 * n_buckets:
+            return np.arange(start, stop)
+        # the coarsest level that still has at least n_buckets buckets in the range...
+        k = -1
+        while k + 1 < len(self.levels) and (stop - start) / self.levels[k+1].bucket >= n_buckets:
+            k += 1
+        candidates = np.unique(self._indices(start, stop, k))
+        # ...which gives up to FACTOR times too many points, so do one last min/max pass over them
+        slice_number = (candidates - start) * n_buckets // (stop - start)
+        values = take(candidates)
+        boundaries = np.flatnonzero(np.diff(slice_number)) + 1
+        order = np.lexsort((np.where(np.isnan(values), np.inf, values), slice_number))
+        minima = candidates[order[np.concatenate(([0], boundaries))]]
+        order = np.lexsort((np.where(np.isnan(values), -np.inf, values), slice_number))
+        maxima = candidates[order[np.concatenate((boundaries - 1, [len(candidates) - 1]))]]
+        return np.unique(np.concatenate(([start, stop - 1], minima, maxima)))
+
+    def _indices(self, start, stop, k):
+        if stop <= start:
+            return np.empty(0, dtype=np.int64)
+        if k < 0:
+            return np.arange(start, stop)
+        level = self.levels[k]
+        first = -(-start // level.bucket)
+        last = min(stop // level.bucket, level.length)
+        if last <= first:
+            return self._indices(start, stop, k - 1)
+        # whole buckets from this level, and the ragged ends from finer levels
+        return np.concatenate((self._indices(start, first * level.bucket, k - 1),
+                               level.idx_min[first:last], level.idx_max[first:last],
+                               self._indices(last * level.bucket, stop, k - 1)))
+
+
+def _pick(a, columns):
+    """a[i, columns[i]] for every row i"""
+    return np.take_along_axis(a, columns[:, None], axis=1)[:, 0]
+
+
+def _nan_argmin(a):
+    """argmin along the last axis, ignoring NaNs (an all-NaN row gives its first index)"""
+    return np.where(np.isnan(a), np.inf, a).argmin(axis=-1)
+
+
+def _nan_argmax(a):
+    """argmax along the last axis, ignoring NaNs (an all-NaN row gives its first index)"""
+    return np.where(np.isnan(a), -np.inf, a).argmax(axis=-1)
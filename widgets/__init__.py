@@ -1,6 +1,8 @@
+from .BlitRenderer import BlitRenderer
 from .COMPortSelector import COMPortSelector
 from .ConsoleUi import ConsoleUi
 from .ElveflowDisplay import ElveflowDisplay
 from .FlowPath import FlowPath
 from .MiscLogger import MiscLogger
+from .PlotDecimator import MinMaxPyramid
 from .TextHandler import TextHandler